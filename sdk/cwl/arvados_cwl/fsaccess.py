@@ -73,7 +73,8 @@ class CollectionCache(object):
                 try:
                     cr = arvados.collection.CollectionReader(locator, api_client=self.api_client,
                                                              keep_client=self.keep_client,
-                                                             num_retries=self.num_retries)
+                                                             num_retries=self.num_retries,
+                                                             lazy=True)
                 except arvados.errors.ApiError as ap:
                     raise IOError(errno.ENOENT, "Could not access collection '%s': %s" % (locator, str(ap._get_reason())))
                 sz = len(cr.manifest_text()) * 128
@@ -4,6 +4,8 @@
 
 from __future__ import division
 from builtins import object
+from builtins import range
+import array
 import logging
 
 _logger = logging.getLogger('arvados.ranges')
@@ -29,6 +31,154 @@ class Range(object):
                 self.range_size == other.range_size and
                 self.segment_offset == other.segment_offset)
 
+try:
+    array.array('q')
+    _INT64 = 'q'
+except ValueError:
+    # Python 2 has no 'q', but 'l' is 64 bits on LP64 platforms.
+    _INT64 = 'l'
+
+class SegmentList(object):
+    """Compact, array-backed list of Range objects.
+
+    Each segment is stored as four 64-bit integers in a single array: an
+    index into the table of distinct locators, range_start, range_size and
+    segment_offset.  This takes about 40 bytes per segment instead of a
+    Range object and its attributes.  Fields are interleaved rather than
+    kept in separate arrays so that a file with a single segment (the
+    common case) only pays for one array header.
+
+    SegmentList supports the list operations used by locators_and_ranges()
+    and replace_range().  Indexing and iteration return new Range objects,
+    so changing those does not change the list: assign them back, or use
+    replace_locators().
+
+    """
+    __slots__ = ('_data', '_locators', '_locator_ids')
+
+    def __init__(self, ranges=()):
+        self._data = array.array(_INT64)
+        # A tuple while short, since most files only have a few blocks.
+        self._locators = ()
+        self._locator_ids = None
+        for r in ranges:
+            self.append(r)
+
+    def _locator_id(self, locator):
+        locators = self._locators
+        if not locators:
+            self._locators = (locator,)
+            return 0
+        if locators[-1] == locator:
+            return len(locators) - 1
+        if self._locator_ids is None and len(locators) >= 8:
+            self._locator_ids = {loc: i for i, loc in enumerate(locators)}
+        if self._locator_ids is not None:
+            i = self._locator_ids.get(locator)
+        elif locator in locators:
+            i = locators.index(locator)
+        else:
+            i = None
+        if i is not None:
+            return i
+        if len(locators) > len(self._data) // 2 + 8:
+            self._compact()
+            locators = self._locators
+        i = len(locators)
+        if i < 8:
+            self._locators = tuple(locators) + (locator,)
+        else:
+            if isinstance(locators, tuple):
+                self._locators = locators = list(locators)
+            locators.append(locator)
+        if self._locator_ids is not None:
+            self._locator_ids[locator] = i
+        return i
+
+    def _compact(self):
+        # Drop locators that are no longer referenced by any segment.
+        data = self._data
+        remap = {}
+        locators = []
+        for p in range(0, len(data), 4):
+            i = remap.get(data[p])
+            if i is None:
+                i = remap[data[p]] = len(locators)
+                locators.append(self._locators[data[p]])
+            data[p] = i
+        self._locators = tuple(locators) if len(locators) < 8 else locators
+        self._locator_ids = None
+
+    def _offset(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("segment index out of range")
+        return i * 4
+
+    def __len__(self):
+        return len(self._data) // 4
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        p = self._offset(i)
+        data = self._data
+        return Range(self._locators[data[p]], data[p+1], data[p+2], data[p+3])
+
+    def _pack(self, r):
+        return array.array(_INT64, (self._locator_id(r.locator), r.range_start,
+                                    r.range_size, r.segment_offset))
+
+    def __setitem__(self, i, r):
+        p = self._offset(i)
+        self._data[p:p+4] = self._pack(r)
+
+    def __delitem__(self, i):
+        p = self._offset(i)
+        del self._data[p:p+4]
+
+    def insert(self, i, r):
+        n = len(self)
+        if i < 0:
+            i = max(i + n, 0)
+        i = min(i, n)
+        self._data[i*4:i*4] = self._pack(r)
+
+    def append(self, r):
+        self.append_segment(r.locator, r.range_start, r.range_size, r.segment_offset)
+
+    def append_segment(self, locator, range_start, range_size, segment_offset):
+        """Append a segment without making a Range object."""
+        self._data.extend((self._locator_id(locator), range_start, range_size, segment_offset))
+
+    def __iter__(self):
+        data = self._data
+        locators = self._locators
+        for p in range(0, len(data), 4):
+            yield Range(locators[data[p]], data[p+1], data[p+2], data[p+3])
+
+    def __repr__(self):
+        return "SegmentList(%r)" % list(self)
+
+    def locators(self):
+        """Return the set of locators referenced by segments."""
+        return set(self._locators[i] for i in self._data[0::4])
+
+    def replace_locators(self, mapping):
+        """Replace locators in all segments according to `mapping` (a dict)."""
+        if not mapping:
+            return
+        self._locators = type(self._locators)(mapping.get(loc, loc) for loc in self._locators)
+        self._locator_ids = None
+
+    def size(self):
+        """Return the end of the last segment."""
+        if not self._data:
+            return 0
+        return self._data[-3] + self._data[-2]
+
 def first_block(data_locators, range_start):
     block_start = 0
 
@@ -173,7 +323,7 @@ def replace_range(data_locators, new_range_start, new_range_size, new_locator, n
     if (last.range_start+last.range_size) == new_range_start:
         if last.locator == new_locator and (last.segment_offset+last.range_size) == new_segment_offset:
             # extend last segment
-            last.range_size += new_range_size
+            data_locators[-1] = Range(last.locator, last.range_start, last.range_size + new_range_size, last.segment_offset)
         else:
             data_locators.append(Range(new_locator, new_range_start, new_range_size, new_segment_offset))
         return
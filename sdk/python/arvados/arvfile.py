@@ -9,9 +9,9 @@ from future.utils import listitems, listvalues
 standard_library.install_aliases()
 from builtins import range
 from builtins import object
+import bisect
 import bz2
 import collections
-import copy
 import errno
 import functools
 import hashlib
@@ -21,14 +21,16 @@ import queue
 import re
 import sys
 import threading
+import time
 import uuid
+import weakref
 import zlib
 
 from . import config
 from .errors import KeepWriteError, AssertionError, ArgumentError
-from .keep import KeepLocator
+from .keep import KeepLocator, KeepClient
 from ._normalize_stream import normalize_stream
-from ._ranges import locators_and_ranges, replace_range, Range, LocatorAndRange
+from ._ranges import locators_and_ranges, replace_range, Range, LocatorAndRange, SegmentList
 from .retry import retry_method
 
 MOD = "mod"
@@ -271,6 +273,12 @@ def synchronized(orig_func):
     return synchronized_wrapper
 
 
+# Locks that guard the segment lists of ArvadosFile objects, see
+# ArvadosFile._segment_lock().  Files share a fixed pool instead of
+# having a lock each, which would cost memory in huge collections.
+_segment_locks = [threading.Lock() for _ in range(64)]
+
+
 class StateChangeError(Exception):
     def __init__(self, message, state, nextstate):
         super(StateChangeError, self).__init__(message)
@@ -319,6 +327,10 @@ class _BufferBlock(object):
         self.buffer_block = bytearray(starting_capacity)
         self.buffer_view = memoryview(self.buffer_block)
         self.write_pointer = 0
+        # Running md5 of the first _md5_size bytes of the buffer,
+        # updated by append().
+        self._md5 = hashlib.md5()
+        self._md5_size = 0
         self._state = _BufferBlock.WRITABLE
         self._locator = None
         self.owner = owner
@@ -343,6 +355,9 @@ class _BufferBlock(object):
                 self.buffer_block = new_buffer_block
                 self.buffer_view = memoryview(self.buffer_block)
             self.buffer_view[self.write_pointer:self.write_pointer+len(data)] = data
+            if self._md5_size == self.write_pointer:
+                self._md5.update(data)
+                self._md5_size += len(data)
             self.write_pointer += len(data)
             self._locator = None
         else:
@@ -385,7 +400,12 @@ class _BufferBlock(object):
     def locator(self):
         """The Keep locator for this buffer's contents."""
         if self._locator is None:
-            self._locator = "%s+%i" % (hashlib.md5(self.buffer_view[0:self.write_pointer]).hexdigest(), self.size())
+            if self._md5_size != self.write_pointer:
+                # write_pointer was moved without append() (e.g., the
+                # padding block), so hash the buffer from scratch.
+                self._md5 = hashlib.md5(self.buffer_view[0:self.write_pointer])
+                self._md5_size = self.write_pointer
+            self._locator = "%s+%i" % (self._md5.hexdigest(), self.size())
         return self._locator
 
     @synchronized
@@ -430,7 +450,7 @@ class _BufferBlock(object):
             # If there's more than one segment referencing this block, it is
             # due to out-of-order writes and will produce a fragmented
             # manifest, so try to optimize by re-packing into a new buffer.
-            contents = self.buffer_view[0:self.write_pointer].tobytes()
+            contents = self.buffer_view[0:self.write_pointer]
             new_bb = _BufferBlock(None, write_total, None)
             for t in bufferblock_segs:
                 new_bb.append(contents[t.segment_offset:t.segment_offset+t.range_size])
@@ -439,6 +459,8 @@ class _BufferBlock(object):
             self.buffer_block = new_bb.buffer_block
             self.buffer_view = new_bb.buffer_view
             self.write_pointer = new_bb.write_pointer
+            self._md5 = new_bb._md5
+            self._md5_size = new_bb._md5_size
             self._locator = None
             new_bb.clear()
             self.owner.set_segments(segs)
@@ -480,27 +502,73 @@ class _BlockManager(object):
 
     DEFAULT_PUT_THREADS = 2
     DEFAULT_GET_THREADS = 2
+    MAX_PUT_THREADS = 32
+
+    # If we don't limit the amount of data waiting to be uploaded, it can
+    # quickly grow to take up gigabytes of RAM if the writing process is
+    # generating data more quickly than it can be sent to the Keep
+    # servers.  The default allows 4 full 64 MiB blocks, which is the
+    # same size as the default download block cache in KeepClient.
+    # The adaptive upload logic doesn't add threads beyond what the
+    # limit can keep busy.
+    DEFAULT_MAX_BUFFER_BYTES = 4 * config.KEEP_BLOCK_SIZE
+
+    # Maximum readahead window of each file, see _Readahead.
+    DEFAULT_READAHEAD_BYTES = 2 * config.KEEP_BLOCK_SIZE
+
+    # Tuning for the adaptive upload concurrency, see _put_block_done().
+    PUT_THROUGHPUT_TOLERANCE = 0.1
+    PUT_LATENCY_BACKOFF = 2.0
+
+    def __init__(self, keep, copies=None, put_threads=None, num_retries=None,
+                 max_buffer_bytes=None, readahead_bytes=None):
+        """keep: KeepClient object to use
+
+        put_threads: fixed number of upload threads.  If not given, uploads
+        start with DEFAULT_PUT_THREADS threads, and the number is adjusted
+        (up to MAX_PUT_THREADS) according to the observed throughput.
 
-    def __init__(self, keep, copies=None, put_threads=None, num_retries=None):
-        """keep: KeepClient object to use"""
+        max_buffer_bytes: maximum amount of data waiting to be uploaded.
+        Asynchronous commits block until enough data has been uploaded.
+
+        readahead_bytes: maximum amount of data to prefetch ahead of a
+        file being read sequentially.  0 disables readahead.
+
+        """
         self._keep = keep
         self._bufferblocks = collections.OrderedDict()
         self._put_queue = None
         self._put_threads = None
         self._prefetch_queue = None
         self._prefetch_threads = None
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_queued = {}
+        self._prefetch_inflight = set()
         self.lock = threading.Lock()
         self.prefetch_enabled = True
         if put_threads:
             self.num_put_threads = put_threads
+            self.max_put_threads = put_threads
+            self._put_adaptive = False
         else:
             self.num_put_threads = _BlockManager.DEFAULT_PUT_THREADS
+            self.max_put_threads = _BlockManager.MAX_PUT_THREADS
+            self._put_adaptive = True
         self.num_get_threads = _BlockManager.DEFAULT_GET_THREADS
         self.copies = copies
         self._pending_write_size = 0
         self.threads_lock = threading.Lock()
         self.padding_block = None
         self.num_retries = num_retries
+        self.max_buffer_bytes = max_buffer_bytes or _BlockManager.DEFAULT_MAX_BUFFER_BYTES
+        self._put_pending_bytes = 0
+        self._put_pending_cond = threading.Condition(self.threads_lock)
+        self._put_stats_reset(None)
+        self._put_best_latency = None
+        self._put_last_step = 1
+        if readahead_bytes is None:
+            readahead_bytes = _BlockManager.DEFAULT_READAHEAD_BYTES
+        self.readahead_bytes = readahead_bytes
 
     @synchronized
     def alloc_bufferblock(self, blockid=None, starting_capacity=2**14, owner=None):
@@ -545,59 +613,175 @@ class _BlockManager(object):
     def is_bufferblock(self, locator):
         return locator in self._bufferblocks
 
+    def _put_bufferblock(self, bufferblock):
+        # Upload the buffer without copying it, reusing the md5 hash
+        # computed as data was appended.
+        kwargs = {
+            'num_retries': self.num_retries,
+            'data_hash': bufferblock.locator().split('+')[0],
+        }
+        if self.copies is not None:
+            kwargs['copies'] = self.copies
+        return self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer], **kwargs)
+
     def _commit_bufferblock_worker(self):
         """Background uploader thread."""
 
         while True:
+            nbytes = 0
             try:
                 bufferblock = self._put_queue.get()
                 if bufferblock is None:
                     return
 
-                if self.copies is None:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries)
-                else:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies)
+                nbytes = bufferblock.size()
+                t0 = time.time()
+                loc = self._put_bufferblock(bufferblock)
                 bufferblock.set_state(_BufferBlock.COMMITTED, loc)
+                if self._put_block_done(nbytes, time.time() - t0):
+                    return
             except Exception as e:
                 bufferblock.set_state(_BufferBlock.ERROR, e)
             finally:
+                self._put_release(nbytes)
                 if self._put_queue is not None:
                     self._put_queue.task_done()
 
+    def _keep_counter(self, name, value):
+        counter = getattr(self._keep, name, None)
+        if counter is not None:
+            counter.add(value)
+
+    def _start_put_thread(self):
+        # Must be called with threads_lock held.
+        thread = threading.Thread(target=self._commit_bufferblock_worker)
+        self._put_threads.append(thread)
+        thread.daemon = True
+        thread.start()
+        self._keep_counter('upload_threads_counter', 1)
+
     def start_put_threads(self):
         with self.threads_lock:
             if self._put_threads is None:
-                # Start uploader threads.
-
-                # If we don't limit the Queue size, the upload queue can quickly
-                # grow to take up gigabytes of RAM if the writing process is
-                # generating data more quickly than it can be send to the Keep
-                # servers.
-                #
-                # With two upload threads and a queue size of 2, this means up to 4
-                # blocks pending.  If they are full 64 MiB blocks, that means up to
-                # 256 MiB of internal buffering, which is the same size as the
-                # default download block cache in KeepClient.
-                self._put_queue = queue.Queue(maxsize=2)
-
+                # Start uploader threads.  The queue itself is unbounded:
+                # memory use is limited by _put_reserve() instead.
+                self._put_queue = queue.Queue()
                 self._put_threads = []
                 for i in range(0, self.num_put_threads):
-                    thread = threading.Thread(target=self._commit_bufferblock_worker)
-                    self._put_threads.append(thread)
-                    thread.daemon = True
-                    thread.start()
+                    self._start_put_thread()
+
+    def _put_reserve(self, nbytes):
+        # Wait until the block fits in the pending upload budget.  A block
+        # larger than the whole budget is allowed once nothing else is
+        # pending, so that it can't wait forever.
+        with self._put_pending_cond:
+            while (self._put_pending_bytes > 0 and
+                   self._put_pending_bytes + nbytes > self.max_buffer_bytes):
+                self._put_pending_cond.wait()
+            self._put_pending_bytes += nbytes
+        self._keep_counter('upload_pending_counter', nbytes)
+
+    def _put_release(self, nbytes):
+        if not nbytes:
+            return
+        with self._put_pending_cond:
+            self._put_pending_bytes -= nbytes
+            self._put_pending_cond.notify_all()
+        self._keep_counter('upload_pending_counter', -nbytes)
+
+    def _put_stats_reset(self, now):
+        self._put_window_start = now
+        self._put_window_blocks = 0
+        self._put_window_bytes = 0
+        self._put_window_busy = 0.0
+        self._put_throughput = None
+
+    def _put_block_done(self, nbytes, elapsed):
+        """Record a finished upload and adjust the number of upload threads.
+
+        Statistics are collected over rounds of one block per thread.  At
+        the end of each round:
+
+        * if aggregate throughput dropped compared to the previous round,
+          undo the last adjustment;
+        * otherwise, if the time spent per byte grew well beyond the best
+          seen so far without a gain in throughput, keepstore is saturated,
+          so remove a thread;
+        * otherwise, if blocks are waiting in the queue and the pending
+          upload budget has room for another block in flight, add a thread.
+
+        Returns True if the calling thread should exit.
+
+        """
+        with self.threads_lock:
+            if self._put_threads is None or not self._put_adaptive:
+                return False
+            now = time.time()
+            if self._put_window_start is None:
+                self._put_window_start = now - elapsed
+            self._put_window_blocks += 1
+            self._put_window_bytes += nbytes
+            self._put_window_busy += elapsed
+            if self._put_window_blocks < self.num_put_threads:
+                return False
+
+            throughput = self._put_window_bytes / max(now - self._put_window_start, 1e-6)
+            latency = self._put_window_busy / max(self._put_window_bytes, 1)
+            block_size = self._put_window_bytes / self._put_window_blocks
+            previous = self._put_throughput
+            self._put_stats_reset(now)
+            self._put_throughput = throughput
+            if self._put_best_latency is None or latency < self._put_best_latency:
+                self._put_best_latency = latency
+
+            tolerance = _BlockManager.PUT_THROUGHPUT_TOLERANCE
+            if previous is not None and throughput < previous * (1 - tolerance):
+                step = -self._put_last_step
+            elif (latency > self._put_best_latency * _BlockManager.PUT_LATENCY_BACKOFF and
+                  (previous is None or throughput < previous * (1 + tolerance))):
+                step = -1
+            elif (self._put_queue.qsize() > 0 and
+                  (self.num_put_threads + 1) * block_size <= self.max_buffer_bytes):
+                # Only add a thread if the pending upload budget can
+                # keep it busy.
+                step = 1
+            else:
+                step = 0
+
+            target = min(max(self.num_put_threads + step, 1), self.max_put_threads)
+            if target == self.num_put_threads:
+                return False
+            self._put_last_step = target - self.num_put_threads
+            _logger.debug("Adjusting upload threads from %d to %d (%d bytes/s)",
+                          self.num_put_threads, target, throughput)
+            self.num_put_threads = target
+            if target > len(self._put_threads):
+                self._start_put_thread()
+                return False
+            self._put_threads.remove(threading.current_thread())
+            self._keep_counter('upload_threads_counter', -1)
+            return True
 
     def _block_prefetch_worker(self):
         """The background downloader thread."""
         while True:
+            b = self._prefetch_queue.get()
+            if b is None:
+                return
+            with self._prefetch_lock:
+                if b not in self._prefetch_queued:
+                    # Cancelled, or a duplicate of a block that has
+                    # already been fetched.
+                    continue
+                del self._prefetch_queued[b]
+                self._prefetch_inflight.add(b)
             try:
-                b = self._prefetch_queue.get()
-                if b is None:
-                    return
                 self._keep.get(b)
             except Exception:
                 _logger.exception("Exception doing block prefetch")
+            finally:
+                with self._prefetch_lock:
+                    self._prefetch_inflight.discard(b)
 
     @synchronized
     def start_get_threads(self):
@@ -615,12 +799,15 @@ class _BlockManager(object):
     def stop_threads(self):
         """Shut down and wait for background upload and download threads to finish."""
 
-        if self._put_threads is not None:
-            for t in self._put_threads:
+        with self.threads_lock:
+            put_threads = self._put_threads
+            self._put_threads = None
+        if put_threads is not None:
+            for t in put_threads:
                 self._put_queue.put(None)
-            for t in self._put_threads:
+            for t in put_threads:
                 t.join()
-        self._put_threads = None
+            self._keep_counter('upload_threads_counter', -len(put_threads))
         self._put_queue = None
 
         if self._prefetch_threads is not None:
@@ -680,7 +867,7 @@ class _BlockManager(object):
             bb = small_blocks.pop(0)
             new_bb.owner.append(bb.owner)
             self._pending_write_size -= bb.size()
-            new_bb.append(bb.buffer_view[0:bb.write_pointer].tobytes())
+            new_bb.append(bb.buffer_view[0:bb.write_pointer])
             files.append((bb, new_bb.write_pointer - bb.size()))
 
         self.commit_bufferblock(new_bb, sync=sync)
@@ -725,16 +912,14 @@ class _BlockManager(object):
 
         if sync:
             try:
-                if self.copies is None:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries)
-                else:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies)
+                loc = self._put_bufferblock(block)
                 block.set_state(_BufferBlock.COMMITTED, loc)
             except Exception as e:
                 block.set_state(_BufferBlock.ERROR, e)
                 raise
         else:
             self.start_put_threads()
+            self._put_reserve(block.size())
             self._put_queue.put(block)
 
     @synchronized
@@ -770,7 +955,8 @@ class _BlockManager(object):
         """Fetch a block.
 
         First checks to see if the locator is a BufferBlock and return that, if
-        not, passes the request through to KeepClient.get().
+        not, passes the request through to KeepClient.  Blocks from Keep
+        may be read-only memoryviews rather than bytes.
 
         """
         with self.lock:
@@ -780,10 +966,19 @@ class _BlockManager(object):
                     return bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes()
                 else:
                     locator = bufferblock._locator
+        return self._get_from_keep(locator, num_retries=num_retries,
+                                   cache_only=cache_only)
+
+    def _get_from_keep(self, locator, num_retries=None, cache_only=False):
+        # KeepClient can return a cached block without copying it.  Other
+        # keep client objects only need to provide get() and
+        # get_from_cache().
+        if isinstance(self._keep, KeepClient):
+            return self._keep._get_view(locator, num_retries=num_retries,
+                                        cache_only=cache_only)
         if cache_only:
             return self._keep.get_from_cache(locator)
-        else:
-            return self._keep.get(locator, num_retries=num_retries)
+        return self._keep.get(locator, num_retries=num_retries)
 
     def commit_all(self):
         """Commit all outstanding buffer blocks.
@@ -834,23 +1029,106 @@ class _BlockManager(object):
 
         This assumes that the underlying KeepClient implements a block cache,
         so repeated requests for the same block will not result in repeated
-        downloads (unless the block is evicted from the cache.)  This method
-        does not block.
+        downloads (unless the block is evicted from the cache.)  A block
+        that is already queued or being downloaded is not queued again.
+        This method does not block.
+
+        Returns True if the request was queued.  Each such call should be
+        matched by a call to cancel_prefetch() if the caller no longer
+        needs the block.
 
         """
 
         if not self.prefetch_enabled:
-            return
+            return False
 
-        if self._keep.get_from_cache(locator) is not None:
-            return
+        if self._get_from_keep(locator, cache_only=True) is not None:
+            return False
 
         with self.lock:
             if locator in self._bufferblocks:
-                return
+                return False
 
         self.start_get_threads()
+        with self._prefetch_lock:
+            if locator in self._prefetch_inflight:
+                return False
+            if locator in self._prefetch_queued:
+                self._prefetch_queued[locator] += 1
+                return True
+            self._prefetch_queued[locator] = 1
         self._prefetch_queue.put(locator)
+        return True
+
+    def cancel_prefetch(self, locator):
+        """Withdraw a block_prefetch() request.
+
+        The download is skipped if it hasn't started yet and nobody else
+        requested the block.
+
+        """
+        with self._prefetch_lock:
+            n = self._prefetch_queued.get(locator)
+            if n == 1:
+                del self._prefetch_queued[locator]
+            elif n:
+                self._prefetch_queued[locator] = n - 1
+
+
+class _Readahead(object):
+    """Readahead state of one reader of a file.
+
+    A read that starts where the previous one ended, or skips ahead
+    within the current window, is sequential and doubles the readahead
+    window, starting at MIN_WINDOW, up to the block manager's
+    readahead_bytes.  Any other read is random access and resets the
+    window to zero.
+
+    Also remembers which blocks were queued for prefetch, so each block
+    is requested only once, and requests the reader has moved away from
+    can be cancelled.
+
+    """
+
+    __slots__ = ('_next', 'window', '_requested')
+
+    MIN_WINDOW = 1024 * 1024
+
+    def __init__(self):
+        self._next = 0
+        self.window = 0
+        self._requested = set()
+
+    def advance(self, offset, size, max_window):
+        """Record a read and return the number of bytes to read ahead."""
+        if self._next <= offset <= self._next + self.window:
+            self.window = min(max(self.window * 2, _Readahead.MIN_WINDOW), max_window)
+        else:
+            self.window = 0
+        self._next = offset + size
+        return self.window
+
+    def request(self, locators):
+        """Return (locators to prefetch, locators to cancel).
+
+        `locators` is the list of blocks in the current window.  The
+        blocks to prefetch are not remembered until they are passed to
+        queued().
+        """
+        wanted = set()
+        start = []
+        for loc in locators:
+            if loc not in wanted:
+                wanted.add(loc)
+                if loc not in self._requested:
+                    start.append(loc)
+        stale = self._requested - wanted
+        self._requested &= wanted
+        return start, stale
+
+    def queued(self, locators):
+        """Remember blocks that block_prefetch() actually queued."""
+        self._requested.update(locators)
 
 
 class ArvadosFile(object):
@@ -865,7 +1143,8 @@ class ArvadosFile(object):
     """
 
     __slots__ = ('parent', 'name', '_writers', '_committed',
-                 '_segments', 'lock', '_current_bblock', 'fuse_entry')
+                 '_segments', 'lock', '_current_bblock', 'fuse_entry',
+                 '_readahead', '_reader_readahead', '_digest')
 
     def __init__(self, parent, name, stream=[], segments=[]):
         """
@@ -881,20 +1160,35 @@ class ArvadosFile(object):
         self.name = name
         self._writers = set()
         self._committed = False
-        self._segments = []
+        self._segments = SegmentList()
         self.lock = parent.root_collection().lock
         for s in segments:
             self._add_segment(stream, s.locator, s.range_size)
         self._current_bblock = None
+        self._readahead = None
+        self._reader_readahead = None
+        self._digest = None
 
     def writable(self):
         return self.parent.writable()
 
+    def _segment_lock(self):
+        """Return the lock that guards changes to the segment list.
+
+        Writers hold the collection lock (self.lock) as well, so they can
+        read the segments without this one.  Readers only take this lock,
+        so reading files doesn't wait for writers and flushes elsewhere
+        in the collection.  Don't call anything that takes another lock
+        while holding it.
+
+        """
+        return _segment_locks[(id(self) >> 4) % len(_segment_locks)]
+
     @synchronized
     def permission_expired(self, as_of_dt=None):
         """Returns True if any of the segment's locators is expired"""
-        for r in self._segments:
-            if KeepLocator(r.locator).permission_expired(as_of_dt):
+        for loc in self._segments.locators():
+            if KeepLocator(loc).permission_expired(as_of_dt):
                 return True
         return False
 
@@ -902,11 +1196,16 @@ class ArvadosFile(object):
     def has_remote_blocks(self):
         """Returns True if any of the segment's locators has a +R signature"""
 
-        for s in self._segments:
-            if '+R' in s.locator:
+        for loc in self._segments.locators():
+            if '+R' in loc:
                 return True
         return False
 
+    @synchronized
+    def _remote_locators(self):
+        """Return the set of remote (+R) block locators used by the file."""
+        return set(loc for loc in self._segments.locators() if '+R' in loc)
+
     @synchronized
     def _copy_remote_blocks(self, remote_blocks={}):
         """Ask Keep to copy remote blocks and point to their local copies.
@@ -919,20 +1218,27 @@ class ArvadosFile(object):
             different subdirectories.
         """
 
-        for s in self._segments:
-            if '+R' in s.locator:
+        local_blocks = {}
+        for remote_loc in self._segments.locators():
+            if '+R' in remote_loc:
                 try:
-                    loc = remote_blocks[s.locator]
+                    loc = remote_blocks[remote_loc]
                 except KeyError:
-                    loc = self.parent._my_keep().refresh_signature(s.locator)
-                    remote_blocks[s.locator] = loc
-                s.locator = loc
-                self.parent.set_committed(False)
+                    loc = self.parent._my_keep().refresh_signature(remote_loc)
+                    remote_blocks[remote_loc] = loc
+                local_blocks[remote_loc] = loc
+        if local_blocks:
+            with self._segment_lock():
+                self._segments.replace_locators(local_blocks)
+            self._digest = None
+            self.parent._forget_stream_text()
+            self.parent.set_committed(False)
         return remote_blocks
 
     @synchronized
     def segments(self):
-        return copy.copy(self._segments)
+        """Return a list of Range objects (copies) describing the file's segments."""
+        return list(self._segments)
 
     @synchronized
     def clone(self, new_parent, new_name):
@@ -947,7 +1253,7 @@ class ArvadosFile(object):
         """Replace segments of this file with segments from another `ArvadosFile` object."""
 
         map_loc = {}
-        self._segments = []
+        segments = SegmentList()
         for other_segment in other.segments():
             new_loc = other_segment.locator
             if other.parent._my_block_manager().is_bufferblock(other_segment.locator):
@@ -959,8 +1265,9 @@ class ArvadosFile(object):
                         map_loc[other_segment.locator] = self.parent._my_block_manager().dup_block(bufferblock, self).blockid
                 new_loc = map_loc[other_segment.locator]
 
-            self._segments.append(Range(new_loc, other_segment.range_start, other_segment.range_size, other_segment.segment_offset))
+            segments.append(Range(new_loc, other_segment.range_start, other_segment.range_size, other_segment.segment_offset))
 
+        self._segments = segments
         self.set_committed(False)
 
     def __eq__(self, other):
@@ -969,6 +1276,12 @@ class ArvadosFile(object):
         if not isinstance(other, ArvadosFile):
             return False
 
+        digest = self._content_digest()
+        if digest is not None:
+            other_digest = other._content_digest()
+            if other_digest is not None:
+                return digest == other_digest
+
         othersegs = other.segments()
         with self.lock:
             if len(self._segments) != len(othersegs):
@@ -996,9 +1309,63 @@ class ArvadosFile(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    @synchronized
+    def _content_digest(self, signed=False):
+        """Return a digest of the file's segments, ignoring locator hints.
+
+        Files with equal digests compare equal.  With `signed`, the digest
+        covers the whole locators, including permission signatures.
+        Return None if the file refers to buffer blocks, whose contents
+        may still change.  The digests are kept until the file is
+        modified.
+
+        """
+        if self._digest is None:
+            self._digest = {}
+        digest = self._digest.get(signed)
+        if digest is None:
+            h = hashlib.sha256()
+            stripped = {}
+            for seg in self._segments:
+                loc = stripped.get(seg.locator)
+                if loc is None:
+                    if self.parent._my_block_manager().is_bufferblock(seg.locator):
+                        return None
+                    loc = seg.locator if signed else KeepLocator(seg.locator).stripped()
+                    stripped[seg.locator] = loc
+                h.update(("%s %d %d %d\n" % (loc, seg.range_start, seg.range_size,
+                                             seg.segment_offset)).encode())
+            digest = self._digest[signed] = h.digest()
+        return digest
+
+    @synchronized
+    def _update_tokens(self, other):
+        """Use the locators of `other`, a file with the same contents.
+
+        This refreshes permission signatures without marking the file as
+        modified.  Nothing changes if the signatures already match.
+        Return True if any locator changed.
+
+        """
+        digest = self._content_digest(signed=True)
+        if digest is not None and digest == other._content_digest(signed=True):
+            return False
+        mapping = {}
+        for seg, other_seg in zip(self._segments, other.segments()):
+            if seg.locator != other_seg.locator:
+                mapping[seg.locator] = other_seg.locator
+        if not mapping:
+            return False
+        with self._segment_lock():
+            self._segments.replace_locators(mapping)
+        self._digest = None
+        self.parent._forget_stream_text()
+        return True
+
     @synchronized
     def set_segments(self, segs):
-        self._segments = segs
+        self._segments = SegmentList(segs)
+        self._digest = None
 
     @synchronized
     def set_committed(self, value=True):
@@ -1008,6 +1375,12 @@ class ArvadosFile(object):
 
         If value is False, set committed to be False for this and all parents.
         """
+        if value is False:
+            self._digest = None
+            if self.parent is not None:
+                # The parent caches the manifest text of its files, so it
+                # needs to hear about every change, not just the first.
+                self.parent._forget_stream_text()
         if value == self._committed:
             return
         self._committed = value
@@ -1072,51 +1445,90 @@ class ArvadosFile(object):
                 else:
                     new_segs.append(r)
 
-            self._segments = new_segs
+            self._segments = SegmentList(new_segs)
             self.set_committed(False)
         elif size > self.size():
             padding = self.parent._my_block_manager().get_padding_block()
-            diff = size - self.size()
-            while diff > config.KEEP_BLOCK_SIZE:
-                self._segments.append(Range(padding.blockid, self.size(), config.KEEP_BLOCK_SIZE, 0))
-                diff -= config.KEEP_BLOCK_SIZE
-            if diff > 0:
-                self._segments.append(Range(padding.blockid, self.size(), diff, 0))
+            with self._segment_lock():
+                diff = size - self._segments.size()
+                while diff > config.KEEP_BLOCK_SIZE:
+                    self._segments.append(Range(padding.blockid, self._segments.size(), config.KEEP_BLOCK_SIZE, 0))
+                    diff -= config.KEEP_BLOCK_SIZE
+                if diff > 0:
+                    self._segments.append(Range(padding.blockid, self._segments.size(), diff, 0))
             self.set_committed(False)
         else:
             # size == self.size()
             pass
 
-    def readfrom(self, offset, size, num_retries, exact=False):
+    def _readahead_for(self, reader):
+        # Return the readahead state of `reader`, called with the segment
+        # lock held.  Readers are tracked separately, so that concurrent
+        # sequential readers don't reset each other's window, and each
+        # one's state goes away with it.
+        if reader is None:
+            if self._readahead is None:
+                self._readahead = _Readahead()
+            return self._readahead
+        if self._reader_readahead is None:
+            self._reader_readahead = weakref.WeakKeyDictionary()
+        readahead = self._reader_readahead.get(reader)
+        if readahead is None:
+            readahead = self._reader_readahead[reader] = _Readahead()
+        return readahead
+
+    def readfrom(self, offset, size, num_retries, exact=False, reader=None):
         """Read up to `size` bytes from the file starting at `offset`.
 
         :exact:
          If False (default), return less data than requested if the read
          crosses a block boundary and the next block isn't cached.  If True,
          only return less data than requested when hitting EOF.
+
+        :reader:
+         The object doing the read, such as a file handle, used to
+         follow its access pattern for readahead.  It must support weak
+         references.  Reads without a reader share the readahead state
+         of the file.
         """
 
-        with self.lock:
-            if size == 0 or offset >= self.size():
+        blockmanager = self.parent._my_block_manager()
+        with self._segment_lock():
+            if size == 0 or offset >= self._segments.size():
                 return b''
             readsegs = locators_and_ranges(self._segments, offset, size)
-            prefetch = locators_and_ranges(self._segments, offset + size, config.KEEP_BLOCK_SIZE, limit=32)
+            readahead = self._readahead_for(reader)
+            window = readahead.advance(offset, size, blockmanager.readahead_bytes)
+            if window:
+                prefetch = locators_and_ranges(self._segments, offset + size, window, limit=32)
+            else:
+                prefetch = []
 
         locs = set()
         data = []
         for lr in readsegs:
-            block = self.parent._my_block_manager().get_block_contents(lr.locator, num_retries=num_retries, cache_only=(bool(data) and not exact))
+            block = blockmanager.get_block_contents(lr.locator, num_retries=num_retries, cache_only=(bool(data) and not exact))
             if block:
+                # Slice without copying: join() below makes the only copy.
                 blockview = memoryview(block)
-                data.append(blockview[lr.segment_offset:lr.segment_offset+lr.segment_size].tobytes())
+                data.append(blockview[lr.segment_offset:lr.segment_offset+lr.segment_size])
                 locs.add(lr.locator)
             else:
                 break
 
-        for lr in prefetch:
-            if lr.locator not in locs:
-                self.parent._my_block_manager().block_prefetch(lr.locator)
-                locs.add(lr.locator)
+        with self._segment_lock():
+            start, stale = readahead.request(
+                [lr.locator for lr in prefetch if lr.locator not in locs])
+        # Each reader holds its own block_prefetch() requests, so a
+        # block is only dropped once no reader wants it.
+        for loc in stale:
+            blockmanager.cancel_prefetch(loc)
+        # Blocks that are already cached or being downloaded aren't
+        # queued, and mustn't be cancelled later.
+        queued = [loc for loc in start if blockmanager.block_prefetch(loc)]
+        if queued:
+            with self._segment_lock():
+                readahead.queued(queued)
 
         return b''.join(data)
 
@@ -1159,7 +1571,8 @@ class ArvadosFile(object):
 
         self._current_bblock.append(data)
 
-        replace_range(self._segments, offset, len(data), self._current_bblock.blockid, self._current_bblock.write_pointer - len(data))
+        with self._segment_lock():
+            replace_range(self._segments, offset, len(data), self._current_bblock.blockid, self._current_bblock.write_pointer - len(data))
 
         self.parent.notify(WRITE, self.parent, self.name, (self, self))
 
@@ -1184,15 +1597,16 @@ class ArvadosFile(object):
                 self.parent._my_block_manager().commit_bufferblock(self._current_bblock, sync=sync)
 
         if sync:
-            to_delete = set()
-            for s in self._segments:
-                bb = self.parent._my_block_manager().get_bufferblock(s.locator)
+            committed = {}
+            for loc in self._segments.locators():
+                bb = self.parent._my_block_manager().get_bufferblock(loc)
                 if bb:
                     if bb.state() != _BufferBlock.COMMITTED:
                         self.parent._my_block_manager().commit_bufferblock(bb, sync=True)
-                    to_delete.add(s.locator)
-                    s.locator = bb.locator()
-            for s in to_delete:
+                    committed[loc] = bb.locator()
+            with self._segment_lock():
+                self._segments.replace_locators(committed)
+            for s in committed:
                 # Don't delete the bufferblock if it's owned by many files. It'll be
                 # deleted after all of its owners are flush()ed.
                 if self.parent._my_block_manager().get_bufferblock(s).owner is self:
@@ -1214,19 +1628,45 @@ class ArvadosFile(object):
     def _add_segment(self, blocks, pos, size):
         """Internal implementation of add_segment."""
         self.set_committed(False)
-        for lr in locators_and_ranges(blocks, pos, size):
-            last = self._segments[-1] if self._segments else Range(0, 0, 0, 0)
-            r = Range(lr.locator, last.range_start+last.range_size, lr.segment_size, lr.segment_offset)
-            self._segments.append(r)
+        with self._segment_lock():
+            for lr in locators_and_ranges(blocks, pos, size):
+                self._segments.append_segment(lr.locator, self._segments.size(), lr.segment_size, lr.segment_offset)
+
+    def _add_stream_segments(self, blocks, block_starts, segments):
+        """Append segments of a manifest stream to the end of the file.
+
+        :blocks:
+          the stream's blocks, a list of Range objects
+
+        :block_starts:
+          the `range_start` of each block, used to find the block where a
+          segment starts by bisection
+
+        :segments:
+          list of (position, size) pairs in the stream
+
+        This is only used while loading a manifest, before anything else can
+        see the file, so it doesn't take the segment lock.
+
+        """
+        filepos = self._segments.size()
+        for pos, size in segments:
+            end = pos + size
+            i = bisect.bisect_right(block_starts, pos) - 1
+            while pos < end and 0 <= i < len(blocks):
+                blk = blocks[i]
+                blockpos = pos - blk.range_start
+                n = min(blk.range_size - blockpos, end - pos)
+                if n > 0:
+                    self._segments.append_segment(blk.locator, filepos, n, blockpos)
+                    filepos += n
+                    pos += n
+                i += 1
 
-    @synchronized
     def size(self):
         """Get the file size."""
-        if self._segments:
-            n = self._segments[-1]
-            return n.range_start + n.range_size
-        else:
-            return 0
+        with self._segment_lock():
+            return self._segments.size()
 
     @synchronized
     def manifest_text(self, stream_name=".", portable_locators=False,
@@ -1291,14 +1731,14 @@ class ArvadosFileReader(ArvadosFileReaderBase):
         """
         if size is None:
             data = []
-            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries)
+            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, reader=self)
             while rd:
                 data.append(rd)
                 self._filepos += len(rd)
-                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries)
+                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, reader=self)
             return b''.join(data)
         else:
-            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True)
+            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True, reader=self)
             self._filepos += len(data)
             return data
 
@@ -1309,7 +1749,7 @@ class ArvadosFileReader(ArvadosFileReaderBase):
 
         This method does not change the file position.
         """
-        return self.arvadosfile.readfrom(offset, size, num_retries)
+        return self.arvadosfile.readfrom(offset, size, num_retries, reader=self)
 
     def flush(self):
         pass
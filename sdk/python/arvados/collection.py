@@ -8,6 +8,7 @@ from builtins import str
 from past.builtins import basestring
 from builtins import object
 import ciso8601
+import collections
 import datetime
 import errno
 import functools
@@ -540,6 +541,119 @@ class RichCollectionBase(CollectionBase):
         self._has_remote_blocks = False
         self._callback = None
         self._items = {}
+        # Rendered stream line for the files directly in this collection,
+        # keyed by (stream_name, strip).  Cleared by notify() and
+        # _forget_stream_text() whenever one of those files changes.
+        self._stream_text = None
+        # Cached results of _content_digest(), keyed by `signed`, cleared
+        # along with the digests of all parents when anything below this
+        # changes.
+        self._digest = None
+        # Set while the contents of a lazily loaded collection haven't
+        # been built yet, see Collection._index_manifest().
+        self._lazy_index = None
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set.  A directory of a
+        # lazily loaded collection has no _items until it's first used.
+        if name == '_items':
+            self._load_lazy_items()
+            return self.__dict__['_items']
+        raise AttributeError(name)
+
+    def _set_lazy_index(self, index):
+        del self._items
+        self._lazy_index = index
+
+    def _load_lazy_items(self):
+        # Build the files and subdirectories of this directory from its
+        # entry in the manifest index.  This doesn't take the collection
+        # lock, which the caller may or may not hold (CollectionReader
+        # doesn't have one); a separate lock makes sure each directory
+        # is only built once.
+        root = self.root_collection()
+        with root._lazy_lock:
+            if '_items' in self.__dict__:
+                return
+            if self._lazy_index is None:
+                raise AttributeError('_items')
+            lines, subdirs = self._lazy_index
+            items = {}
+            for name, index in listitems(subdirs):
+                item = Subcollection(self, name)
+                item._set_lazy_index(index)
+                item._committed = True
+                items[name] = item
+            text = root._lazy_text
+            for start, end in lines:
+                blocks, block_starts, files = root._parse_stream(text[start:end].split())
+                for name, segments in listitems(files):
+                    if name == '.':
+                        continue
+                    afile = items.get(name)
+                    if afile is None:
+                        afile = items[name] = ArvadosFile(self, name)
+                        afile._committed = True
+                    if not isinstance(afile, ArvadosFile):
+                        raise errors.SyntaxError("File %s conflicts with stream of the same name.", os.path.join(self.stream_name(), name))
+                    afile._add_stream_segments(blocks, block_starts, segments)
+            self._items = items
+            self._lazy_index = None
+
+    def _forget_stream_text(self):
+        self._stream_text = None
+        # A parent's digest covers this one, so if this one is cached,
+        # so is the parent's.
+        node = self
+        while node is not None and node._digest is not None:
+            node._digest = None
+            node = node.parent if isinstance(node, Subcollection) else None
+
+    @synchronized
+    def _content_digest(self, signed=False):
+        """Return a digest of the collection's contents.
+
+        The digest covers the names, types and content digests of all
+        items, so collections with equal digests compare equal.  With
+        `signed`, it also covers the permission signatures of the
+        locators.  Return None if any file refers to buffer blocks.
+
+        """
+        if self._digest is None:
+            self._digest = {}
+        digest = self._digest.get(signed)
+        if digest is None:
+            h = hashlib.sha256()
+            for name in sorted(self._items):
+                item = self._items[name]
+                item_digest = item._content_digest(signed)
+                if item_digest is None:
+                    return None
+                if not isinstance(name, bytes):
+                    name = name.encode('utf-8')
+                h.update(b"%d:%s%s" % (len(name), name,
+                                       b"/" if isinstance(item, RichCollectionBase) else b" "))
+                h.update(item_digest)
+            digest = self._digest[signed] = h.digest()
+        return digest
+
+    @synchronized
+    def _update_tokens(self, other):
+        """Use the locators of `other`, a collection with the same contents.
+
+        Subtrees whose signatures already match are skipped without
+        looking at their files.  Nothing is marked as modified.  Return
+        True if any locator changed.
+
+        """
+        digest = self._content_digest(signed=True)
+        if digest is not None and digest == other._content_digest(signed=True):
+            return False
+        changed = False
+        for name, item in listitems(self._items):
+            if item._update_tokens(other[name]):
+                changed = True
+        return changed
 
     def _my_api(self):
         raise NotImplementedError()
@@ -744,8 +858,11 @@ class RichCollectionBase(CollectionBase):
         if value == self._committed:
             return
         if value:
-            for k,v in listitems(self._items):
-                v.set_committed(True)
+            # The contents of a directory that hasn't been loaded yet
+            # are committed already.
+            if self._lazy_index is None:
+                for k,v in listitems(self._items):
+                    v.set_committed(True)
             self._committed = True
         else:
             self._committed = False
@@ -1038,26 +1155,40 @@ class RichCollectionBase(CollectionBase):
         """
 
         if not self.committed() or self._manifest_text is None or normalize:
-            stream = {}
             buf = []
             sorted_keys = sorted(self.keys())
-            for filename in [s for s in sorted_keys if isinstance(self[s], ArvadosFile)]:
-                # Create a stream per file `k`
-                arvfile = self[filename]
-                filestream = []
-                for segment in arvfile.segments():
-                    loc = segment.locator
-                    if arvfile.parent._my_block_manager().is_bufferblock(loc):
-                        if only_committed:
-                            continue
-                        loc = arvfile.parent._my_block_manager().get_bufferblock(loc).locator()
-                    if strip:
-                        loc = KeepLocator(loc).stripped()
-                    filestream.append(LocatorAndRange(loc, KeepLocator(loc).size,
-                                         segment.segment_offset, segment.range_size))
-                stream[filename] = filestream
-            if stream:
-                buf.append(" ".join(normalize_stream(stream_name, stream)) + "\n")
+            cache_key = (stream_name, strip)
+            if self._stream_text is not None and cache_key in self._stream_text:
+                buf.append(self._stream_text[cache_key])
+            else:
+                stream = {}
+                # Lines that refer to buffer blocks depend on their
+                # state, so they can't be reused.
+                cacheable = True
+                for filename in [s for s in sorted_keys if isinstance(self[s], ArvadosFile)]:
+                    # Create a stream per file `k`
+                    arvfile = self[filename]
+                    filestream = []
+                    for segment in arvfile.segments():
+                        loc = segment.locator
+                        if arvfile.parent._my_block_manager().is_bufferblock(loc):
+                            cacheable = False
+                            if only_committed:
+                                continue
+                            loc = arvfile.parent._my_block_manager().get_bufferblock(loc).locator()
+                        if strip:
+                            loc = KeepLocator(loc).stripped()
+                        filestream.append(LocatorAndRange(loc, KeepLocator(loc).size,
+                                             segment.segment_offset, segment.range_size))
+                    stream[filename] = filestream
+                text = ""
+                if stream:
+                    text = " ".join(normalize_stream(stream_name, stream)) + "\n"
+                if cacheable:
+                    if self._stream_text is None:
+                        self._stream_text = {}
+                    self._stream_text[cache_key] = text
+                buf.append(text)
             for dirname in [s for s in sorted_keys if isinstance(self[s], RichCollectionBase)]:
                 buf.append(self[dirname].manifest_text(
                     stream_name=os.path.join(stream_name, dirname),
@@ -1070,6 +1201,16 @@ class RichCollectionBase(CollectionBase):
                 return self._manifest_text
 
     @synchronized
+    def _find_remote_blocks(self, found):
+        """Append (file, remote locators) for each file below this one that uses remote blocks."""
+        for item in listvalues(self._items):
+            if isinstance(item, ArvadosFile):
+                locators = item._remote_locators()
+                if locators:
+                    found.append((item, locators))
+            else:
+                item._find_remote_blocks(found)
+
     def _copy_remote_blocks(self, remote_blocks={}):
         """Scan through the entire collection and ask Keep to copy remote blocks.
 
@@ -1077,14 +1218,39 @@ class RichCollectionBase(CollectionBase):
         (+R instead of +A). Collect these signatures and request Keep to copy the
         blocks to the local cluster, returning local (+A) signatures.
 
+        Each block is copied once, by a pool of threads.  The collection lock
+        is only held while looking for remote blocks and while updating the
+        files, not while waiting for Keep.
+
         :remote_blocks:
           Shared cache of remote to local block mappings. This is used to avoid
           doing extra work when blocks are shared by more than one file in
           different subdirectories.
 
         """
-        for item in self:
-            remote_blocks = self[item]._copy_remote_blocks(remote_blocks)
+        found = []
+        with self.lock:
+            self._find_remote_blocks(found)
+        todo = set()
+        for _, locators in found:
+            todo.update(locators)
+        todo.difference_update(remote_blocks)
+        if todo:
+            _logger.info("Copying %d remote blocks to the local cluster", len(todo))
+            last_report = time.time()
+            copied = 0
+            for remote_loc, loc in self._my_keep().refresh_signatures(
+                    todo, num_retries=self.num_retries):
+                remote_blocks[remote_loc] = loc
+                copied += 1
+                if time.time() - last_report >= 10:
+                    _logger.info("Copied %d of %d remote blocks", copied, len(todo))
+                    last_report = time.time()
+        with self.lock:
+            # Files that got new remote blocks in the meantime copy
+            # those one at a time.
+            for item, _ in found:
+                remote_blocks = item._copy_remote_blocks(remote_blocks)
         return remote_blocks
 
     @synchronized
@@ -1103,7 +1269,19 @@ class RichCollectionBase(CollectionBase):
         for k in end_collection:
             if k in self:
                 if isinstance(end_collection[k], Subcollection) and isinstance(self[k], Subcollection):
-                    changes.extend(self[k].diff(end_collection[k], os.path.join(prefix, k), holding_collection))
+                    if end_collection[k] == self[k]:
+                        # One change updates the tokens of the whole
+                        # subtree, see apply().  Both sides are the same,
+                        # so one copy serves as "initial" and "final"; a
+                        # read-only collection can't change, so its items
+                        # don't need copying at all.
+                        if end_collection.writable():
+                            item = end_collection[k].clone(holding_collection, "")
+                        else:
+                            item = end_collection[k]
+                        changes.append((TOK, os.path.join(prefix, k), item, item))
+                    else:
+                        changes.extend(self[k].diff(end_collection[k], os.path.join(prefix, k), holding_collection))
                 elif end_collection[k] != self[k]:
                     changes.append((MOD, os.path.join(prefix, k), self[k].clone(holding_collection, ""), end_collection[k].clone(holding_collection, "")))
                 else:
@@ -1121,13 +1299,27 @@ class RichCollectionBase(CollectionBase):
         alternate path indicating the conflict.
 
         """
-        if changes:
+        # Token updates don't change the contents, see _update_tokens().
+        if any(change[0] != TOK for change in changes):
             self.set_committed(False)
+        tokens_updated = False
         for change in changes:
             event_type = change[0]
             path = change[1]
             initial = change[2]
             local = self.find(path)
+            if event_type == TOK and local is not None and local == initial:
+                if local._update_tokens(change[3]):
+                    tokens_updated = True
+                continue
+            if event_type == TOK and isinstance(initial, RichCollectionBase):
+                # diff() sends a single change for a subcollection that is
+                # the same on both sides.  It was modified locally, so
+                # handle its items one by one.
+                final = change[3]
+                self.apply([(TOK, os.path.join(path, k), initial[k], final[k])
+                            for k in initial])
+                continue
             conflictpath = "%s~%s~conflict~" % (path, time.strftime("%Y%m%d-%H%M%S",
                                                                     time.gmtime()))
             if event_type == ADD:
@@ -1160,6 +1352,8 @@ class RichCollectionBase(CollectionBase):
                     self.remove(path, recursive=True)
                 # else, the file is modified or already removed, in either
                 # case we don't want to try to remove it.
+        if tokens_updated:
+            self.root_collection()._refresh_manifest_text()
 
     def portable_data_hash(self):
         """Get the portable data hash for this collection's manifest."""
@@ -1185,6 +1379,7 @@ class RichCollectionBase(CollectionBase):
 
     @synchronized
     def notify(self, event, collection, name, item):
+        self._forget_stream_text()
         if self._callback:
             self._callback(event, collection, name, item)
         self.root_collection().notify(event, collection, name, item)
@@ -1195,6 +1390,11 @@ class RichCollectionBase(CollectionBase):
             return True
         if not isinstance(other, RichCollectionBase):
             return False
+        digest = self._content_digest()
+        if digest is not None:
+            other_digest = other._content_digest()
+            if other_digest is not None:
+                return digest == other_digest
         if len(self._items) != len(other):
             return False
         for k in self._items:
@@ -1261,7 +1461,9 @@ class Collection(RichCollectionBase):
                  apiconfig=None,
                  block_manager=None,
                  replication_desired=None,
-                 put_threads=None):
+                 put_threads=None,
+                 max_buffer_bytes=None,
+                 lazy=False):
         """Collection constructor.
 
         :manifest_locator_or_text:
@@ -1293,6 +1495,17 @@ class Collection(RichCollectionBase):
           configuration applies. If not None, this value will also be used
           for determining the number of block copies being written.
 
+        :max_buffer_bytes:
+          The maximum amount of written data waiting to be uploaded.  If
+          None, the block manager's default of 4 full blocks applies.
+
+        :lazy:
+          If True, only index the manifest by directory when loading it,
+          and build the files and subdirectories of each directory the
+          first time it is used.  Errors in the manifest text are then
+          reported when the directory that contains them is used, rather
+          than by the constructor.
+
         """
         super(Collection, self).__init__(parent)
         self._api_client = api_client
@@ -1300,6 +1513,10 @@ class Collection(RichCollectionBase):
         self._block_manager = block_manager
         self.replication_desired = replication_desired
         self.put_threads = put_threads
+        self.max_buffer_bytes = max_buffer_bytes
+        self._lazy = lazy
+        self._lazy_lock = threading.Lock()
+        self._lazy_text = None
 
         if apiconfig:
             self._config = apiconfig
@@ -1387,6 +1604,14 @@ class Collection(RichCollectionBase):
         self.apply(baseline.diff(other))
         self._manifest_text = self.manifest_text()
 
+    @synchronized
+    def _refresh_manifest_text(self):
+        # A committed collection returns the manifest text it was
+        # loaded or saved with, which must show the signatures that
+        # apply() updated without marking anything as modified.
+        if self.committed() and self._manifest_text is not None:
+            self._manifest_text = self._get_manifest_text(".", strip=False, normalize=True)
+
     @synchronized
     def _my_api(self):
         if self._api_client is None:
@@ -1404,13 +1629,17 @@ class Collection(RichCollectionBase):
                 self._keep_client = KeepClient(api_client=self._api_client)
         return self._keep_client
 
-    @synchronized
     def _my_block_manager(self):
+        # Readers call this on every read, so only take the lock to
+        # create the block manager.
         if self._block_manager is None:
-            copies = (self.replication_desired or
-                      self._my_api()._rootDesc.get('defaultCollectionReplication',
-                                                   2))
-            self._block_manager = _BlockManager(self._my_keep(), copies=copies, put_threads=self.put_threads, num_retries=self.num_retries)
+            with self.lock:
+                if self._block_manager is None:
+                    copies = (self.replication_desired or
+                              self._my_api()._rootDesc.get('defaultCollectionReplication',
+                                                           2))
+                    self._block_manager = _BlockManager(self._my_keep(), copies=copies, put_threads=self.put_threads, num_retries=self.num_retries,
+                                                        max_buffer_bytes=self.max_buffer_bytes)
         return self._block_manager
 
     def _remember_api_response(self, response):
@@ -1523,7 +1752,6 @@ class Collection(RichCollectionBase):
             return super(Collection, self).remove(path[2:] if path.startswith("./") else path, recursive)
 
     @must_be_writable
-    @synchronized
     @retry_method
     def save(self,
              properties=None,
@@ -1561,6 +1789,14 @@ class Collection(RichCollectionBase):
           Retry count on API calls (if None,  use the collection default)
 
         """
+        if self._has_remote_blocks and not self.committed():
+            # Copy remote blocks to the local cluster before taking the
+            # collection lock, so it isn't held while waiting for Keep.
+            self._copy_remote_blocks(remote_blocks={})
+        return self._save(properties, storage_classes, trash_at, merge, num_retries)
+
+    @synchronized
+    def _save(self, properties, storage_classes, trash_at, merge, num_retries):
         if properties and type(properties) is not dict:
             raise errors.ArgumentError("properties must be dictionary type.")
 
@@ -1614,7 +1850,6 @@ class Collection(RichCollectionBase):
 
 
     @must_be_writable
-    @synchronized
     @retry_method
     def save_new(self, name=None,
                  create_collection_record=True,
@@ -1663,6 +1898,16 @@ class Collection(RichCollectionBase):
           Retry count on API calls (if None,  use the collection default)
 
         """
+        if self._has_remote_blocks:
+            # Copy remote blocks to the local cluster before taking the
+            # collection lock, so it isn't held while waiting for Keep.
+            self._copy_remote_blocks(remote_blocks={})
+        return self._save_new(name, create_collection_record, owner_uuid, properties,
+                              storage_classes, trash_at, ensure_unique_name, num_retries)
+
+    @synchronized
+    def _save_new(self, name, create_collection_record, owner_uuid, properties,
+                  storage_classes, trash_at, ensure_unique_name, num_retries):
         if properties and type(properties) is not dict:
             raise errors.ArgumentError("properties must be dictionary type.")
 
@@ -1709,13 +1954,116 @@ class Collection(RichCollectionBase):
 
         return text
 
-    _token_re = re.compile(r'(\S+)(\s+|$)')
     _block_re = re.compile(r'[0-9a-f]{32}\+(\d+)(\+\S+)*')
-    _segment_re = re.compile(r'(\d+):(\d+):(\S+)')
 
     def _unescape_manifest_path(self, path):
+        if '\\' not in path:
+            return path
         return re.sub('\\\\([0-3][0-7][0-7])', lambda m: chr(int(m.group(1), 8)), path)
 
+    @staticmethod
+    def _manifest_lines(manifest_text):
+        # Like manifest_text.split("\n"), but without making a copy of
+        # the whole manifest at once.
+        pos = 0
+        while pos < len(manifest_text):
+            eol = manifest_text.find("\n", pos)
+            if eol < 0:
+                eol = len(manifest_text)
+            yield manifest_text[pos:eol]
+            pos = eol + 1
+
+    def _index_manifest(self, manifest_text):
+        """Index the stream lines of a manifest by directory.
+
+        Return a (lines, subdirectories) pair for the top directory, where
+        lines lists the (start, end) offsets of the directory's stream
+        lines in manifest_text, and subdirectories maps each name to
+        another such pair.  Return None if the manifest has to be
+        imported in full: that is the case when file names refer to
+        subdirectories, or a stream name isn't a plain path.
+
+        """
+        top = ([], {})
+        streams = {}
+        end_of_text = len(manifest_text)
+        pos = 0
+        while pos < end_of_text:
+            eol = manifest_text.find("\n", pos)
+            if eol < 0:
+                eol = end_of_text
+            if eol == pos:
+                pos += 1
+                continue
+            sep = manifest_text.find(" ", pos, eol)
+            if sep <= pos:
+                return None
+            if (manifest_text.find("/", sep, eol) >= 0 or
+                manifest_text.find("\\057", sep, eol) >= 0):
+                return None
+            raw_name = manifest_text[pos:sep]
+            node = streams.get(raw_name)
+            if node is None:
+                if raw_name.split() != [raw_name]:
+                    return None
+                stream_name = self._unescape_manifest_path(raw_name)
+                node = top
+                if stream_name != ".":
+                    if stream_name.startswith("./"):
+                        stream_name = stream_name[2:]
+                    for name in stream_name.split("/"):
+                        if name in ("", ".", ".."):
+                            return None
+                        child = node[1].get(name)
+                        if child is None:
+                            child = node[1][name] = ([], {})
+                        node = child
+                streams[raw_name] = node
+            node[0].append((pos, eol))
+            pos = eol + 1
+        return top
+
+    def _parse_stream(self, tokens):
+        """Parse the tokens of a manifest stream line.
+
+        Return the stream's blocks (a list of Range objects), the start of
+        each block, and an ordered dict mapping each file name to its
+        list of (position, size) segments.  The stream name, tokens[0],
+        is ignored.
+
+        """
+        block_match = self._block_re.match
+        blocks = []
+        block_starts = []
+        streamoffset = 0
+        i = 1
+        while i < len(tokens):
+            block_locator = block_match(tokens[i])
+            if not block_locator:
+                break
+            blocksize = int(block_locator.group(1))
+            blocks.append(Range(tokens[i], streamoffset, blocksize, 0))
+            block_starts.append(streamoffset)
+            streamoffset += blocksize
+            i += 1
+
+        files = collections.OrderedDict()
+        for tok in tokens[i:]:
+            try:
+                pos, size, name = tok.split(':', 2)
+                if not name:
+                    raise ValueError(tok)
+                pos = int(pos)
+                size = int(size)
+            except ValueError:
+                raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
+            name = self._unescape_manifest_path(name)
+            segments = files.get(name)
+            if segments is None:
+                segments = files[name] = []
+            segments.append((pos, size))
+        return blocks, block_starts, files
+
     @synchronized
     def _import_manifest(self, manifest_text):
         """Import a manifest into a `Collection`.
@@ -1727,65 +2075,55 @@ class Collection(RichCollectionBase):
         if len(self) > 0:
             raise ArgumentError("Can only import manifest into an empty collection")
 
-        STREAM_NAME = 0
-        BLOCKS = 1
-        SEGMENTS = 2
-
-        stream_name = None
-        state = STREAM_NAME
-
-        for token_and_separator in self._token_re.finditer(manifest_text):
-            tok = token_and_separator.group(1)
-            sep = token_and_separator.group(2)
-
-            if state == STREAM_NAME:
-                # starting a new stream
-                stream_name = self._unescape_manifest_path(tok)
-                blocks = []
-                segments = []
-                streamoffset = 0
-                state = BLOCKS
-                self.find_or_create(stream_name, COLLECTION)
+        if self._lazy:
+            index = self._index_manifest(manifest_text)
+            if index is not None:
+                self._lazy_text = manifest_text
+                self._set_lazy_index(index)
+                self.set_committed(True)
+                return
+
+        for line in self._manifest_lines(manifest_text):
+            tokens = line.split()
+            if not tokens:
                 continue
 
-            if state == BLOCKS:
-                block_locator = self._block_re.match(tok)
-                if block_locator:
-                    blocksize = int(block_locator.group(1))
-                    blocks.append(Range(tok, streamoffset, blocksize, 0))
-                    streamoffset += blocksize
+            # The stream's directory is looked up once, file names are
+            # resolved relative to it.
+            stream_name = self._unescape_manifest_path(tokens[0])
+            stream = self.find_or_create(stream_name, COLLECTION)
+            if not isinstance(stream, RichCollectionBase):
+                raise IOError(errno.ENOTDIR, "Not a directory", stream_name)
+
+            # Collect the segments of each file in the stream, then add
+            # them to each file in one go.
+            blocks, block_starts, files = self._parse_stream(tokens)
+            for name, segments in listitems(files):
+                if name.split('/')[-1] == '.':
+                    # placeholder for persisting an empty directory, not a real file
+                    if len(name) > 2:
+                        stream.find_or_create(name[:-2], COLLECTION)
+                    continue
+                if '/' in name or self._callback:
+                    afile = stream.find_or_create(name, FILE)
                 else:
-                    state = SEGMENTS
-
-            if state == SEGMENTS:
-                file_segment = self._segment_re.match(tok)
-                if file_segment:
-                    pos = int(file_segment.group(1))
-                    size = int(file_segment.group(2))
-                    name = self._unescape_manifest_path(file_segment.group(3))
-                    if name.split('/')[-1] == '.':
-                        # placeholder for persisting an empty directory, not a real file
-                        if len(name) > 2:
-                            self.find_or_create(os.path.join(stream_name, name[:-2]), COLLECTION)
-                    else:
-                        filepath = os.path.join(stream_name, name)
-                        afile = self.find_or_create(filepath, FILE)
-                        if isinstance(afile, ArvadosFile):
-                            afile.add_segment(blocks, pos, size)
-                        else:
-                            raise errors.SyntaxError("File %s conflicts with stream of the same name.", filepath)
+                    # Nobody is listening for ADD events, and the stream
+                    # directory is already resolved and writable: add the
+                    # file directly.
+                    afile = stream._items.get(name)
+                    if afile is None:
+                        afile = stream._items[name] = ArvadosFile(stream, name)
+                if isinstance(afile, ArvadosFile):
+                    afile._add_stream_segments(blocks, block_starts, segments)
                 else:
-                    # error!
-                    raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
-
-            if sep == "\n":
-                stream_name = None
-                state = STREAM_NAME
+                    raise errors.SyntaxError("File %s conflicts with stream of the same name.", os.path.join(stream_name, name))
 
         self.set_committed(True)
 
     @synchronized
     def notify(self, event, collection, name, item):
+        if collection is self:
+            self._forget_stream_text()
         if self._callback:
             self._callback(event, collection, name, item)
 
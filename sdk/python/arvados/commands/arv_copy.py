@@ -25,6 +25,7 @@ standard_library.install_aliases()
 from past.builtins import basestring
 from builtins import object
 import argparse
+import collections
 import contextlib
 import getpass
 import os
@@ -530,8 +531,6 @@ def copy_collection(obj_uuid, src, dst, args):
     logger.debug("Copying collection %s with manifest: <%s>", obj_uuid, manifest)
 
     # Copy each block from src_keep to dst_keep.
-    # Use the newly signed locators returned from dst_keep to build
-    # a new manifest as we go.
     src_keep = arvados.keep.KeepClient(api_client=src, num_retries=args.retries)
     dst_keep = arvados.keep.KeepClient(api_client=dst, num_retries=args.retries)
     dst_manifest = io.StringIO()
@@ -543,6 +542,29 @@ def copy_collection(obj_uuid, src, dst, args):
     else:
         progress_writer = None
 
+    # Find each distinct block in the manifest, then fetch them
+    # concurrently (in manifest order) and copy each one as it arrives.
+    src_blocks = collections.OrderedDict()
+    for line in manifest.splitlines():
+        for word in line.split()[1:]:
+            try:
+                loc = arvados.KeepLocator(word)
+            except ValueError:
+                continue
+            if loc.md5sum not in src_blocks:
+                src_blocks[loc.md5sum] = (word, loc.size)
+
+    for (blockhash, (word, size)), data in zip(
+            src_blocks.items(),
+            src_keep.get_many(word for word, _ in src_blocks.values())):
+        logger.debug("Copying block %s (%s bytes)", blockhash, size)
+        if progress_writer:
+            progress_writer.report(obj_uuid, bytes_written, bytes_expected)
+        dst_locators[blockhash] = dst_keep.put(data)
+        bytes_written += size
+
+    # Use the newly signed locators returned from dst_keep to build
+    # the new manifest.
     for line in manifest.splitlines():
         words = line.split()
         dst_manifest.write(words[0])
@@ -555,19 +577,8 @@ def copy_collection(obj_uuid, src, dst, args):
                 dst_manifest.write(' ')
                 dst_manifest.write(word)
                 continue
-            blockhash = loc.md5sum
-            # copy this block if we haven't seen it before
-            # (otherwise, just reuse the existing dst_locator)
-            if blockhash not in dst_locators:
-                logger.debug("Copying block %s (%s bytes)", blockhash, loc.size)
-                if progress_writer:
-                    progress_writer.report(obj_uuid, bytes_written, bytes_expected)
-                data = src_keep.get(word)
-                dst_locator = dst_keep.put(data)
-                dst_locators[blockhash] = dst_locator
-                bytes_written += loc.size
             dst_manifest.write(' ')
-            dst_manifest.write(dst_locators[blockhash])
+            dst_manifest.write(dst_locators[loc.md5sum])
         dst_manifest.write("\n")
 
     if progress_writer:
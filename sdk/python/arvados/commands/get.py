@@ -97,12 +97,20 @@ group.add_argument('--strip-manifest', action='store_true', default=False,
 When getting a collection manifest, strip its access tokens before writing
 it.
 """)
+parser.add_argument('--threads', type=int, metavar='N', default=1,
+                    help="""
+Fetch up to N blocks from Keep at once, reading ahead across all the
+files being downloaded. Files are still written one after the other.
+Default: 1 (read one file at a time).
+""")
 
 def parse_arguments(arguments, stdout, stderr):
     args = parser.parse_args(arguments)
 
     if args.locator[-1] == os.sep:
         args.r = True
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
     if (args.r and
         not args.n and
         not (args.destination and
@@ -225,6 +233,12 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr):
                     os.path.exists(dest_path)):
                     logger.error('Local file %s already exists.' % (dest_path,))
                     return 1
+                if (args.skip_existing and not args.n and
+                    os.path.exists(dest_path)):
+                    # Leave it out now, so it doesn't count towards
+                    # the progress total or get fetched ahead.
+                    logger.debug('Local file %s exists. Skipping.', dest_path)
+                    continue
                 todo += [(s, f, dest_path)]
                 todo_bytes += f.size()
         elif isinstance(item, arvados.arvfile.ArvadosFile):
@@ -237,16 +251,32 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr):
         logger.error(e)
         return 1
 
+    if args.threads > 1:
+        file_contents = read_files_ahead(
+            reader._my_keep(), [f for _, f, _ in todo],
+            args.threads, args.retries)
+    else:
+        file_contents = None
+
     out_bytes = 0
     for s, f, outfilename in todo:
         outfile = None
         digestor = None
+        if file_contents is None:
+            content = read_file(s, f)
+        else:
+            content = next(file_contents)
         if not args.n:
             if outfilename == "-":
                 outfile = stdout
             else:
                 if args.skip_existing and os.path.exists(outfilename):
                     logger.debug('Local file %s exists. Skipping.', outfilename)
+                    if file_contents is not None:
+                        # Its blocks are in the read-ahead stream
+                        # already, so pass them by.
+                        for _ in content:
+                            pass
                     continue
                 elif not args.f and (os.path.isfile(outfilename) or
                                    os.path.isdir(outfilename)):
@@ -264,24 +294,23 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr):
         if args.hash:
             digestor = hashlib.new(args.hash)
         try:
-            with s.open(f.name, 'rb') as file_reader:
-                for data in file_reader.readall():
-                    if outfile:
-                        outfile.write(data)
-                    if digestor:
-                        digestor.update(data)
-                    out_bytes += len(data)
-                    if args.progress:
-                        stderr.write('\r%d MiB / %d MiB %.1f%%' %
-                                     (out_bytes >> 20,
-                                      todo_bytes >> 20,
-                                      (100
-                                       if todo_bytes==0
-                                       else 100.0*out_bytes/todo_bytes)))
-                    elif args.batch_progress:
-                        stderr.write('%s %d read %d total\n' %
-                                     (sys.argv[0], os.getpid(),
-                                      out_bytes, todo_bytes))
+            for data in content:
+                if outfile:
+                    outfile.write(data)
+                if digestor:
+                    digestor.update(data)
+                out_bytes += len(data)
+                if args.progress:
+                    stderr.write('\r%d MiB / %d MiB %.1f%%' %
+                                 (out_bytes >> 20,
+                                  todo_bytes >> 20,
+                                  (100
+                                   if todo_bytes==0
+                                   else 100.0*out_bytes/todo_bytes)))
+                elif args.batch_progress:
+                    stderr.write('%s %d read %d total\n' %
+                                 (sys.argv[0], os.getpid(),
+                                  out_bytes, todo_bytes))
             if digestor:
                 stderr.write("%s  %s/%s\n"
                              % (digestor.hexdigest(), s.stream_name(), f.name))
@@ -309,6 +338,49 @@ def files_in_collection(c):
             for s, f in files_in_collection(c[i]):
                 yield (s, f)
 
+def read_file(s, f):
+    with s.open(f.name, 'rb') as file_reader:
+        for data in file_reader.readall():
+            yield data
+
+def read_files_ahead(keep, files, max_workers, num_retries):
+    """Read several files from Keep, fetching their blocks concurrently.
+
+    Yield one iterator per file, in order, over the file's content.
+    Each iterator must be used up before the next one is taken.
+    The blocks of all the files are fetched ahead of the consumer by
+    up to max_workers threads, with at most max_workers blocks'
+    worth of data waiting to be consumed.  A block used by several
+    consecutive segments (e.g. many small files stored together) is
+    only fetched once.
+    """
+    segments = [f.segments() for f in files]
+
+    def locators():
+        last = None
+        for segs in segments:
+            for seg in segs:
+                if seg.locator != last:
+                    last = seg.locator
+                    yield last
+
+    blocks = keep.get_many(
+        locators(), max_workers=max_workers,
+        max_bytes=max_workers * arvados.config.KEEP_BLOCK_SIZE,
+        num_retries=num_retries)
+    # The locator and content of the block being consumed.
+    current = [None, None]
+
+    def content(segs):
+        for seg in segs:
+            if seg.locator != current[0]:
+                current[0] = seg.locator
+                current[1] = memoryview(next(blocks))
+            yield current[1][seg.segment_offset:seg.segment_offset+seg.range_size]
+
+    for segs in segments:
+        yield content(segs)
+
 def write_block_or_manifest(dest, src, api_client, args):
     if '+A' in src:
         # block locator
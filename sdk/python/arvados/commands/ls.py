@@ -54,7 +54,7 @@ def main(args, stdout, stderr, api_client=None, logger=None):
         get_prefix = r.group(2)
 
         cr = arvados.CollectionReader(collection, api_client=api_client,
-                                      num_retries=args.retries)
+                                      num_retries=args.retries, lazy=True)
         if get_prefix:
             if get_prefix[-1] == '/':
                 get_prefix = get_prefix[:-1]
@@ -11,19 +11,23 @@ import arvados
 import arvados.collection
 import base64
 import ciso8601
+import collections
 import copy
 import datetime
 import errno
 import fcntl
 import fnmatch
 import hashlib
+import itertools
 import json
 import logging
 import os
 import pwd
+import queue
 import re
 import signal
 import socket
+import stat
 import sys
 import tempfile
 import threading
@@ -149,11 +153,19 @@ upload_opts.add_argument('--threads', type=int, metavar='N', default=None,
                          help="""
 Set the number of upload threads to be used. Take into account that
 using lots of threads will increase the RAM requirements. Default is
-to use 2 threads.
+to start with 2 threads and adjust the number according to the observed
+upload throughput.
 On high latency installations, using a greater number will improve
 overall throughput.
 """)
 
+upload_opts.add_argument('--max-buffer', type=int, metavar='MiB', default=None,
+                         help="""
+Set the maximum amount of data, in MiB, read from the input files but
+not yet uploaded.  Upload threads are only added while this leaves a
+block for each of them to send.  Default 256 MiB (4 blocks).
+""")
+
 upload_opts.add_argument('--exclude', metavar='PATTERN', default=[],
                       action='append', help="""
 Exclude files and directories whose names match the given glob pattern. When
@@ -323,11 +335,39 @@ class FileUploadList(list):
     def __init__(self, dry_run=False):
         list.__init__(self)
         self.dry_run = dry_run
+        self._cond = threading.Condition()
+        self._closed = False
 
     def append(self, other):
         if self.dry_run:
             raise ArvPutUploadIsPending()
-        super(FileUploadList, self).append(other)
+        with self._cond:
+            super(FileUploadList, self).append(other)
+            self._cond.notify_all()
+
+    def ready(self, i):
+        """Return True if item i can be had (or is known not to exist) without waiting."""
+        with self._cond:
+            return i < len(self) or self._closed
+
+    def close(self):
+        """Mark the list complete: no more items will be appended."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def follow(self):
+        """Iterate over the list, waiting for new items until it is closed."""
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self) and not self._closed:
+                    self._cond.wait()
+                if i >= len(self):
+                    return
+                item = self[i]
+            i += 1
+            yield item
 
 
 # Appends the X-Request-Id to the log message when log level is ERROR or DEBUG
@@ -432,6 +472,14 @@ class ResumeCache(object):
 
 class ArvPutUploadJob(object):
     CACHE_DIR = '.cache/arvados/arv-put'
+    SCAN_THREADS = 8
+    # Files up to SMALL_FILE_SIZE are read ahead of the upload by
+    # READ_THREADS threads, up to READ_AHEAD_FILES files or
+    # READ_AHEAD_BYTES bytes at a time.
+    SMALL_FILE_SIZE = 1024 * 1024
+    READ_THREADS = 8
+    READ_AHEAD_FILES = 1024
+    READ_AHEAD_BYTES = 64 * 1024 * 1024
     EMPTY_STATE = {
         'manifest' : None, # Last saved manifest checkpoint
         'files' : {} # Previous run file list: {path : {size, mtime}}
@@ -444,7 +492,7 @@ class ArvPutUploadJob(object):
                  update_time=60.0, update_collection=None, storage_classes=None,
                  logger=logging.getLogger('arvados.arv_put'), dry_run=False,
                  follow_links=True, exclude_paths=[], exclude_names=None,
-                 trash_at=None):
+                 trash_at=None, max_buffer_bytes=None):
         self.paths = paths
         self.resume = resume
         self.use_cache = use_cache
@@ -452,7 +500,7 @@ class ArvPutUploadJob(object):
         self.reporter = reporter
         # This will set to 0 before start counting, if no special files are going
         # to be read.
-        self.bytes_expected = None
+        self._bytes_expected = None
         self.bytes_written = 0
         self.bytes_skipped = 0
         self.name = name
@@ -461,6 +509,7 @@ class ArvPutUploadJob(object):
         self.num_retries = num_retries
         self.replication_desired = replication_desired
         self.put_threads = put_threads
+        self.max_buffer_bytes = max_buffer_bytes
         self.filename = filename
         self.storage_classes = storage_classes
         self._api_client = api_client
@@ -468,6 +517,10 @@ class ArvPutUploadJob(object):
         self._state = None # Previous run state (file list & manifest)
         self._current_files = [] # Current run file list
         self._cache_file = None
+        self._snapshot_bytes = 0 # Size of the cache file's snapshot line
+        self._journal_bytes = 0 # Size of the records appended after it
+        self._journal_files = set() # Sources changed since last checkpoint
+        self._journal_paths = set() # Collection files changed since last checkpoint
         self._collection_lock = threading.Lock()
         self._remote_collection = None # Collection being updated (if asked)
         self._local_collection = None # Collection from previous run manifest
@@ -477,6 +530,11 @@ class ArvPutUploadJob(object):
         self._checkpointer.daemon = True
         self._update_task_time = update_time  # How many seconds wait between update runs
         self._files_to_upload = FileUploadList(dry_run=dry_run)
+        self._scanner = threading.Thread(target=self._scan_task)
+        self._scanner.daemon = True
+        self._scan_complete = threading.Event()
+        self._stop_scan = threading.Event()
+        self._scan_error = None
         self._upload_started = False
         self.logger = logger
         self.dry_run = dry_run
@@ -506,16 +564,30 @@ class ArvPutUploadJob(object):
         # bytes expected to be uploaded.
         self._build_upload_list()
 
+    @property
+    def bytes_expected(self):
+        # The total isn't known until the whole tree has been scanned.
+        self._scan_complete.wait()
+        return self._bytes_expected
+
+    @bytes_expected.setter
+    def bytes_expected(self, value):
+        self._scan_complete.wait()
+        self._bytes_expected = value
+
     def _build_upload_list(self):
         """
-        Scan the requested paths to count file sizes, excluding requested files
-        and dirs and building the upload file list.
+        Check the requested paths and start scanning them.
+
+        On a dry run, the scan is done before returning.  Otherwise it
+        continues in the background, appending to the upload file list
+        while the upload proceeds.
         """
         # If there aren't special files to be read, reset total bytes count to zero
         # to start counting.
         if not any([p for p in self.paths
                     if not (os.path.isfile(p) or os.path.isdir(p))]):
-            self.bytes_expected = 0
+            self._bytes_expected = 0
 
         for path in self.paths:
             # Test for stdin first, in case some file named '-' exist
@@ -525,6 +597,41 @@ class ArvPutUploadJob(object):
                 self._write_stdin(self.filename or 'stdin')
             elif not os.path.exists(path):
                  raise PathDoesNotExistError(u"file or directory '{}' does not exist.".format(path))
+
+        if self.dry_run:
+            self._scan_paths()
+            self._scan_complete.set()
+            # If dry-mode is on, and got up to this point, then we should notify that
+            # there aren't any file to upload.
+            raise ArvPutUploadNotPending()
+        self._scanner.start()
+
+    def _scan_task(self):
+        try:
+            self._scan_paths()
+            if self._stop_scan.is_set():
+                return
+            # Remove local_collection's files that don't exist locally anymore, so the
+            # bytes_written count is correct.
+            for f in self.collection_file_paths(self._local_collection,
+                                                path_prefix=""):
+                if f != 'stdin' and f != self.filename and not f in self._file_paths:
+                    self._local_collection.remove(f)
+                    self._journal_path(f)
+        except Exception as error:
+            self._scan_error = error
+        finally:
+            self._scan_complete.set()
+            self._files_to_upload.close()
+
+    def _scan_paths(self):
+        """
+        Scan the requested paths to count file sizes, excluding requested files
+        and dirs and building the upload file list.
+        """
+        for path in self.paths:
+            if path == '-':
+                continue
             elif os.path.isdir(path):
                 # Use absolute paths on cache index so CWD doesn't interfere
                 # with the caching logic.
@@ -540,56 +647,28 @@ class ArvPutUploadJob(object):
                     # upload the directory to the collection's root.
                     prefixdir = os.path.dirname(path)
                 prefixdir += os.sep
-                for root, dirs, files in os.walk(path,
-                                                 followlinks=self.follow_links):
-                    root_relpath = os.path.relpath(root, path)
-                    if root_relpath == '.':
-                        root_relpath = ''
-                    # Exclude files/dirs by full path matching pattern
-                    if self.exclude_paths:
-                        dirs[:] = [d for d in dirs
-                                   if not any(pathname_match(
-                                           os.path.join(root_relpath, d), pat)
-                                              for pat in self.exclude_paths)]
-                        files = [f for f in files
-                                 if not any(pathname_match(
-                                         os.path.join(root_relpath, f), pat)
-                                            for pat in self.exclude_paths)]
-                    # Exclude files/dirs by name matching pattern
-                    if self.exclude_names is not None:
-                        dirs[:] = [d for d in dirs
-                                   if not self.exclude_names.match(d)]
-                        files = [f for f in files
-                                 if not self.exclude_names.match(f)]
-                    # Make os.walk()'s dir traversing order deterministic
-                    dirs.sort()
-                    files.sort()
-                    for f in files:
-                        filepath = os.path.join(root, f)
-                        # Add its size to the total bytes count (if applicable)
-                        if self.follow_links or (not os.path.islink(filepath)):
-                            if self.bytes_expected is not None:
-                                self.bytes_expected += os.path.getsize(filepath)
-                        self._check_file(filepath,
-                                         os.path.join(root[len(prefixdir):], f))
+                # Symlinks are left out unless they are followed.
+                for filepath, st in scan_tree(path,
+                                              follow_links=self.follow_links,
+                                              exclude_paths=self.exclude_paths,
+                                              exclude_names=self.exclude_names,
+                                              threads=self.SCAN_THREADS):
+                    if self._stop_scan.is_set():
+                        return
+                    # Add its size to the total bytes count (if applicable)
+                    if self._bytes_expected is not None:
+                        self._bytes_expected += st.st_size
+                    self._check_file(filepath, filepath[len(prefixdir):], st)
             else:
                 filepath = os.path.abspath(path)
-                # Add its size to the total bytes count (if applicable)
+                # Ignore symlinks when requested
                 if self.follow_links or (not os.path.islink(filepath)):
-                    if self.bytes_expected is not None:
-                        self.bytes_expected += os.path.getsize(filepath)
-                self._check_file(filepath,
-                                 self.filename or os.path.basename(path))
-        # If dry-mode is on, and got up to this point, then we should notify that
-        # there aren't any file to upload.
-        if self.dry_run:
-            raise ArvPutUploadNotPending()
-        # Remove local_collection's files that don't exist locally anymore, so the
-        # bytes_written count is correct.
-        for f in self.collection_file_paths(self._local_collection,
-                                            path_prefix=""):
-            if f != 'stdin' and f != self.filename and not f in self._file_paths:
-                self._local_collection.remove(f)
+                    st = os.stat(filepath)
+                    # Add its size to the total bytes count (if applicable)
+                    if self._bytes_expected is not None:
+                        self._bytes_expected += st.st_size
+                    self._check_file(filepath,
+                                     self.filename or os.path.basename(path), st)
 
     def start(self, save_collection):
         """
@@ -603,8 +682,11 @@ class ArvPutUploadJob(object):
             # Actual file upload
             self._upload_started = True # Used by the update thread to start checkpointing
             self._upload_files()
+            if self._scan_error is not None:
+                raise self._scan_error
         except (SystemExit, Exception) as e:
             self._checkpoint_before_quit = False
+            self._stop_scan.set()
             # Log stack trace only when Ctrl-C isn't pressed (SIGINT)
             # Note: We're expecting SystemExit instead of
             # KeyboardInterrupt because we have a custom signal
@@ -619,7 +701,8 @@ class ArvPutUploadJob(object):
             raise
         finally:
             if not self.dry_run:
-                # Stop the thread before doing anything else
+                # Stop the threads before doing anything else
+                self._scan_complete.wait()
                 self._stop_checkpointer.set()
                 self._checkpointer.join()
                 if self._checkpoint_before_quit:
@@ -702,24 +785,37 @@ class ArvPutUploadJob(object):
     def _update(self, final=False):
         """
         Update cached manifest text and report progress.
+
+        Checkpoints append the changes since the previous one to the
+        cache file.  Once those records outgrow the snapshot they're
+        appended to (and on the final update), the whole state is
+        rewritten instead, so the cache stays proportional to the
+        upload size.
         """
         if self._upload_started:
+            record = None
             with self._collection_lock:
                 self.bytes_written = self._collection_size(self._local_collection)
                 if self.use_cache:
-                    if final:
-                        manifest = self._local_collection.manifest_text()
-                    else:
-                        # Get the manifest text without comitting pending blocks
-                        manifest = self._local_collection.manifest_text(strip=False,
-                                                                        normalize=False,
-                                                                        only_committed=True)
-                    # Update cache
-                    with self._state_lock:
-                        self._state['manifest'] = manifest
+                    record = self._journal_record()
+                    if final or self._journal_bytes >= self._snapshot_bytes:
+                        record = None
+                        if final:
+                            manifest = self._local_collection.manifest_text()
+                        else:
+                            # Get the manifest text without comitting pending blocks
+                            manifest = self._local_collection.manifest_text(strip=False,
+                                                                            normalize=False,
+                                                                            only_committed=True)
+                        # Update cache
+                        with self._state_lock:
+                            self._state['manifest'] = manifest
             if self.use_cache:
                 try:
-                    self._save_state()
+                    if record is None:
+                        self._save_state()
+                    else:
+                        self._append_state(record)
                 except Exception as e:
                     self.logger.error("Unexpected error trying to save cache file: {}".format(e))
             # Keep remote collection's trash_at attribute synced when using relative expire dates
@@ -738,20 +834,58 @@ class ArvPutUploadJob(object):
 
     def report_progress(self):
         if self.reporter is not None:
-            self.reporter(self.bytes_written, self.bytes_expected)
+            # Report an unknown total while the scan is still going.
+            self.reporter(self.bytes_written,
+                          self._bytes_expected if self._scan_complete.is_set() else None)
+
+    def _journal_path(self, filename):
+        """Note that `filename` changed in the local collection."""
+        with self._state_lock:
+            self._journal_paths.add(filename)
+
+    def _journal_record(self):
+        """
+        Return the changes since the last checkpoint, as a cache journal record.
+
+        The record holds the updated file list entries, and the manifest
+        text of every changed collection file (None if it was removed).
+        Files still open for writing stay in the changed set so the next
+        checkpoint picks up their newly committed blocks.
+        """
+        with self._state_lock:
+            files = {source: dict(self._state['files'][source])
+                     for source in self._journal_files}
+            paths = self._journal_paths
+            self._journal_files = set()
+            self._journal_paths = set()
+        streams = {}
+        still_open = set()
+        for path in paths:
+            item = self._local_collection.find(path)
+            if isinstance(item, arvados.arvfile.ArvadosFile):
+                stream_name = os.path.dirname(path)
+                stream_name = './' + stream_name if stream_name else '.'
+                streams[path] = item.manifest_text(stream_name=stream_name,
+                                                   only_committed=True)
+                if not item.closed():
+                    still_open.add(path)
+            else:
+                streams[path] = None
+        if still_open:
+            with self._state_lock:
+                self._journal_paths.update(still_open)
+        return {'files': files, 'streams': streams}
 
     def _write_stdin(self, filename):
         output = self._local_collection.open(filename, 'wb')
+        self._journal_path(filename)
         self._write(sys.stdin.buffer, output)
         output.close()
 
-    def _check_file(self, source, filename):
+    def _check_file(self, source, filename, st):
         """
-        Check if this file needs to be uploaded
+        Check if this file needs to be uploaded, given its os.stat() result
         """
-        # Ignore symlinks when requested
-        if (not self.follow_links) and os.path.islink(source):
-            return
         resume_offset = 0
         should_upload = False
         new_file_in_cache = False
@@ -763,9 +897,10 @@ class ArvPutUploadJob(object):
             # repeated run.
             if source not in self._state['files']:
                 self._state['files'][source] = {
-                    'mtime': os.path.getmtime(source),
-                    'size' : os.path.getsize(source)
+                    'mtime': st.st_mtime,
+                    'size' : st.st_size
                 }
+                self._journal_files.add(source)
                 new_file_in_cache = True
             cached_file_data = self._state['files'][source]
 
@@ -779,7 +914,7 @@ class ArvPutUploadJob(object):
         elif new_file_in_cache:
             should_upload = True
         # Local file didn't change from last run.
-        elif cached_file_data['mtime'] == os.path.getmtime(source) and cached_file_data['size'] == os.path.getsize(source):
+        elif cached_file_data['mtime'] == st.st_mtime and cached_file_data['size'] == st.st_size:
             if not file_in_local_collection:
                 # File not uploaded yet, upload it completely
                 should_upload = True
@@ -789,6 +924,7 @@ class ArvPutUploadJob(object):
                 self.logger.warning(u"Uploaded file '{}' access token expired, will re-upload it from scratch".format(filename))
                 should_upload = True
                 self._local_collection.remove(filename)
+                self._journal_path(filename)
             elif cached_file_data['size'] == file_in_local_collection.size():
                 # File already there, skip it.
                 self.bytes_skipped += cached_file_data['size']
@@ -801,16 +937,18 @@ class ArvPutUploadJob(object):
                 # Inconsistent cache, re-upload the file
                 should_upload = True
                 self._local_collection.remove(filename)
+                self._journal_path(filename)
                 self.logger.warning(u"Uploaded version of file '{}' is bigger than local version, will re-upload it from scratch.".format(source))
         # Local file differs from cached data, re-upload it.
         else:
             if file_in_local_collection:
                 self._local_collection.remove(filename)
+                self._journal_path(filename)
             should_upload = True
 
         if should_upload:
             try:
-                self._files_to_upload.append((source, resume_offset, filename))
+                self._files_to_upload.append((source, resume_offset, filename, st))
             except ArvPutUploadIsPending:
                 # This could happen when running on dry-mode, close cache file to
                 # avoid locking issues.
@@ -818,11 +956,24 @@ class ArvPutUploadJob(object):
                 raise
 
     def _upload_files(self):
-        for source, resume_offset, filename in self._files_to_upload:
+        for upload, data in self._read_small_files(self._files_to_upload):
+            source, resume_offset, filename, st = upload
+            if data is not None:
+                # Read ahead of time, see _read_small_files()
+                with self._state_lock:
+                    self._state['files'][source]['mtime'] = st.st_mtime
+                    self._state['files'][source]['size'] = st.st_size
+                    self._journal_files.add(source)
+                output = self._local_collection.open(filename, 'wb')
+                self._journal_path(filename)
+                output.write(data)
+                output.close(flush=False)
+                continue
             with open(source, 'rb') as source_fd:
                 with self._state_lock:
-                    self._state['files'][source]['mtime'] = os.path.getmtime(source)
-                    self._state['files'][source]['size'] = os.path.getsize(source)
+                    self._state['files'][source]['mtime'] = st.st_mtime
+                    self._state['files'][source]['size'] = st.st_size
+                    self._journal_files.add(source)
                 if resume_offset > 0:
                     # Start upload where we left off
                     output = self._local_collection.open(filename, 'ab')
@@ -830,9 +981,99 @@ class ArvPutUploadJob(object):
                 else:
                     # Start from scratch
                     output = self._local_collection.open(filename, 'wb')
+                self._journal_path(filename)
                 self._write(source_fd, output)
                 output.close(flush=False)
 
+    def _read_small_files(self, uploads):
+        """
+        Yield (upload, data) for each item of the upload list, in order.
+
+        When there are millions of tiny files, opening and reading them
+        one at a time is slower than writing them to Keep.  So the
+        small regular files that are uploaded from the start are read
+        ahead by a pool of threads, and data is their content.  For the
+        other files data is None, and the caller reads them itself.  Keeping
+        a single writer keeps the manifest the same as before.
+        """
+        todo = queue.Queue()
+        def read():
+            while True:
+                task = todo.get()
+                if task is None:
+                    return
+                source, done, result = task
+                try:
+                    with open(source, 'rb') as f:
+                        data = f.read(self.SMALL_FILE_SIZE + 1)
+                    # A file that grew past SMALL_FILE_SIZE since it was
+                    # scanned is left to the caller to stream.
+                    result.append(data if len(data) <= self.SMALL_FILE_SIZE else None)
+                except Exception as e:
+                    result.append(e)
+                finally:
+                    done.set()
+
+        workers = []
+        pending = collections.deque()
+        pending_bytes = 0
+        items = uploads.follow()
+        taken = 0
+        exhausted = False
+        try:
+            while True:
+                # Take more items while there is room, but only wait for
+                # the scan to list more when there is nothing else to do.
+                while (not exhausted and
+                       (not pending or
+                        (len(pending) < self.READ_AHEAD_FILES and
+                         pending_bytes < self.READ_AHEAD_BYTES and
+                         uploads.ready(taken)))):
+                    upload = next(items, None)
+                    if upload is None:
+                        exhausted = True
+                        break
+                    taken += 1
+                    source, resume_offset, filename, st = upload
+                    # Devices, FIFOs and the like report a size of zero
+                    # but can hold any amount of data, so only regular
+                    # files are read ahead.
+                    if (resume_offset > 0 or not stat.S_ISREG(st.st_mode) or
+                        st.st_size > self.SMALL_FILE_SIZE):
+                        pending.append((upload, 0, None, None))
+                        continue
+                    if len(workers) < self.READ_THREADS:
+                        w = threading.Thread(target=read)
+                        w.daemon = True
+                        w.start()
+                        workers.append(w)
+                    done = threading.Event()
+                    result = []
+                    todo.put((source, done, result))
+                    pending.append((upload, st.st_size, done, result))
+                    pending_bytes += st.st_size
+                if not pending:
+                    return
+                upload, size, done, result = pending.popleft()
+                pending_bytes -= size
+                if done is None:
+                    yield upload, None
+                    continue
+                done.wait()
+                if isinstance(result[0], Exception):
+                    raise result[0]
+                yield upload, result[0]
+        finally:
+            # Skip the files that haven't been started, then stop the
+            # workers.
+            try:
+                while True:
+                    todo.get_nowait()
+            except queue.Empty:
+                pass
+            for _ in workers:
+                todo.put(None)
+
     def _write(self, source_fd, output):
         while True:
             data = source_fd.read(arvados.config.KEEP_BLOCK_SIZE)
@@ -893,13 +1134,15 @@ class ArvPutUploadJob(object):
         with self._state_lock:
             if self.use_cache:
                 try:
-                    self._state = json.load(self._cache_file)
+                    self._state = self._load_state()
                     if not set(['manifest', 'files']).issubset(set(self._state.keys())):
                         # Cache at least partially incomplete, set up new cache
                         self._state = copy.deepcopy(self.EMPTY_STATE)
+                        self._snapshot_bytes = 0
                 except ValueError:
-                    # Cache file empty, set up new cache
+                    # Cache file empty or damaged, set up new cache
                     self._state = copy.deepcopy(self.EMPTY_STATE)
+                    self._snapshot_bytes = 0
             else:
                 self.logger.info("No cache usage requested for this run.")
                 # No cache file, set empty state
@@ -911,8 +1154,71 @@ class ArvPutUploadJob(object):
                 self._state['manifest'],
                 replication_desired=self.replication_desired,
                 put_threads=self.put_threads,
+                max_buffer_bytes=self.max_buffer_bytes,
                 api_client=self._api_client,
                 num_retries=self.num_retries)
+            streams = self._state.pop('streams', None)
+            if streams:
+                self._apply_streams(streams)
+
+    def _load_state(self):
+        """
+        Read the cache file and return the state it holds.
+
+        The first line is a snapshot of the whole state, in the same format
+        older versions saved.  Each following line is a journal record
+        written by a checkpoint; records are folded in order into the file
+        list and into a {path: manifest text} map of the files that changed
+        after the snapshot, which is kept in the 'streams' key for
+        _setup_state() to apply.  A truncated last line, left by an
+        interrupted checkpoint, is ignored.
+        """
+        data = self._cache_file.read()
+        snapshot, newline, journal = data.partition('\n')
+        state = json.loads(snapshot)
+        if not isinstance(state, dict):
+            raise ValueError("cache snapshot is not a JSON object")
+        files = state.setdefault('files', {})
+        streams = {}
+        records = journal.split('\n')
+        complete = True
+        for n, line in enumerate(records):
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if n < len(records) - 1:
+                    raise
+                complete = False
+                break
+            files.update(record['files'])
+            streams.update(record['streams'])
+        if streams:
+            state['streams'] = streams
+        if newline and complete:
+            self._snapshot_bytes = len(snapshot) + 1
+            self._journal_bytes = len(journal)
+        else:
+            # Nothing can be appended here as it is (old format cache,
+            # or a partial record at the end): have the first checkpoint
+            # rewrite the file.
+            self._snapshot_bytes = 0
+            self._journal_bytes = 0
+        return state
+
+    def _apply_streams(self, streams):
+        """Update the local collection with the journaled file manifests."""
+        changed = arvados.collection.Collection(
+            ''.join(m for m in listvalues(streams) if m),
+            api_client=self._api_client,
+            num_retries=self.num_retries)
+        for path, manifest in listitems(streams):
+            if manifest is not None:
+                self._local_collection.copy(path, path, source_collection=changed,
+                                            overwrite=True)
+            elif self._local_collection.find(path) is not None:
+                self._local_collection.remove(path)
 
     def _cached_manifest_valid(self):
         """
@@ -920,14 +1226,19 @@ class ArvPutUploadJob(object):
         is usable: checking if the cached manifest was not created with a different
         arvados account.
         """
-        if self._state.get('manifest', None) is None:
+        # Journaled file manifests are checked along with the snapshot.
+        manifests = [m for m in [self._state.get('manifest', None)] +
+                     listvalues(self._state.get('streams', {}))
+                     if m is not None]
+        if not manifests:
             # No cached manifest yet, all good.
             return True
         now = datetime.datetime.utcnow()
         oldest_exp = None
         oldest_loc = None
         block_found = False
-        for m in keep_locator_pattern.finditer(self._state['manifest']):
+        for m in itertools.chain.from_iterable(
+                keep_locator_pattern.finditer(manifest) for manifest in manifests):
             loc = m.group(0)
             try:
                 exp = datetime.datetime.utcfromtimestamp(int(loc.split('@')[1], 16))
@@ -946,6 +1257,7 @@ class ArvPutUploadJob(object):
             # Reset the cache and move on.
             self.logger.info('Cache expired, starting from scratch.')
             self._state['manifest'] = ''
+            self._state.pop('streams', None)
             return True
         kc = arvados.KeepClient(api_client=self._api_client,
                                 num_retries=self.num_retries)
@@ -975,13 +1287,13 @@ class ArvPutUploadJob(object):
 
     def _save_state(self):
         """
-        Atomically save current state into cache.
+        Atomically save current state into cache, as a new snapshot.
         """
         with self._state_lock:
             # We're not using copy.deepcopy() here because it's a lot slower
             # than json.dumps(), and we're already needing JSON format to be
             # saved on disk.
-            state = json.dumps(self._state)
+            state = json.dumps(self._state) + '\n'
         try:
             new_cache = tempfile.NamedTemporaryFile(
                 mode='w+',
@@ -1000,6 +1312,28 @@ class ArvPutUploadJob(object):
         else:
             self._cache_file.close()
             self._cache_file = new_cache
+            self._snapshot_bytes = len(state)
+            self._journal_bytes = 0
+
+    def _append_state(self, record):
+        """
+        Append a journal record to the cache file.
+        """
+        if not (record['files'] or record['streams']):
+            return
+        line = json.dumps(record) + '\n'
+        try:
+            self._cache_file.seek(0, os.SEEK_END)
+            self._cache_file.write(line)
+            self._cache_file.flush()
+            os.fsync(self._cache_file.fileno())
+        except (IOError, OSError) as error:
+            self.logger.error("There was a problem while saving the cache file: {}".format(error))
+            # This record's changes are lost from the journal: rewrite the
+            # whole state on the next checkpoint.
+            self._snapshot_bytes = 0
+        else:
+            self._journal_bytes += len(line)
 
     def collection_name(self):
         return self._my_collection().api_response()['name'] if self._my_collection().api_response() else None
@@ -1071,6 +1405,107 @@ def pathname_match(pathname, pattern):
             return False
     return True
 
+def scan_tree(top, follow_links=True, exclude_paths=[], exclude_names=None,
+              threads=8, readahead=64):
+    """Yield (path, stat result) for each file under the directory `top`.
+
+    Files come in the order os.walk() would produce them top-down with
+    sorted directory and file names.  Up to `readahead` of the
+    directories that come next are listed ahead of the consumer by a
+    pool of `threads` threads.  Listing uses os.scandir(), so each file
+    costs one stat() call, and symlinks that aren't followed cost none.
+
+    Like os.walk(), directories that can't be listed are skipped.  A
+    file that can't be stat()ed raises OSError when it is reached.
+    """
+    def list_dir(path, relpath):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return None
+        files = []
+        dirs = []
+        for entry in entries:
+            # Exclude files/dirs by full path or name matching pattern
+            if exclude_paths and any(pathname_match(os.path.join(relpath, entry.name), pat)
+                                     for pat in exclude_paths):
+                continue
+            if exclude_names is not None and exclude_names.match(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not follow_links and entry.is_symlink():
+                continue
+            if is_dir:
+                dirs.append(entry.name)
+            else:
+                try:
+                    files.append((entry.name, entry.stat()))
+                except OSError as error:
+                    files.append((entry.name, error))
+        files.sort(key=lambda f: f[0])
+        dirs.sort()
+        return files, dirs
+
+    todo = queue.Queue()
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            path, relpath, done, result = job
+            try:
+                result.append(list_dir(path, relpath))
+            finally:
+                done.set()
+
+    workers = []
+    # Directories still to be walked, the next one last.  Each is a
+    # [path, relpath, event, result] list; event is None until it has
+    # been queued for listing.
+    stack = [[top, '', None, []]]
+    queued = 0
+    try:
+        while stack:
+            # Queue the directories that come next.  The next one
+            # always gets queued: it either was already, or there is
+            # room because the previous one was just taken off.
+            for job in reversed(stack[-readahead:]):
+                if queued >= readahead:
+                    break
+                if job[2] is None:
+                    job[2] = threading.Event()
+                    todo.put(job)
+                    queued += 1
+                    if len(workers) < threads:
+                        w = threading.Thread(target=work)
+                        w.daemon = True
+                        w.start()
+                        workers.append(w)
+            path, relpath, done, result = stack.pop()
+            done.wait()
+            queued -= 1
+            if result[0] is None:
+                continue
+            files, dirs = result[0]
+            for name, st in files:
+                if isinstance(st, OSError):
+                    raise st
+                yield os.path.join(path, name), st
+            stack.extend([os.path.join(path, d), os.path.join(relpath, d), None, []]
+                         for d in reversed(dirs))
+    finally:
+        # Skip the listings that haven't started, then stop the workers.
+        try:
+            while True:
+                todo.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in workers:
+            todo.put(None)
+
 def machine_progress(bytes_written, bytes_expected):
     return _machine_format.format(
         bytes_written, -1 if (bytes_expected is None) else bytes_expected)
@@ -1266,7 +1701,9 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr,
                                  follow_links=args.follow_links,
                                  exclude_paths=exclude_paths,
                                  exclude_names=exclude_names,
-                                 trash_at=trash_at)
+                                 trash_at=trash_at,
+                                 max_buffer_bytes=(args.max_buffer and
+                                                   args.max_buffer * 1024 * 1024))
     except ResumeCacheConflict:
         logger.error("\n".join([
             "arv-put: Another process is already uploading this data.",
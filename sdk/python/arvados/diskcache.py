@@ -0,0 +1,161 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from builtins import object
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger('arvados.keep')
+
+class DiskBlockCache(object):
+    """Persistent block cache shared by all processes using one directory.
+
+    Keep blocks are immutable, so each block is stored in a file named
+    by its md5 hash and never rewritten.  New blocks are written to a
+    temporary file and renamed into place, so readers never see a
+    partial block.  Readers hold a shared flock() on a block file while
+    reading it; eviction only removes files it can lock exclusively.
+    Block contents are verified against their hash on every load, and
+    a block that fails verification is discarded.
+
+    Access time is recorded by touching the file's mtime.  When the
+    total size exceeds cache_max, eviction removes the least recently
+    used blocks until it is below EVICT_TO * cache_max, so that the
+    directory is not rescanned on every new block.
+    """
+
+    EVICT_TO = 0.9
+
+    # Default disk cache is 8GiB
+    def __init__(self, path, cache_max=(8 * 1024 * 1024 * 1024)):
+        self._dir = path
+        self.cache_max = cache_max
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self._dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._cache_size = self._cap()
+
+    def __str__(self):
+        return self._dir
+
+    def _filename(self, md5sum):
+        return os.path.join(self._dir, md5sum[0:3], md5sum)
+
+    def get(self, md5sum):
+        """Return the cached block with the given hash, or None."""
+        filename = self._filename(md5sum)
+        try:
+            f = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            content = f.read()
+            if hashlib.md5(content).hexdigest() != md5sum:
+                _logger.warning("Disk cache checksum fail: %s", filename)
+                self._unlink(filename)
+                return None
+            os.utime(filename, None)
+            return content
+        except (IOError, OSError) as err:
+            _logger.debug("Disk cache read %s: %s", filename, err)
+            return None
+        finally:
+            f.close()
+
+    def set(self, md5sum, content):
+        """Store a block in the cache.
+
+        Errors (e.g. a full disk) are logged and otherwise ignored: the
+        block is still available from Keep.
+        """
+        filename = self._filename(md5sum)
+        if os.path.exists(filename):
+            return
+        tempname = None
+        try:
+            try:
+                os.mkdir(os.path.dirname(filename))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            fd, tempname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.rename(tempname, filename)
+            tempname = None
+        except (IOError, OSError) as err:
+            _logger.warning("Disk cache write %s: %s", filename, err)
+            return
+        finally:
+            if tempname:
+                self._unlink(tempname)
+        with self._lock:
+            self._cache_size += len(content)
+            if self._cache_size > self.cache_max:
+                self._cache_size = self._cap()
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _cap(self):
+        # Other processes add blocks too, so the running size estimate
+        # kept by set() is only a trigger: rescan the directory, evict
+        # the least recently used blocks down to the low watermark, and
+        # return the actual size.
+        # An exclusive lock on the cache directory keeps several
+        # processes from evicting at once.
+        with open(os.path.join(self._dir, '.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            blocks = []
+            total = 0
+            for subdir in os.listdir(self._dir):
+                subpath = os.path.join(self._dir, subdir)
+                if not os.path.isdir(subpath):
+                    continue
+                for ent in os.listdir(subpath):
+                    fnm = os.path.join(subpath, ent)
+                    try:
+                        st = os.lstat(fnm)
+                    except OSError:
+                        continue
+                    if ent.endswith('.tmp'):
+                        # Leftover from a writer that crashed.  Any
+                        # temp file still being written is much
+                        # younger than this.
+                        if st.st_mtime < time.time() - 86400:
+                            self._unlink(fnm)
+                        continue
+                    blocks.append((st.st_mtime, st.st_size, fnm))
+                    total += st.st_size
+            if total <= self.cache_max:
+                return total
+            target = self.cache_max * self.EVICT_TO
+            blocks.sort()
+            for _, size, fnm in blocks:
+                if total <= target:
+                    break
+                try:
+                    with open(fnm, 'rb') as f:
+                        # Skip blocks that are being read right now.
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self._unlink(fnm)
+                except (IOError, OSError):
+                    continue
+                total -= size
+            return total
@@ -13,6 +13,8 @@ from builtins import range
 from builtins import object
 import collections
 import datetime
+import errno
+import fcntl
 import hashlib
 import io
 import logging
@@ -21,10 +23,12 @@ import os
 import pycurl
 import queue
 import re
+import select
 import socket
 import ssl
 import sys
 import threading
+import time
 from . import timer
 import urllib.parse
 
@@ -35,6 +39,7 @@ else:
 
 import arvados
 import arvados.config as config
+import arvados.diskcache
 import arvados.errors
 import arvados.retry as retry
 import arvados.util
@@ -173,11 +178,71 @@ class Keep(object):
     def put(data, **kwargs):
         return Keep.global_client_object().put(data, **kwargs)
 
+class _ResponseBuffer(object):
+    """Receive a response body without copying it.
+
+    The body is written straight into a buffer preallocated from the
+    expected size (it still grows if more data arrives), and its md5
+    hash is computed as the data arrives.  getvalue() returns a
+    read-only memoryview of the buffer.
+    """
+
+    def __init__(self, size_hint=None):
+        self._buf = bytearray(min(size_hint or 0, config.KEEP_BLOCK_SIZE))
+        self._size = 0
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        end = self._size + len(data)
+        # Overwrites preallocated space, or extends the buffer.
+        self._buf[self._size:end] = data
+        self._size = end
+        self._md5.update(data)
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def getvalue(self):
+        view = memoryview(self._buf)[:self._size]
+        if hasattr(view, 'toreadonly'):
+            view = view.toreadonly()
+        return view
+
+
+class _RequestBody(object):
+    """Feed a request body to cURL from any bytes-like object.
+
+    Unlike BytesIO, this does not copy the whole body up front: each
+    read() copies only the chunk cURL asks for.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def read(self, size):
+        chunk = self._view[self._pos:self._pos+size]
+        self._pos += len(chunk)
+        return chunk.tobytes()
+
+
+def _as_bytes(blob):
+    # Blocks received by KeepService.get() are memoryviews of the
+    # receive buffer; the public KeepClient methods return bytes.
+    if isinstance(blob, memoryview):
+        return blob.tobytes()
+    return blob
+
+
 class KeepBlockCache(object):
     # Default RAM cache is 256MiB
     def __init__(self, cache_max=(256 * 1024 * 1024)):
         self.cache_max = cache_max
-        self._cache = []
+        # Slots are kept in least-recently-used order: the most
+        # recently used slot is at the end, the next eviction
+        # candidate is at the front.
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
         self._cache_lock = threading.Lock()
 
     class CacheSlot(object):
@@ -202,31 +267,32 @@ class KeepBlockCache(object):
             else:
                 return len(self.content)
 
+    def _cap_cache(self):
+        # Evict ready slots, least recently used first, until the
+        # total size of cached content fits in cache_max.  Slots that
+        # are still being fetched are skipped; there are at most as
+        # many of those as there are concurrent readers.
+        while self._cache_size > self.cache_max:
+            for locator, slot in self._cache.items():
+                if slot.ready.is_set():
+                    break
+            else:
+                return
+            del self._cache[locator]
+            self._cache_size -= slot.size()
+
     def cap_cache(self):
         '''Cap the cache size to self.cache_max'''
         with self._cache_lock:
-            # Select all slots except those where ready.is_set() and content is
-            # None (that means there was an error reading the block).
-            self._cache = [c for c in self._cache if not (c.ready.is_set() and c.content is None)]
-            sm = sum([slot.size() for slot in self._cache])
-            while len(self._cache) > 0 and sm > self.cache_max:
-                for i in range(len(self._cache)-1, -1, -1):
-                    if self._cache[i].ready.is_set():
-                        del self._cache[i]
-                        break
-                sm = sum([slot.size() for slot in self._cache])
+            self._cap_cache()
 
     def _get(self, locator):
-        # Test if the locator is already in the cache
-        for i in range(0, len(self._cache)):
-            if self._cache[i].locator == locator:
-                n = self._cache[i]
-                if i != 0:
-                    # move it to the front
-                    del self._cache[i]
-                    self._cache.insert(0, n)
-                return n
-        return None
+        # Test if the locator is already in the cache, and if so,
+        # mark it as most recently used.
+        n = self._cache.pop(locator, None)
+        if n is not None:
+            self._cache[locator] = n
+        return n
 
     def get(self, locator):
         with self._cache_lock:
@@ -242,9 +308,25 @@ class KeepBlockCache(object):
             else:
                 # Add a new cache slot for the locator
                 n = KeepBlockCache.CacheSlot(locator)
-                self._cache.insert(0, n)
+                self._cache[locator] = n
                 return n, True
 
+    def set(self, slot, blob):
+        '''Fill a slot returned by reserve_cache() and cap the cache.
+
+        A slot set to None (the block could not be read) wakes up any
+        waiting readers and is then dropped, so the next reader tries
+        again.
+        '''
+        slot.set(blob)
+        with self._cache_lock:
+            if self._cache.get(slot.locator) is slot:
+                if blob is None:
+                    del self._cache[slot.locator]
+                else:
+                    self._cache_size += slot.size()
+            self._cap_cache()
+
 class Counter(object):
     def __init__(self, v=0):
         self._lk = threading.Lock()
@@ -259,6 +341,186 @@ class Counter(object):
             return self._val
 
 
+_curl_multi_loop_object = None
+_curl_multi_loop_lock = threading.Lock()
+
+def _curl_multi_loop():
+    global _curl_multi_loop_object
+    with _curl_multi_loop_lock:
+        if _curl_multi_loop_object is None:
+            _curl_multi_loop_object = CurlMultiLoop()
+        return _curl_multi_loop_object
+
+
+class CurlMultiLoop(object):
+    """Drive many cURL transfers from a single I/O thread.
+
+    Transfers are added with start(), which returns immediately and
+    calls a callback from the I/O thread when the transfer finishes,
+    or with perform(), which blocks the calling thread like
+    Curl.perform().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._new = collections.deque()
+        self._callbacks = {}
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._new_multi()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _new_multi(self):
+        # libcurl tells us which sockets to watch through the socket
+        # callback, and we wait on them with poll() rather than
+        # fdset()/select(), which can't handle descriptors >= FD_SETSIZE.
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket_callback)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, self._timer_callback)
+        self._poller = select.poll()
+        self._poller.register(self._wakeup_r, select.POLLIN)
+        self._sockets = set()
+        self._deadline = None
+
+    def start(self, curl, callback):
+        """Start a transfer on a fully configured Curl handle.
+
+        When it finishes, callback(error) is called from the I/O
+        thread.  error is None on success, otherwise the pycurl.error
+        that Curl.perform() would have raised.  The callback must not
+        block.
+        """
+        with self._lock:
+            self._new.append((curl, callback))
+        try:
+            os.write(self._wakeup_w, b'x')
+        except OSError as err:
+            # A full pipe already guarantees a wakeup.
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def perform(self, curl):
+        """Run a transfer on the I/O thread and wait for it to finish."""
+        done = threading.Event()
+        result = []
+        def callback(error):
+            result.append(error)
+            done.set()
+        self.start(curl, callback)
+        done.wait()
+        if result[0] is not None:
+            raise result[0]
+
+    def _socket_callback(self, what, fd, multi, data):
+        if what == pycurl.POLL_REMOVE:
+            if fd in self._sockets:
+                self._sockets.discard(fd)
+                self._poller.unregister(fd)
+            return
+        events = 0
+        if what & pycurl.POLL_IN:
+            events |= select.POLLIN
+        if what & pycurl.POLL_OUT:
+            events |= select.POLLOUT
+        self._sockets.add(fd)
+        self._poller.register(fd, events)
+
+    def _timer_callback(self, timeout_ms):
+        if timeout_ms < 0:
+            self._deadline = None
+        else:
+            self._deadline = time.time() + timeout_ms / 1000.0
+
+    def _run(self):
+        while True:
+            try:
+                self._run_once()
+            except Exception as err:
+                # Don't let the I/O thread die with transfers in
+                # flight: perform() callers would wait forever.
+                _logger.exception("Unexpected error in CurlMultiLoop")
+                self._fail_all(err)
+
+    def _run_once(self):
+        with self._lock:
+            while self._new:
+                curl, callback = self._new.popleft()
+                self._callbacks[id(curl)] = (curl, callback)
+                self._multi.add_handle(curl)
+        if self._deadline is not None:
+            timeout = max(0, int((self._deadline - time.time()) * 1000))
+        elif self._callbacks:
+            timeout = 1000
+        else:
+            timeout = None
+        try:
+            events = self._poller.poll(timeout)
+        except (OSError, select.error) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return
+        for fd, event in events:
+            if fd == self._wakeup_r:
+                os.read(self._wakeup_r, 4096)
+                continue
+            action = 0
+            if event & (select.POLLIN | select.POLLHUP):
+                action |= pycurl.CSELECT_IN
+            if event & select.POLLOUT:
+                action |= pycurl.CSELECT_OUT
+            if event & select.POLLERR:
+                action |= pycurl.CSELECT_ERR
+            self._multi.socket_action(fd, action)
+        if self._deadline is not None and self._deadline <= time.time():
+            self._deadline = None
+            self._multi.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self._finish_transfers()
+
+    def _fail_all(self, err):
+        # Report err to every pending transfer and start over with a
+        # fresh multi handle.
+        error = pycurl.error(pycurl.E_ABORTED_BY_CALLBACK,
+                             "CurlMultiLoop failed: {}".format(err))
+        with self._lock:
+            pending = list(self._callbacks.values())
+            pending.extend(self._new)
+            self._callbacks.clear()
+            self._new.clear()
+        for curl, _ in pending:
+            try:
+                self._multi.remove_handle(curl)
+            except pycurl.error:
+                pass
+        try:
+            self._multi.close()
+        except pycurl.error:
+            pass
+        self._new_multi()
+        for _, callback in pending:
+            try:
+                callback(error)
+            except Exception:
+                _logger.exception("Exception in CurlMultiLoop callback")
+
+    def _finish_transfers(self):
+        while True:
+            remaining, ok_list, err_list = self._multi.info_read()
+            finished = [(curl, None) for curl in ok_list]
+            finished.extend((curl, pycurl.error(code, errmsg))
+                            for curl, code, errmsg in err_list)
+            for curl, error in finished:
+                self._multi.remove_handle(curl)
+                _, callback = self._callbacks.pop(id(curl))
+                try:
+                    callback(error)
+                except Exception:
+                    _logger.exception("Exception in CurlMultiLoop callback")
+            if remaining == 0:
+                return
+
+
 class KeepClient(object):
 
     # Default Keep server connection timeout:  2 seconds
@@ -270,6 +532,11 @@ class KeepClient(object):
     DEFAULT_TIMEOUT = (2, 256, 32768)
     DEFAULT_PROXY_TIMEOUT = (20, 256, 32768)
 
+    # Number of recent GET latencies used to estimate the hedging
+    # threshold, and how many are needed before the estimate is used.
+    HEDGE_LATENCY_SAMPLES = 200
+    HEDGE_LATENCY_MIN_SAMPLES = 20
+
 
     class KeepService(object):
         """Make requests to a single Keep service, and track results.
@@ -293,7 +560,8 @@ class KeepClient(object):
                      upload_counter=None,
                      download_counter=None,
                      headers={},
-                     insecure=False):
+                     insecure=False,
+                     curl_multi=None):
             self.root = root
             self._user_agent_pool = user_agent_pool
             self._result = {'error': None}
@@ -306,6 +574,8 @@ class KeepClient(object):
             self.upload_counter = upload_counter
             self.download_counter = download_counter
             self.insecure = insecure
+            self._curl_multi = curl_multi
+            self._cancelled = False
 
         def usable(self):
             """Is it worth attempting a request?"""
@@ -318,6 +588,18 @@ class KeepClient(object):
         def last_result(self):
             return self._result
 
+        def cancel(self):
+            """Abort a request in progress in another thread.
+
+            The aborted request fails without marking this service
+            unusable.
+            """
+            self._cancelled = True
+
+        def _progressfunction(self, *args):
+            # A nonzero return value makes cURL abort the transfer.
+            return 1 if self._cancelled else 0
+
         def _get_user_agent(self):
             try:
                 return self._user_agent_pool.get(block=False)
@@ -331,6 +613,12 @@ class KeepClient(object):
             except:
                 ua.close()
 
+        def _perform(self, curl):
+            if self._curl_multi is None:
+                curl.perform()
+            else:
+                self._curl_multi.perform(curl)
+
         def _socket_open(self, *args, **kwargs):
             if len(args) + len(kwargs) == 2:
                 return self._socket_open_pycurl_7_21_5(*args, **kwargs)
@@ -364,7 +652,8 @@ class KeepClient(object):
             try:
                 with timer.Timer() as t:
                     self._headers = {}
-                    response_body = BytesIO()
+                    response_body = _ResponseBuffer(
+                        locator.size if method == "GET" else 0)
                     curl.setopt(pycurl.NOSIGNAL, 1)
                     curl.setopt(pycurl.OPENSOCKETFUNCTION,
                                 lambda *args, **kwargs: self._socket_open(*args, **kwargs))
@@ -373,6 +662,8 @@ class KeepClient(object):
                         '{}: {}'.format(k,v) for k,v in self.get_headers.items()])
                     curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
                     curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
+                    curl.setopt(pycurl.NOPROGRESS, 0)
+                    curl.setopt(pycurl.PROGRESSFUNCTION, self._progressfunction)
                     if self.insecure:
                         curl.setopt(pycurl.SSL_VERIFYPEER, 0)
                     else:
@@ -382,7 +673,7 @@ class KeepClient(object):
                     self._setcurltimeouts(curl, timeout, method=="HEAD")
 
                     try:
-                        curl.perform()
+                        self._perform(curl)
                     except Exception as e:
                         raise arvados.errors.HttpError(0, str(e))
                     finally:
@@ -437,7 +728,7 @@ class KeepClient(object):
 
             if self.download_counter:
                 self.download_counter.add(len(self._result['body']))
-            resp_md5 = hashlib.md5(self._result['body']).hexdigest()
+            resp_md5 = response_body.md5()
             if resp_md5 != locator.md5sum:
                 _logger.warning("Checksum fail: md5(%s) = %s",
                                 url, resp_md5)
@@ -447,75 +738,119 @@ class KeepClient(object):
             return self._result['body']
 
         def put(self, hash_s, body, timeout=None):
-            url = self.root + hash_s
-            _logger.debug("Request: PUT %s", url)
+            curl, state = self._put_start(hash_s, body, timeout)
+            if curl is not None:
+                try:
+                    self._perform(curl)
+                    error = None
+                except Exception as e:
+                    error = e
+                self._put_transfer_done(curl, state, error)
+            return self._put_finish(curl, state)
+
+        def put_async(self, hash_s, body, callback, timeout=None):
+            """Start a PUT on this service's CurlMultiLoop.
+
+            Return immediately.  When the request finishes, callback is
+            called from the I/O thread with the value put() would have
+            returned.
+            """
+            curl, state = self._put_start(hash_s, body, timeout)
+            if curl is None:
+                callback(self._put_finish(curl, state))
+                return
+            def done(error):
+                self._put_transfer_done(curl, state, error)
+                callback(self._put_finish(curl, state))
+            self._curl_multi.start(curl, done)
+
+        def _put_start(self, hash_s, body, timeout):
+            # Set up a cURL handle for a PUT request.  Return the handle
+            # and the state needed by _put_finish(), or (None, state)
+            # if the request failed before it could be sent.
+            state = {
+                'url': self.root + hash_s,
+                'body': body,
+                'start': time.time(),
+            }
+            _logger.debug("Request: PUT %s", state['url'])
             curl = self._get_user_agent()
-            ok = None
             try:
-                with timer.Timer() as t:
-                    self._headers = {}
-                    body_reader = BytesIO(body)
-                    response_body = BytesIO()
-                    curl.setopt(pycurl.NOSIGNAL, 1)
-                    curl.setopt(pycurl.OPENSOCKETFUNCTION,
-                                lambda *args, **kwargs: self._socket_open(*args, **kwargs))
-                    curl.setopt(pycurl.URL, url.encode('utf-8'))
-                    # Using UPLOAD tells cURL to wait for a "go ahead" from the
-                    # Keep server (in the form of a HTTP/1.1 "100 Continue"
-                    # response) instead of sending the request body immediately.
-                    # This allows the server to reject the request if the request
-                    # is invalid or the server is read-only, without waiting for
-                    # the client to send the entire block.
-                    curl.setopt(pycurl.UPLOAD, True)
-                    curl.setopt(pycurl.INFILESIZE, len(body))
-                    curl.setopt(pycurl.READFUNCTION, body_reader.read)
-                    curl.setopt(pycurl.HTTPHEADER, [
-                        '{}: {}'.format(k,v) for k,v in self.put_headers.items()])
-                    curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
-                    curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
-                    if self.insecure:
-                        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
-                    else:
-                        curl.setopt(pycurl.CAINFO, arvados.util.ca_certs_path())
-                    self._setcurltimeouts(curl, timeout)
-                    try:
-                        curl.perform()
-                    except Exception as e:
-                        raise arvados.errors.HttpError(0, str(e))
-                    finally:
-                        if self._socket:
-                            self._socket.close()
-                            self._socket = None
-                    self._result = {
-                        'status_code': curl.getinfo(pycurl.RESPONSE_CODE),
-                        'body': response_body.getvalue().decode('utf-8'),
-                        'headers': self._headers,
-                        'error': False,
-                    }
+                self._headers = {}
+                body_reader = _RequestBody(body)
+                state['response_body'] = BytesIO()
+                curl.setopt(pycurl.NOSIGNAL, 1)
+                curl.setopt(pycurl.OPENSOCKETFUNCTION,
+                            lambda *args, **kwargs: self._socket_open(*args, **kwargs))
+                curl.setopt(pycurl.URL, state['url'].encode('utf-8'))
+                # Using UPLOAD tells cURL to wait for a "go ahead" from the
+                # Keep server (in the form of a HTTP/1.1 "100 Continue"
+                # response) instead of sending the request body immediately.
+                # This allows the server to reject the request if the request
+                # is invalid or the server is read-only, without waiting for
+                # the client to send the entire block.
+                curl.setopt(pycurl.UPLOAD, True)
+                curl.setopt(pycurl.INFILESIZE, len(body))
+                curl.setopt(pycurl.READFUNCTION, body_reader.read)
+                curl.setopt(pycurl.HTTPHEADER, [
+                    '{}: {}'.format(k,v) for k,v in self.put_headers.items()])
+                curl.setopt(pycurl.WRITEFUNCTION, state['response_body'].write)
+                curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
+                if self.insecure:
+                    curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+                else:
+                    curl.setopt(pycurl.CAINFO, arvados.util.ca_certs_path())
+                self._setcurltimeouts(curl, timeout)
+            except self.HTTP_ERRORS as e:
+                self._result = {
+                    'error': e,
+                }
+                curl.close()
+                return None, state
+            return curl, state
+
+        def _put_transfer_done(self, curl, state, error):
+            if self._socket:
+                self._socket.close()
+                self._socket = None
+            if error is not None:
+                self._result = {
+                    'error': arvados.errors.HttpError(0, str(error)),
+                }
+                return
+            self._result = {
+                'status_code': curl.getinfo(pycurl.RESPONSE_CODE),
+                'body': state['response_body'].getvalue().decode('utf-8'),
+                'headers': self._headers,
+                'error': False,
+            }
+
+        def _put_finish(self, curl, state):
+            secs = time.time() - state['start']
+            ok = None
+            if self._result['error'] is False:
                 ok = retry.check_http_response_success(self._result['status_code'])
                 if not ok:
                     self._result['error'] = arvados.errors.HttpError(
                         self._result['status_code'],
                         self._headers.get('x-status-line', 'Error'))
-            except self.HTTP_ERRORS as e:
-                self._result = {
-                    'error': e,
-                }
             self._usable = ok != False # still usable if ok is True or None
-            if self._result.get('status_code', None):
-                # Client is functional. See comment in get().
-                self._put_user_agent(curl)
-            else:
-                curl.close()
+            if curl is not None:
+                if self._result.get('status_code', None):
+                    # Client is functional. See comment in get().
+                    self._put_user_agent(curl)
+                else:
+                    curl.close()
             if not ok:
                 _logger.debug("Request fail: PUT %s => %s: %s",
-                              url, type(self._result['error']), str(self._result['error']))
+                              state['url'], type(self._result['error']), str(self._result['error']))
                 return False
+            body = state['body']
             _logger.info("PUT %s: %s bytes in %s msec (%.3f MiB/sec)",
                          self._result['status_code'],
                          len(body),
-                         t.msecs,
-                         1.0*len(body)/2**20/t.secs if t.secs > 0 else 0)
+                         secs * 1000,
+                         1.0*len(body)/2**20/secs if secs > 0 else 0)
             if self.upload_counter:
                 self.upload_counter.add(len(body))
             return True
@@ -614,7 +949,8 @@ class KeepClient(object):
 
 
     class KeepWriterThreadPool(object):
-        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None):
+        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None,
+                     curl_multi=False):
             self.total_task_nr = 0
             self.wanted_copies = copies
             if (not max_service_replicas) or (max_service_replicas >= copies):
@@ -622,12 +958,19 @@ class KeepClient(object):
             else:
                 num_threads = int(math.ceil(1.0*copies/max_service_replicas))
             _logger.debug("Pool max threads is %d", num_threads)
+            self.num_threads = num_threads
+            self.data = data
+            self.data_hash = data_hash
+            self.timeout = timeout
+            self.curl_multi = curl_multi
             self.workers = []
             self.queue = KeepClient.KeepWriterQueue(copies)
-            # Create workers
-            for _ in range(num_threads):
-                w = KeepClient.KeepWriterThread(self.queue, data, data_hash, timeout)
-                self.workers.append(w)
+            # Create workers.  With curl_multi, requests are started
+            # on the services' CurlMultiLoop instead.
+            if not curl_multi:
+                for _ in range(num_threads):
+                    w = KeepClient.KeepWriterThread(self.queue, data, data_hash, timeout)
+                    self.workers.append(w)
 
         def add_task(self, ks, service_root):
             self.queue.put((ks, service_root))
@@ -637,12 +980,48 @@ class KeepClient(object):
             return self.queue.successful_copies
 
         def join(self):
+            if self.curl_multi:
+                self._join_async()
+                return
             # Start workers
             for worker in self.workers:
                 worker.start()
             # Wait for finished work
             self.queue.join()
 
+        def _join_async(self):
+            # Run up to num_threads PUTs at a time, like the worker
+            # threads would, without starting any threads: each
+            # request runs on the CurlMultiLoop and reports back here.
+            finished = queue.Queue()
+            in_flight = 0
+            while True:
+                while (in_flight < self.num_threads and
+                       in_flight < self.queue.pending_copies()):
+                    try:
+                        service, service_root = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.queue.task_done()
+                    if service.finished():
+                        continue
+                    service.put_async(
+                        self.data_hash, self.data,
+                        lambda ok, service=service, service_root=service_root:
+                            finished.put((service, service_root, ok)),
+                        timeout=self.timeout)
+                    in_flight += 1
+                if in_flight == 0:
+                    return
+                service, service_root, ok = finished.get()
+                in_flight -= 1
+                try:
+                    locator, copies = KeepClient.KeepWriterThread.task_result(
+                        service, service_root, ok, self.data_hash, len(self.data))
+                except KeepClient.KeepWriterThread.TaskFailed:
+                    continue
+                self.queue.write_success(locator, copies)
+
         def response(self):
             return self.queue.response
 
@@ -679,20 +1058,25 @@ class KeepClient(object):
             success = bool(service.put(self.data_hash,
                                         self.data,
                                         timeout=self.timeout))
+            return self.task_result(service, service_root, success,
+                                    self.data_hash, len(self.data))
+
+        @classmethod
+        def task_result(cls, service, service_root, success, data_hash, data_size):
             result = service.last_result()
 
             if not success:
                 if result.get('status_code', None):
                     _logger.debug("Request fail: PUT %s => %s %s",
-                                  self.data_hash,
+                                  data_hash,
                                   result['status_code'],
                                   result['body'])
-                raise self.TaskFailed()
+                raise cls.TaskFailed()
 
             _logger.debug("KeepWriterThread %s succeeded %s+%i %s",
                           str(threading.current_thread()),
-                          self.data_hash,
-                          len(self.data),
+                          data_hash,
+                          data_size,
                           service_root)
             try:
                 replicas_stored = int(result['headers']['x-keep-replicas-stored'])
@@ -705,7 +1089,9 @@ class KeepClient(object):
     def __init__(self, api_client=None, proxy=None,
                  timeout=DEFAULT_TIMEOUT, proxy_timeout=DEFAULT_PROXY_TIMEOUT,
                  api_token=None, local_store=None, block_cache=None,
-                 num_retries=0, session=None):
+                 num_retries=0, session=None,
+                 disk_cache_dir=None, disk_cache_max=None,
+                 hedge_delay=None, curl_multi=False):
         """Initialize a new KeepClient.
 
         Arguments:
@@ -759,6 +1145,31 @@ class KeepClient(object):
           The default number of times to retry failed requests.
           This will be used as the default num_retries value when get() and
           put() are called.  Default 0.
+
+        :disk_cache_dir:
+          If specified, blocks read from Keep are also saved in this
+          directory, and blocks missing from the RAM block cache are
+          looked up there before asking Keep.  The directory can be
+          shared by several processes.  Default None (no disk cache).
+
+        :disk_cache_max:
+          The maximum total size, in bytes, of blocks kept in
+          disk_cache_dir.  Default 8GiB.
+
+        :hedge_delay:
+          If specified, GET requests are hedged: when a Keep service
+          has not answered after this many seconds, or after the 95th
+          percentile of recent GET latencies if that is shorter, the
+          same block is also requested from the next service in probe
+          order.  The first successful response is used and the other
+          request is aborted.  Default None (no hedging: services are
+          tried one at a time).
+
+        :curl_multi:
+          If true, run all Keep requests on a single I/O thread driving
+          a pycurl.CurlMulti (shared by every KeepClient in the process
+          that uses this option), and send the copies of each PUT
+          without starting writer threads.  Default False.
         """
         self.lock = threading.Lock()
         if proxy is None:
@@ -783,6 +1194,14 @@ class KeepClient(object):
             self.insecure = api_client.insecure
 
         self.block_cache = block_cache if block_cache else KeepBlockCache()
+        if disk_cache_dir:
+            if disk_cache_max is None:
+                self.disk_cache = arvados.diskcache.DiskBlockCache(disk_cache_dir)
+            else:
+                self.disk_cache = arvados.diskcache.DiskBlockCache(
+                    disk_cache_dir, cache_max=disk_cache_max)
+        else:
+            self.disk_cache = None
         self.timeout = timeout
         self.proxy_timeout = proxy_timeout
         self._user_agent_pool = queue.LifoQueue()
@@ -792,6 +1211,14 @@ class KeepClient(object):
         self.get_counter = Counter()
         self.hits_counter = Counter()
         self.misses_counter = Counter()
+        # Gauges updated by arvfile._BlockManager: number of background
+        # upload threads, and bytes waiting to be uploaded.
+        self.upload_threads_counter = Counter()
+        self.upload_pending_counter = Counter()
+        self.hedge_delay = hedge_delay
+        self._curl_multi = _curl_multi_loop() if curl_multi else None
+        self.hedged_counter = Counter()
+        self._get_latencies = collections.deque(maxlen=self.HEDGE_LATENCY_SAMPLES)
 
         if local_store:
             self.local_store = local_store
@@ -956,7 +1383,8 @@ class KeepClient(object):
                     upload_counter=self.upload_counter,
                     download_counter=self.download_counter,
                     headers=headers,
-                    insecure=self.insecure)
+                    insecure=self.insecure,
+                    curl_multi=self._curl_multi)
         return local_roots
 
     @staticmethod
@@ -977,18 +1405,140 @@ class KeepClient(object):
         else:
             return None
 
+    def _current_hedge_delay(self):
+        latencies = sorted(self._get_latencies)
+        if len(latencies) < self.HEDGE_LATENCY_MIN_SAMPLES:
+            return self.hedge_delay
+        return min(self.hedge_delay,
+                   latencies[int(len(latencies) * 0.95)])
+
+    def _get_hedged(self, services_to_try, locator, timeout):
+        """Fetch a block, trying more than one service at a time if needed.
+
+        Start a GET on the first service.  Each time the hedging delay
+        passes without a successful response (or a request fails),
+        start a GET on the next service.  Return the first block
+        received and abort the other requests, or return None if all
+        services fail.  An unexpected exception from a request is
+        raised here, as it would be without hedging.
+        """
+        results = queue.Queue()
+        def fetch(keep_service):
+            blob = error = None
+            try:
+                with timer.Timer() as t:
+                    blob = keep_service.get(locator, method="GET", timeout=timeout)
+                if blob is not None:
+                    self._get_latencies.append(t.secs)
+            except Exception as e:
+                error = e
+            finally:
+                # Always report back, so the caller doesn't wait forever.
+                results.put((keep_service, blob, error))
+
+        running = []
+        remaining = list(services_to_try)
+        blob = error = None
+        while remaining or len(running) > 0:
+            # Start another request: on the first pass, when the
+            # hedging delay has passed, or when a request has failed.
+            if remaining:
+                keep_service = remaining.pop(0)
+                if running:
+                    self.hedged_counter.add(1)
+                running.append(keep_service)
+                t = threading.Thread(target=fetch, args=(keep_service,))
+                t.daemon = True
+                t.start()
+            try:
+                keep_service, blob, error = results.get(
+                    timeout=self._current_hedge_delay() if remaining else None)
+            except queue.Empty:
+                continue
+            running.remove(keep_service)
+            if blob is not None or error is not None:
+                break
+        for keep_service in running:
+            keep_service.cancel()
+        if error is not None:
+            raise error
+        return blob
+
     def get_from_cache(self, loc):
         """Fetch a block only if is in the cache, otherwise return None."""
+        return _as_bytes(self._get_view_from_cache(loc))
+
+    def _get_view_from_cache(self, loc):
         slot = self.block_cache.get(loc)
         if slot is not None and slot.ready.is_set():
             return slot.get()
         else:
             return None
 
-    def refresh_signature(self, loc):
+    @retry.retry_method
+    def _get_view(self, loc_s, num_retries=None, cache_only=False):
+        # Like get() (or get_from_cache() if cache_only), but return a
+        # block found in the cache as is, which may be a read-only
+        # memoryview of the receive buffer, instead of a copy.  For
+        # callers that slice blocks and join the pieces, like
+        # ArvadosFile.readfrom.  Misses go through get(), so that
+        # local_store and other overrides of get() are honored.
+        try:
+            md5sum = KeepLocator(loc_s).md5sum
+        except ValueError:
+            md5sum = loc_s
+        blob = self._get_view_from_cache(md5sum)
+        if blob is not None or cache_only:
+            return blob
+        return self.get(loc_s, num_retries=num_retries)
+
+    def refresh_signature(self, loc, num_retries=None):
         """Ask Keep to get the remote block and return its local signature"""
         now = datetime.datetime.utcnow().isoformat("T") + 'Z'
-        return self.head(loc, headers={'X-Keep-Signature': 'local, {}'.format(now)})
+        return self.head(loc, headers={'X-Keep-Signature': 'local, {}'.format(now)},
+                         num_retries=num_retries)
+
+    def refresh_signatures(self, locators, max_workers=8, num_retries=None):
+        """Ask Keep to copy several remote blocks concurrently.
+
+        Return an iterator that yields a (locator, local_locator) pair
+        for each of `locators` as soon as its copy is done, in no
+        particular order.  Up to `max_workers` requests run at once,
+        each retried up to `num_retries` times like refresh_signature().
+
+        If a block can't be copied, the iterator raises the same error
+        refresh_signature() would, once that block's turn comes up; the
+        blocks that haven't been started yet are skipped.
+        """
+        locators = list(locators)
+        todo = queue.Queue()
+        for loc in locators:
+            todo.put(loc)
+        done = queue.Queue()
+        stop = threading.Event()
+        def refresh():
+            while not stop.is_set():
+                try:
+                    loc = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    done.put((loc, self.refresh_signature(loc, num_retries=num_retries), None))
+                except Exception as e:
+                    done.put((loc, None, e))
+
+        for _ in range(min(max_workers, len(locators))):
+            w = threading.Thread(target=refresh)
+            w.daemon = True
+            w.start()
+        try:
+            for _ in range(len(locators)):
+                loc, local_loc, err = done.get()
+                if err is not None:
+                    raise err
+                yield loc, local_loc
+        finally:
+            stop.set()
 
     @retry.retry_method
     def head(self, loc_s, **kwargs):
@@ -996,7 +1546,87 @@ class KeepClient(object):
 
     @retry.retry_method
     def get(self, loc_s, **kwargs):
-        return self._get_or_head(loc_s, method="GET", **kwargs)
+        return _as_bytes(self._get_or_head(loc_s, method="GET", **kwargs))
+
+    def get_many(self, locators, max_workers=4, max_bytes=(256 * 1024 * 1024),
+                 num_retries=None, request_id=None):
+        """Fetch several blocks from Keep concurrently.
+
+        Return an iterator that yields the content of each block in
+        the order given by `locators`.  Blocks are fetched ahead of
+        the consumer by up to `max_workers` threads, sharing the block
+        cache (so a block that is already cached or being fetched is
+        not requested again).
+
+        Arguments:
+        * locators: An iterable of locator strings.
+        * max_workers: The maximum number of blocks to fetch at once.
+        * max_bytes: The maximum number of bytes (estimated from the
+          locators' size hints) that may be fetched but not yet
+          consumed.  At least one block is always fetched.
+        * num_retries, request_id: Passed through to get().
+
+        If a block can't be read, the iterator raises the same error
+        get() would, when it reaches that block.
+        """
+        get_kwargs = {'num_retries': num_retries}
+        if request_id is not None:
+            get_kwargs['request_id'] = request_id
+        todo = queue.Queue()
+        def fetch():
+            while True:
+                task = todo.get()
+                if task is None:
+                    return
+                loc_s, done, result = task
+                try:
+                    result.append(self.get(loc_s, **get_kwargs))
+                except Exception as e:
+                    result.append(e)
+                finally:
+                    done.set()
+
+        workers = []
+        pending = collections.deque()
+        pending_bytes = 0
+        locators = iter(locators)
+        next_loc = next(locators, None)
+        try:
+            while next_loc is not None or pending:
+                # Queue more blocks while there is room in the budget.
+                while next_loc is not None:
+                    size = KeepLocator(next_loc).size
+                    if size is None:
+                        size = config.KEEP_BLOCK_SIZE
+                    if pending and pending_bytes + size > max_bytes:
+                        break
+                    if len(workers) < max_workers and len(workers) < len(pending) + 1:
+                        w = threading.Thread(target=fetch)
+                        w.daemon = True
+                        w.start()
+                        workers.append(w)
+                    done = threading.Event()
+                    result = []
+                    todo.put((next_loc, done, result))
+                    pending.append((size, done, result))
+                    pending_bytes += size
+                    next_loc = next(locators, None)
+                size, done, result = pending.popleft()
+                done.wait()
+                pending_bytes -= size
+                if isinstance(result[0], Exception):
+                    raise result[0]
+                yield result[0]
+        finally:
+            # If the consumer gave up early, skip the blocks that
+            # haven't been started yet, then stop the workers.
+            try:
+                while True:
+                    todo.get_nowait()
+            except queue.Empty:
+                pass
+            for _ in workers:
+                todo.put(None)
 
     def _get_or_head(self, loc_s, method="GET", num_retries=None, request_id=None, headers=None):
         """Get data from Keep.
@@ -1019,7 +1649,13 @@ class KeepClient(object):
           is set when the KeepClient is initialized.
         """
         if ',' in loc_s:
-            return ''.join(self.get(x) for x in loc_s.split(','))
+            if method == "HEAD":
+                for x in loc_s.split(','):
+                    self.head(x, num_retries=num_retries, request_id=request_id)
+                return True
+            return b''.join(self.get_many(loc_s.split(','),
+                                          num_retries=num_retries,
+                                          request_id=request_id))
 
         self.get_counter.add(1)
 
@@ -1036,6 +1672,11 @@ class KeepClient(object):
                         raise arvados.errors.KeepReadError(
                             "failed to read {}".format(loc_s))
                     return blob
+                if self.disk_cache is not None:
+                    blob = self.disk_cache.get(locator.md5sum)
+                    if blob is not None:
+                        self.hits_counter.add(1)
+                        return blob
 
             self.misses_counter.add(1)
 
@@ -1063,7 +1704,8 @@ class KeepClient(object):
                                        upload_counter=self.upload_counter,
                                        download_counter=self.download_counter,
                                        headers=headers,
-                                       insecure=self.insecure)
+                                       insecure=self.insecure,
+                                       curl_multi=self._curl_multi)
                 for root in hint_roots
             }
 
@@ -1092,19 +1734,23 @@ class KeepClient(object):
                 services_to_try = [roots_map[root]
                                    for root in sorted_roots
                                    if roots_map[root].usable()]
-                for keep_service in services_to_try:
-                    blob = keep_service.get(locator, method=method, timeout=self.current_timeout(num_retries-tries_left))
-                    if blob is not None:
-                        break
+                if method == "GET" and self.hedge_delay is not None:
+                    blob = self._get_hedged(services_to_try, locator, timeout=self.current_timeout(num_retries-tries_left))
+                else:
+                    for keep_service in services_to_try:
+                        blob = keep_service.get(locator, method=method, timeout=self.current_timeout(num_retries-tries_left))
+                        if blob is not None:
+                            break
                 loop.save_result((blob, len(services_to_try)))
 
             # Always cache the result, then return it if we succeeded.
             if loop.success():
+                if method == "GET" and self.disk_cache is not None:
+                    self.disk_cache.set(locator.md5sum, blob)
                 return blob
         finally:
             if slot is not None:
-                slot.set(blob)
-                self.block_cache.cap_cache()
+                self.block_cache.set(slot, blob)
 
         # Q: Including 403 is necessary for the Keep tests to continue
         # passing, but maybe they should expect KeepReadError instead?
@@ -1124,7 +1770,7 @@ class KeepClient(object):
                 "failed to read {} after {}".format(loc_s, loop.attempts_str()), service_errors, label="service")
 
     @retry.retry_method
-    def put(self, data, copies=2, num_retries=None, request_id=None):
+    def put(self, data, copies=2, num_retries=None, request_id=None, data_hash=None):
         """Save data in Keep.
 
         This method will get a list of Keep services from the API server, and
@@ -1141,14 +1787,17 @@ class KeepClient(object):
           *each* Keep server if it returns temporary failures, with
           exponential backoff.  The default value is set when the
           KeepClient is initialized.
+        * data_hash: The md5 hex digest of data, if the caller has
+          already computed it.  data is not hashed again.
         """
 
-        if not isinstance(data, bytes):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             data = data.encode()
 
         self.put_counter.add(1)
 
-        data_hash = hashlib.md5(data).hexdigest()
+        if data_hash is None:
+            data_hash = hashlib.md5(data).hexdigest()
         loc_s = data_hash + '+' + str(len(data))
         if copies < 1:
             return loc_s
@@ -1179,7 +1828,8 @@ class KeepClient(object):
                                                         data_hash=data_hash,
                                                         copies=copies - done,
                                                         max_service_replicas=self.max_replicas_per_service,
-                                                        timeout=self.current_timeout(num_retries - tries_left))
+                                                        timeout=self.current_timeout(num_retries - tries_left),
+                                                        curl_multi=self._curl_multi is not None)
             for service_root, ks in [(root, roots_map[root])
                                      for root in sorted_roots]:
                 if ks.finished():
@@ -1203,7 +1853,7 @@ class KeepClient(object):
                 "failed to write {} after {} (wanted {} copies but wrote {})".format(
                     data_hash, loop.attempts_str(), copies, writer_pool.done()), service_errors, label="service")
 
-    def local_store_put(self, data, copies=1, num_retries=None):
+    def local_store_put(self, data, copies=1, num_retries=None, data_hash=None):
         """A stub for put().
 
         This method is used in place of the real put() method when
@@ -1215,7 +1865,7 @@ class KeepClient(object):
 
         Data stored this way can be retrieved via local_store_get().
         """
-        md5 = hashlib.md5(data).hexdigest()
+        md5 = data_hash or hashlib.md5(data).hexdigest()
         locator = '%s+%d' % (md5, len(data))
         with open(os.path.join(self.local_store, md5 + '.tmp'), 'wb') as f:
             f.write(data)
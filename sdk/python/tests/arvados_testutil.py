@@ -172,6 +172,32 @@ def mock_keep_responses(body, *codes, **headers):
     cm.responses = responses
     return mock.patch('pycurl.Curl', cm)
 
+class FakeCurlByLocator(FakeCurl):
+    """FakeCurl that answers with the block whose hash is in the URL."""
+    def __init__(self, blocks):
+        super(FakeCurlByLocator, self).__init__(404)
+        self._blocks = blocks
+
+    def perform(self):
+        url = self.getopt(pycurl.URL)
+        if isinstance(url, bytes):
+            url = url.decode()
+        for block in self._blocks:
+            if url is not None and hashlib.md5(block).hexdigest() in url:
+                self._resp_code = 200
+                self._resp_body = block
+        return super(FakeCurlByLocator, self).perform()
+
+def mock_keep_blocks(*blocks):
+    """Patch pycurl so each request gets the block it asked for.
+
+    Unlike mock_keep_responses, this doesn't depend on the order in which
+    requests are made, so it suits concurrent fetches.
+    """
+    cm = mock.MagicMock()
+    cm.side_effect = lambda: mock.Mock(spec=FakeCurl, wraps=FakeCurlByLocator(blocks))
+    return mock.patch('pycurl.Curl', cm)
+
 
 class MockStreamReader(object):
     def __init__(self, name='.', *data):
@@ -0,0 +1,101 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from builtins import range
+import threading
+import time
+import unittest
+
+import arvados.arvfile
+import arvados.collection
+from .. import arvados_testutil as tutil
+
+class SlowKeep(object):
+    """Keep client stub that takes `latency` seconds to return a block."""
+    def __init__(self, blocks, latency):
+        self.blocks = blocks
+        self.latency = latency
+
+    def get(self, locator, num_retries=0):
+        time.sleep(self.latency)
+        return self.blocks[locator]
+
+    def get_from_cache(self, locator):
+        return None
+
+class ConcurrentReadBenchmark(unittest.TestCase):
+    FILES = 64
+    READS = 512
+    LATENCY = 0.002
+
+    def setUp(self):
+        blocks = {}
+        tokens = ['.']
+        files = []
+        for i in range(self.FILES):
+            data = '{:08}'.format(i).encode()
+            loc = tutil.str_keep_locator(data)
+            blocks[loc] = data
+            tokens.append(loc)
+            files.append('{}:{}:file{}.txt'.format(i * len(data), len(data), i))
+        manifest = ' '.join(tokens + files) + '\n'
+        blockmanager = arvados.arvfile._BlockManager(
+            SlowKeep(blocks, self.LATENCY), readahead_bytes=0)
+        self.coll = arvados.collection.Collection(
+            manifest, keep_client=blockmanager._keep, block_manager=blockmanager)
+
+    def tearDown(self):
+        self.coll.stop_threads()
+
+    def read_files(self, nthreads, busy_collection):
+        """Read files from nthreads threads, return reads per second.
+
+        If busy_collection is true, another thread holds the collection
+        lock most of the time, the way a slow flush or save would.
+        """
+        readers = [self.coll.open('file{}.txt'.format(i), 'rb')
+                   for i in range(self.FILES)]
+        stop = threading.Event()
+
+        def hog():
+            while not stop.is_set():
+                with self.coll.lock:
+                    time.sleep(0.05)
+                time.sleep(0.001)
+
+        def read(n):
+            for i in range(n, self.READS, nthreads):
+                r = readers[i % self.FILES]
+                self.assertEqual(8, len(r.readfrom(0, 8)))
+
+        if busy_collection:
+            hogger = threading.Thread(target=hog)
+            hogger.start()
+        threads = [threading.Thread(target=read, args=(n,))
+                   for n in range(nthreads)]
+        t0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        secs = time.time() - t0
+        stop.set()
+        if busy_collection:
+            hogger.join()
+        return self.READS / secs
+
+    def test_read_throughput(self):
+        for busy in (False, True):
+            for nthreads in (1, 4, 16):
+                print("Reads with {} threads{}: {:.0f} reads/s".format(
+                    nthreads, ", collection lock busy" if busy else "",
+                    self.read_files(nthreads, busy)))
+
+    def test_reads_proceed_while_collection_locked(self):
+        # Unlocked, 16 threads manage several thousand reads/s at 2ms
+        # per block.  A busy collection lock shouldn't stall them.
+        self.assertGreater(self.read_files(16, True), 1000)
@@ -0,0 +1,50 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from builtins import range
+import hashlib
+import time
+import unittest
+
+import arvados.keep
+from .performance_profiler import profiled
+
+class KeepBlockCacheBenchmark(unittest.TestCase):
+    SLOTS = 20000
+    BLOCK = b'x' * 1024
+
+    def setUp(self):
+        self.locators = [hashlib.md5(str(i).encode()).hexdigest()
+                         for i in range(self.SLOTS * 2)]
+        # Room for exactly SLOTS blocks, so every miss evicts one.
+        self.cache = arvados.keep.KeepBlockCache(
+            cache_max=self.SLOTS * len(self.BLOCK))
+        for loc in self.locators[:self.SLOTS]:
+            slot, _ = self.cache.reserve_cache(loc)
+            self.cache.set(slot, self.BLOCK)
+
+    def report(self, what, count, secs):
+        print("KeepBlockCache {} with {} slots: {:.2f} usec/op".format(
+            what, self.SLOTS, secs * 1e6 / count))
+
+    @profiled
+    def test_hit_latency(self):
+        t0 = time.time()
+        # Walk from the oldest slot so every hit also promotes.
+        for loc in self.locators[:self.SLOTS]:
+            self.assertIsNotNone(self.cache.get(loc))
+        self.report('hit', self.SLOTS, time.time() - t0)
+
+    @profiled
+    def test_miss_latency(self):
+        t0 = time.time()
+        for loc in self.locators[self.SLOTS:]:
+            slot, first = self.cache.reserve_cache(loc)
+            self.assertTrue(first)
+            self.cache.set(slot, self.BLOCK)
+        self.report('miss+evict', self.SLOTS, time.time() - t0)
+        self.assertIsNone(self.cache.get(self.locators[0]))
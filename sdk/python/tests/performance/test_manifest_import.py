@@ -0,0 +1,72 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from builtins import range
+import os
+import resource
+import time
+import unittest
+
+import arvados.collection
+from .performance_profiler import profiled
+
+def make_manifest(nfiles, files_per_stream=1000, blocks_per_stream=4):
+    """Return a manifest with nfiles small files spread over several streams."""
+    lines = []
+    for s in range(nfiles // files_per_stream):
+        tokens = ['./dir{}'.format(s)]
+        tokens.extend('{:032x}+67108864'.format(s * blocks_per_stream + b)
+                      for b in range(blocks_per_stream))
+        tokens.extend('{}:1000:file{}.txt'.format(f * 1000, f)
+                      for f in range(files_per_stream))
+        lines.append(' '.join(tokens))
+    return '\n'.join(lines) + '\n'
+
+class ManifestImportBenchmark(unittest.TestCase):
+    def import_manifest(self, nfiles):
+        manifest = make_manifest(nfiles)
+        t0 = time.time()
+        coll = arvados.collection.Collection(manifest)
+        secs = time.time() - t0
+        # ru_maxrss is in KiB on Linux.
+        print("Collection import with {} files: {:.2f} s, peak RSS {} MiB".format(
+            nfiles, secs, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+        self.assertEqual(nfiles // 1000, len(coll))
+        self.assertEqual(1000, coll.find('dir0/file999.txt').size())
+
+    @profiled
+    def test_import_10k_files(self):
+        self.import_manifest(10000)
+
+    @profiled
+    def test_import_100k_files(self):
+        self.import_manifest(100000)
+
+    @unittest.skipUnless(os.environ.get('ARVADOS_TEST_SLOW_BENCHMARKS'),
+                         "set ARVADOS_TEST_SLOW_BENCHMARKS to run")
+    def test_import_1m_files(self):
+        self.import_manifest(1000000)
+
+    def lazy_open_one_file(self, nfiles):
+        manifest = make_manifest(nfiles)
+        t0 = time.time()
+        coll = arvados.collection.Collection(manifest, lazy=True)
+        with coll.open('dir7/file999.txt', 'rb') as f:
+            self.assertEqual(1000, f.size())
+        secs = time.time() - t0
+        print("Lazy collection open of one file in {} files: {:.3f} s, peak RSS {} MiB".format(
+            nfiles, secs, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+        self.assertEqual(nfiles // 1000, len(coll))
+
+    @profiled
+    def test_lazy_open_one_file_in_100k_files(self):
+        self.lazy_open_one_file(100000)
+
+    @unittest.skipUnless(os.environ.get('ARVADOS_TEST_SLOW_BENCHMARKS'),
+                         "set ARVADOS_TEST_SLOW_BENCHMARKS to run")
+    def test_lazy_open_one_file_in_1m_files(self):
+        self.lazy_open_one_file(1000000)
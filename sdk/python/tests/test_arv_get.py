@@ -101,6 +101,38 @@ class ArvadosGetTestCase(run_test_server.TestCaseWithServers,
         with open(os.path.join(self.tempdir, "subdir", "baz.txt"), "r") as f:
             self.assertEqual("baz", f.read())
 
+    def test_get_multiple_files_with_threads(self):
+        r = self.run_get(["--threads", "4", "{}/".format(self.col_loc), self.tempdir])
+        self.assertEqual(0, r)
+        with open(os.path.join(self.tempdir, "foo.txt"), "r") as f:
+            self.assertEqual("foo", f.read())
+        with open(os.path.join(self.tempdir, "bar.txt"), "r") as f:
+            self.assertEqual("bar", f.read())
+        with open(os.path.join(self.tempdir, "subdir", "baz.txt"), "r") as f:
+            self.assertEqual("baz", f.read())
+
+    def test_get_with_threads_md5sum_and_skip_existing(self):
+        with open(os.path.join(self.tempdir, "foo.txt"), "w") as f:
+            f.write("another foo")
+        r = self.run_get(["--threads", "4", "--md5sum", "--skip-existing",
+                          "{}/".format(self.col_loc), self.tempdir])
+        self.assertEqual(0, r)
+        with open(os.path.join(self.tempdir, "foo.txt"), "r") as f:
+            self.assertEqual("another foo", f.read())
+        with open(os.path.join(self.tempdir, "subdir", "baz.txt"), "r") as f:
+            self.assertEqual("baz", f.read())
+        self.assertIn("37b51d194a7513e45b56f6524f2d51f2  ./bar.txt\n",
+                      self.stderr.getvalue())
+        self.assertIn("73feffa4b7f6bb68e44cf984c85f6e88  ./subdir/baz.txt\n",
+                      self.stderr.getvalue())
+        self.assertNotIn("foo.txt", self.stderr.getvalue())
+
+    def test_invalid_thread_count(self):
+        with tutil.redirected_streams(
+                stdout=tutil.StringIO, stderr=tutil.StringIO):
+            with self.assertRaises(SystemExit):
+                self.run_get(["--threads", "0", "{}/".format(self.col_loc), self.tempdir])
+
     def test_get_collection_unstripped_manifest(self):
         dummy_token = "+Axxxxxxx"
         # Get the collection manifest by UUID
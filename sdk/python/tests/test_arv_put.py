@@ -28,6 +28,7 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import uuid
@@ -359,6 +360,56 @@ class ArvPutUploadJobTest(run_test_server.TestCaseWithServers,
         cwriter.destroy_cache()
         self.assertEqual(1024*(1+2+3+4+5), cwriter.bytes_written)
 
+    def test_small_files_read_ahead_in_order(self):
+        manifests = []
+        for threads, small_file_size in [(1, 0), (4, 4096)]:
+            with mock.patch.multiple(arv_put.ArvPutUploadJob,
+                                     READ_THREADS=threads,
+                                     SMALL_FILE_SIZE=small_file_size):
+                cwriter = arv_put.ArvPutUploadJob([self.tempdir], resume=False)
+                cwriter.start(save_collection=False)
+                cwriter.destroy_cache()
+            self.assertEqual(1024*(1+2+3+4+5), cwriter.bytes_written)
+            manifests.append(cwriter.manifest_text())
+        self.assertEqual(manifests[0], manifests[1])
+
+    def test_fifo_not_read_ahead(self):
+        fifo = os.path.join(self.make_tmpdir(), 'fifo')
+        os.mkfifo(fifo)
+        data = b'x' * 10000
+        def feed():
+            with open(fifo, 'wb') as f:
+                f.write(data)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            with mock.patch.object(arv_put.ArvPutUploadJob, 'SMALL_FILE_SIZE', 4096), \
+                 mock.patch.object(arv_put.ArvPutUploadJob, '_write',
+                                   autospec=True,
+                                   side_effect=arv_put.ArvPutUploadJob._write) as mocked_write:
+                cwriter = arv_put.ArvPutUploadJob([fifo], use_cache=False, resume=False)
+                cwriter.start(save_collection=False)
+        finally:
+            feeder.join()
+        # The FIFO reports a size of zero, but it is streamed like a
+        # large file rather than read into memory whole.
+        self.assertTrue(mocked_write.called)
+        self.assertEqual(len(data), cwriter.bytes_written)
+
+    def test_small_file_grown_since_scan(self):
+        with mock.patch.object(arv_put.ArvPutUploadJob, 'SMALL_FILE_SIZE', 4096):
+            cwriter = arv_put.ArvPutUploadJob([self.tempdir], use_cache=False, resume=False)
+            # Grow a file after it was stat()ed as small.
+            real_check_file = cwriter._check_file
+            def check_file(source, filename, st):
+                if source == os.path.join(self.tempdir, '1'):
+                    with open(source, 'ab') as f:
+                        f.write(b'y' * 8192)
+                return real_check_file(source, filename, st)
+            cwriter._check_file = check_file
+            cwriter.start(save_collection=False)
+        self.assertEqual(1024*(1+2+3+4+5) + 8192, cwriter.bytes_written)
+
     def test_resume_large_file_upload(self):
         def wrapped_write(*args, **kwargs):
             data = args[1]
@@ -391,6 +442,43 @@ class ArvPutUploadJobTest(run_test_server.TestCaseWithServers,
         writer2.destroy_cache()
         del(self.writer)
 
+    def test_resume_from_journaled_checkpoint(self):
+        def wrapped_write(*args, **kwargs):
+            data = args[1]
+            if len(data) < arvados.config.KEEP_BLOCK_SIZE:
+                # Commit what was written so far, checkpoint without
+                # compacting the cache, then quit.
+                args[0].flush()
+                self.writer._update()
+                raise SystemExit("Simulated error")
+            # Write a snapshot for the journal records to follow.
+            self.writer._update()
+            return self.arvfile_write(*args, **kwargs)
+
+        with mock.patch('arvados.arvfile.ArvadosFileWriter.write',
+                        autospec=True) as mocked_write:
+            mocked_write.side_effect = wrapped_write
+            writer = arv_put.ArvPutUploadJob([self.large_file_name],
+                                             replication_desired=1)
+            # Only checkpoint from wrapped_write
+            writer._stop_checkpointer.set()
+            self.writer = writer
+            with self.assertRaises(SystemExit):
+                writer.start(save_collection=False)
+        with open(writer._cache_filename) as f:
+            self.assertEqual(2, len(f.readlines()))
+        writer2 = arv_put.ArvPutUploadJob([self.large_file_name],
+                                          replication_desired=1)
+        writer2.start(save_collection=False)
+        self.assertEqual(arvados.config.KEEP_BLOCK_SIZE, writer2.bytes_skipped)
+        self.assertEqual(os.path.getsize(self.large_file_name),
+                         writer2.bytes_written)
+        # The final checkpoint compacts the cache into a single snapshot.
+        with open(writer2._cache_filename) as f:
+            self.assertEqual(1, len(f.readlines()))
+        writer2.destroy_cache()
+        del(self.writer)
+
     # Test for bug #11002
     def test_graceful_exit_while_repacking_small_blocks(self):
         def wrapped_commit(*args, **kwargs):
@@ -611,6 +699,74 @@ class CachedManifestValidationTest(ArvadosBaseTestCase):
                     head_mock.assert_not_called()
 
 
+class ResumeCacheJournalTest(ArvadosBaseTestCase):
+    class MockedPut(arv_put.ArvPutUploadJob):
+        def __init__(self, cache_data):
+            self._cache_file = tutil.StringIO(cache_data)
+            self._snapshot_bytes = 0
+            self._journal_bytes = 0
+
+    def setUp(self):
+        super(ResumeCacheJournalTest, self).setUp()
+        self.snapshot = json.dumps({
+            'manifest': ". acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:foo\n",
+            'files': {'/tmp/foo': {'mtime': 1, 'size': 3}},
+        }) + '\n'
+        self.records = [json.dumps(r) + '\n' for r in [
+            {'files': {'/tmp/bar': {'mtime': 2, 'size': 3}},
+             'streams': {'bar': ". d41d8cd98f00b204e9800998ecf8427e+0 0:0:bar\n"}},
+            {'files': {'/tmp/bar': {'mtime': 2, 'size': 3}},
+             'streams': {'bar': ". 37b51d194a7513e45b56f6524f2d51f2+3 0:3:bar\n",
+                         'foo': None}},
+        ]]
+
+    def test_old_format_cache(self):
+        put_mock = self.MockedPut(self.snapshot.rstrip('\n'))
+        state = put_mock._load_state()
+        self.assertEqual(json.loads(self.snapshot), state)
+        # Nothing can be appended to it, so it gets rewritten.
+        self.assertEqual(0, put_mock._snapshot_bytes)
+
+    def test_journal_records_applied_in_order(self):
+        cache_data = self.snapshot + ''.join(self.records)
+        put_mock = self.MockedPut(cache_data)
+        state = put_mock._load_state()
+        self.assertEqual(['/tmp/bar', '/tmp/foo'], sorted(state['files']))
+        self.assertEqual(
+            {'bar': ". 37b51d194a7513e45b56f6524f2d51f2+3 0:3:bar\n",
+             'foo': None},
+            state['streams'])
+        self.assertEqual(len(self.snapshot), put_mock._snapshot_bytes)
+        self.assertEqual(len(cache_data) - len(self.snapshot),
+                         put_mock._journal_bytes)
+
+    def test_partial_last_record_ignored(self):
+        put_mock = self.MockedPut(
+            self.snapshot + self.records[0] + self.records[1][:20])
+        state = put_mock._load_state()
+        self.assertEqual(
+            {'bar': ". d41d8cd98f00b204e9800998ecf8427e+0 0:0:bar\n"},
+            state['streams'])
+        self.assertEqual(0, put_mock._snapshot_bytes)
+
+    def test_damaged_record_is_an_error(self):
+        put_mock = self.MockedPut(
+            self.snapshot + self.records[0][:20] + '\n' + self.records[1])
+        with self.assertRaises(ValueError):
+            put_mock._load_state()
+
+    def test_journaled_signatures_validated(self):
+        put_mock = self.MockedPut(self.snapshot + ''.join(self.records))
+        put_mock._state = put_mock._load_state()
+        put_mock._state['manifest'] = ''
+        put_mock._state['streams']['bar'] = ". 37b51d194a7513e45b56f6524f2d51f2+3+Asignature@{} 0:3:bar\n".format(
+            hex(int(time.time()) - 3600)[2:])
+        put_mock.logger = mock.MagicMock()
+        # All signatures expired: the journaled files are discarded too.
+        self.assertTrue(put_mock._cached_manifest_valid())
+        self.assertNotIn('streams', put_mock._state)
+
+
 class ArvadosExpectedBytesTest(ArvadosBaseTestCase):
     TEST_SIZE = os.path.getsize(__file__)
 
@@ -638,6 +794,70 @@ class ArvadosExpectedBytesTest(ArvadosBaseTestCase):
         self.assertIsNone(writer.bytes_expected)
 
 
+class ArvPutScanTreeTest(ArvadosBaseTestCase):
+    def setUp(self):
+        super(ArvPutScanTreeTest, self).setUp()
+        self.tree = self.make_tmpdir()
+        for path in ['b', 'a.txt', 'sub/z', 'sub/deeper/y.txt', 'sub2/x',
+                     'sub10/w']:
+            path = os.path.join(self.tree, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(path)
+        os.symlink(os.path.join(self.tree, 'sub2'),
+                   os.path.join(self.tree, 'sub', 'linkeddir'))
+        os.symlink(os.path.join(self.tree, 'b'),
+                   os.path.join(self.tree, 'linkedfile'))
+
+    def scan(self, **kwargs):
+        return [(os.path.relpath(path, self.tree), st.st_size)
+                for path, st in arv_put.scan_tree(self.tree, **kwargs)]
+
+    def test_walk_order(self):
+        expected = [(p, os.path.getsize(os.path.join(self.tree, p))) for p in [
+            'a.txt', 'b', 'linkedfile',
+            'sub/z', 'sub/deeper/y.txt', 'sub/linkeddir/x',
+            'sub10/w', 'sub2/x']]
+        # Whatever the amount of concurrency, the order is the same.
+        for threads, readahead in [(1, 1), (2, 1), (4, 64)]:
+            self.assertEqual(expected,
+                             self.scan(threads=threads, readahead=readahead))
+
+    def test_symlinks_not_followed(self):
+        self.assertEqual(
+            ['a.txt', 'b', 'sub/z', 'sub/deeper/y.txt', 'sub10/w', 'sub2/x'],
+            [p for p, _ in self.scan(follow_links=False)])
+
+    def test_exclusions(self):
+        self.assertEqual(
+            ['b', 'linkedfile', 'sub/z', 'sub/linkeddir/x', 'sub10/w'],
+            [p for p, _ in self.scan(exclude_paths=['*.txt', 'sub2'],
+                                     exclude_names=re.compile('^deeper$'))])
+
+    def test_unreadable_file_raises(self):
+        os.symlink(os.path.join(self.tree, 'nonexistent'),
+                   os.path.join(self.tree, 'brokenlink'))
+        with self.assertRaises(OSError):
+            self.scan()
+        # Not following symlinks, it isn't read at all.
+        self.assertEqual(6, len(self.scan(follow_links=False)))
+
+    def test_upload_list_follow(self):
+        upload_list = arv_put.FileUploadList()
+        got = []
+        follower = threading.Thread(
+            target=lambda: got.extend(upload_list.follow()))
+        follower.start()
+        upload_list.append(1)
+        upload_list.append(2)
+        self.assertTrue(follower.is_alive())
+        upload_list.close()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual([1, 2], got)
+
+
 class ArvadosPutReportTest(ArvadosBaseTestCase):
     def test_machine_progress(self):
         for count, total in [(0, 1), (0, None), (1, None), (235, 9283)]:
@@ -784,6 +1004,13 @@ class ArvadosPutTest(run_test_server.TestCaseWithServers,
                 [x[-1].get('copies') for x in put_mock.call_args_list],
                 [1, 4, 5])
 
+    def test_put_max_buffer(self):
+        with mock.patch('arvados.collection._BlockManager',
+                        wraps=arvados.arvfile._BlockManager) as bm_mock:
+            self.call_main_on_test_file(['--max-buffer', '128'])
+        self.assertEqual(128*1024*1024,
+                         bm_mock.call_args[1]['max_buffer_bytes'])
+
     def test_normalize(self):
         testfile1 = self.make_test_file()
         testfile2 = self.make_test_file()
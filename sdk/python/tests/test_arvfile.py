@@ -10,14 +10,20 @@ from builtins import object
 import bz2
 import datetime
 import gzip
+import hashlib
 import io
 import mock
 import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
 import unittest
 import time
 
 import arvados
-from arvados._ranges import Range
+from arvados._ranges import Range, SegmentList, locators_and_ranges, replace_range
 from arvados.keep import KeepLocator
 from arvados.collection import Collection, CollectionReader
 from arvados.arvfile import ArvadosFile, ArvadosFileReader
@@ -36,9 +42,12 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
         def get_from_cache(self, locator):
             self.requests.append(locator)
             return self.blocks.get(locator)
-        def put(self, data, num_retries=None, copies=None):
+        def put(self, data, num_retries=None, copies=None, data_hash=None):
+            data = bytes(data)
             pdh = tutil.str_keep_locator(data)
-            self.blocks[pdh] = bytes(data)
+            if data_hash is not None:
+                assert pdh.startswith(data_hash + '+')
+            self.blocks[pdh] = data
             return pdh
 
     class MockApi(object):
@@ -629,10 +638,25 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
             self.assertFalse(c.modified())
             self.assertEqual(b"01234567", keep.get("2e9ec317e197819358fbc43afca7d837+8"))
 
+    def test_manifest_text_with_buffer_blocks(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with Collection(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n", keep_client=keep, replication_desired=1) as c:
+            self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n",
+                             c.manifest_text(only_committed=True, normalize=True))
+            with c.open("count1.txt", "ab") as f:
+                f.write(b"a")
+                self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n",
+                                 c.manifest_text(only_committed=True))
+                f.flush()
+                self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0cc175b9c0f1b6a831c399e269772661+1 0:11:count1.txt\n",
+                                 c.manifest_text(only_committed=True))
+
 
 class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
     class MockParent(object):
         class MockBlockMgr(object):
+            readahead_bytes = arvados.arvfile._BlockManager.DEFAULT_READAHEAD_BYTES
+
             def __init__(self, blocks, nocache):
                 self.blocks = blocks
                 self.nocache = nocache
@@ -640,6 +664,9 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
             def block_prefetch(self, loc):
                 pass
 
+            def cancel_prefetch(self, loc):
+                pass
+
             def get_block_contents(self, loc, num_retries=0, cache_only=False):
                 if self.nocache and cache_only:
                     return None
@@ -653,6 +680,9 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
         def root_collection(self):
             return self
 
+        def _forget_stream_text(self):
+            pass
+
         def _my_block_manager(self):
             return ArvadosFileReaderTestCase.MockParent.MockBlockMgr(self.blocks, self.nocache)
 
@@ -700,6 +730,124 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
         self.assertIn("2e9ec317e197819358fbc43afca7d837+8", keep.requests)
         self.assertIn("e8dc4081b13434b45189a720b77b6818+8", keep.requests)
 
+    def test_readahead_follows_access_pattern(self):
+        blocks = [tutil.str_keep_locator(str(i)) for i in range(8)]
+        blockmanager = mock.MagicMock()
+        blockmanager.readahead_bytes = 4
+        blockmanager.get_block_contents.return_value = b"x"
+        parent = mock.MagicMock()
+        parent.root_collection.return_value.lock = arvados.arvfile.NoopLock()
+        parent._my_block_manager.return_value = blockmanager
+        af = ArvadosFile(parent, "count.txt",
+                         stream=[Range(loc, n, 1) for n, loc in enumerate(blocks)],
+                         segments=[Range(0, 0, 8)])
+
+        def prefetched(offset):
+            blockmanager.block_prefetch.reset_mock()
+            blockmanager.cancel_prefetch.reset_mock()
+            af.readfrom(offset, 1, 0)
+            return ([c[0][0] for c in blockmanager.block_prefetch.call_args_list],
+                    set(c[0][0] for c in blockmanager.cancel_prefetch.call_args_list))
+
+        # Sequential reads from the start grow the window to the budget,
+        # and each block is only requested once.
+        self.assertEqual((blocks[1:5], set()), prefetched(0))
+        self.assertEqual(([blocks[5]], {blocks[1]}), prefetched(1))
+        # Seeking away cancels outstanding prefetches and stops readahead.
+        self.assertEqual(([], set(blocks[2:6])), prefetched(7))
+        self.assertEqual(([], set()), prefetched(0))
+        # Reading sequentially again restarts it.
+        self.assertEqual((blocks[2:6], set()), prefetched(1))
+
+    def test_readahead_per_reader(self):
+        blocks = [tutil.str_keep_locator(str(i)) for i in range(16)]
+        blockmanager = mock.MagicMock()
+        blockmanager.readahead_bytes = 4
+        blockmanager.get_block_contents.return_value = b"x"
+        parent = mock.MagicMock()
+        parent.root_collection.return_value.lock = arvados.arvfile.NoopLock()
+        parent._my_block_manager.return_value = blockmanager
+        af = ArvadosFile(parent, "count.txt",
+                         stream=[Range(loc, n, 1) for n, loc in enumerate(blocks)],
+                         segments=[Range(0, 0, 16)])
+        r1 = ArvadosFileReader(af, mode="rb")
+        r2 = ArvadosFileReader(af, mode="rb")
+
+        def prefetched(reader, offset):
+            blockmanager.block_prefetch.reset_mock()
+            blockmanager.cancel_prefetch.reset_mock()
+            reader.readfrom(offset, 1)
+            return ([c[0][0] for c in blockmanager.block_prefetch.call_args_list],
+                    set(c[0][0] for c in blockmanager.cancel_prefetch.call_args_list))
+
+        # Interleaved sequential readers keep their own windows, and
+        # don't cancel each other's prefetches.
+        self.assertEqual((blocks[1:5], set()), prefetched(r1, 0))
+        self.assertEqual(([], set()), prefetched(r2, 8))
+        self.assertEqual((blocks[10:14], set()), prefetched(r2, 9))
+        self.assertEqual(([blocks[5]], {blocks[1]}), prefetched(r1, 1))
+        self.assertEqual(([blocks[14]], {blocks[10]}), prefetched(r2, 10))
+        # A reader seeking away only cancels its own prefetches.
+        self.assertEqual(([], set(blocks[2:6])), prefetched(r1, 15))
+        self.assertEqual(([blocks[15]], {blocks[11]}), prefetched(r2, 11))
+
+    def test_read_through_local_store(self):
+        local_store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_store)
+        keep = arvados.KeepClient(local_store=local_store)
+        loc = keep.put(b"01234567")
+        with Collection(". {} 0:8:count.txt\n".format(loc), keep_client=keep,
+                        replication_desired=1) as c:
+            with c.open("count.txt", "rb") as r:
+                self.assertEqual(b"01234567", r.read(8))
+
+    def test_readahead_does_not_cancel_unqueued_blocks(self):
+        blocks = [tutil.str_keep_locator(str(i)) for i in range(8)]
+        blockmanager = mock.MagicMock()
+        blockmanager.readahead_bytes = 4
+        blockmanager.get_block_contents.return_value = b"x"
+        # Every block is already cached, so nothing gets queued.
+        blockmanager.block_prefetch.return_value = False
+        parent = mock.MagicMock()
+        parent.root_collection.return_value.lock = arvados.arvfile.NoopLock()
+        parent._my_block_manager.return_value = blockmanager
+        af = ArvadosFile(parent, "count.txt",
+                         stream=[Range(loc, n, 1) for n, loc in enumerate(blocks)],
+                         segments=[Range(0, 0, 8)])
+        af.readfrom(0, 1, 0)
+        af.readfrom(1, 1, 0)
+        af.readfrom(7, 1, 0)
+        blockmanager.cancel_prefetch.assert_not_called()
+
+    def test_readahead_disabled(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({
+            "2e9ec317e197819358fbc43afca7d837+8": b"01234567",
+            "e8dc4081b13434b45189a720b77b6818+8": b"abcdefgh",
+        })
+        blockmanager = arvados.arvfile._BlockManager(keep, readahead_bytes=0)
+        with Collection(". 2e9ec317e197819358fbc43afca7d837+8 e8dc4081b13434b45189a720b77b6818+8 0:16:count.txt\n", keep_client=keep, block_manager=blockmanager) as c:
+            r = c.open("count.txt", "rb")
+            self.assertEqual(b"0123", r.read(4))
+        self.assertIn("2e9ec317e197819358fbc43afca7d837+8", keep.requests)
+        self.assertNotIn("e8dc4081b13434b45189a720b77b6818+8", keep.requests)
+
+    def test_read_while_collection_locked(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({
+            "2e9ec317e197819358fbc43afca7d837+8": b"01234567",
+        })
+        blockmanager = arvados.arvfile._BlockManager(keep)
+        with Collection(". 2e9ec317e197819358fbc43afca7d837+8 0:8:count.txt\n", keep_client=keep, block_manager=blockmanager) as c:
+            r = c.open("count.txt", "rb")
+            got = []
+            reader = threading.Thread(target=lambda: got.append((r.size(), r.read(8))))
+            with c.lock:
+                # Reading a file doesn't need the collection lock,
+                # which writers can hold for a long time.
+                reader.start()
+                reader.join(5)
+                self.assertFalse(reader.is_alive())
+        self.assertEqual([(8, b"01234567")], got)
+
     def test__eq__from_manifest(self):
         with Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt') as c1:
             with Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt') as c2:
@@ -791,6 +939,56 @@ class ArvadosFileTestCase(unittest.TestCase):
             self.assertFalse(f.permission_expired(a_month_ago))
 
 
+class SegmentListTestCase(unittest.TestCase):
+    def test_same_as_list(self):
+        rnd = random.Random(1)
+        segs = []
+        seglist = SegmentList()
+        for i in range(500):
+            size = len(segs) and segs[-1].range_start + segs[-1].range_size
+            start = rnd.randint(0, size)
+            length = rnd.randint(1, 20)
+            loc = "block{}".format(rnd.randint(0, 30))
+            offset = rnd.randint(0, 100)
+            replace_range(segs, start, length, loc, offset)
+            replace_range(seglist, start, length, loc, offset)
+            self.assertEqual(segs, list(seglist))
+            start = rnd.randint(0, size)
+            self.assertEqual(locators_and_ranges(segs, start, 30),
+                             locators_and_ranges(seglist, start, 30))
+        self.assertEqual(segs[-1].range_start + segs[-1].range_size, seglist.size())
+        self.assertEqual(set(r.locator for r in segs), seglist.locators())
+
+    def test_list_operations(self):
+        seglist = SegmentList([Range("a", 0, 10, 0), Range("b", 10, 5, 3)])
+        seglist.insert(1, Range("c", 10, 1, 1))
+        seglist[-1] = Range("b", 11, 4, 4)
+        self.assertEqual([Range("a", 0, 10, 0), Range("c", 10, 1, 1), Range("b", 11, 4, 4)],
+                         seglist[:])
+        del seglist[0]
+        self.assertEqual(2, len(seglist))
+        self.assertEqual(Range("c", 10, 1, 1), seglist[0])
+        with self.assertRaises(IndexError):
+            seglist[2]
+        # Ranges are copies.
+        seglist[0].locator = "d"
+        self.assertEqual("c", seglist[0].locator)
+
+    def test_replace_locators(self):
+        seglist = SegmentList([Range("a", 0, 10, 0), Range("b", 10, 5, 3), Range("a", 15, 5, 3)])
+        seglist.replace_locators({"a": "x"})
+        self.assertEqual(["x", "b", "x"], [r.locator for r in seglist])
+        seglist.append(Range("x", 20, 1, 0))
+        self.assertEqual(set(["x", "b"]), seglist.locators())
+
+    def test_unused_locators_dropped(self):
+        seglist = SegmentList()
+        for i in range(1000):
+            replace_range(seglist, 0, 10, "block{}".format(i), 0)
+        self.assertEqual(1, len(seglist))
+        self.assertLess(len(seglist._locators), 20)
+
+
 class BlockManagerTest(unittest.TestCase):
     def test_bufferblock_append(self):
         keep = ArvadosFileWriterTestCase.MockKeep({})
@@ -862,6 +1060,26 @@ class BlockManagerTest(unittest.TestCase):
             self.assertEqual(bufferblock.state(), arvados.arvfile._BufferBlock.COMMITTED)
             self.assertIsNone(bufferblock.buffer_view)
 
+    def test_bufferblock_commit_uses_running_hash(self):
+        mockkeep = mock.MagicMock()
+        with arvados.arvfile._BlockManager(mockkeep) as blockmanager:
+            bufferblock = blockmanager.alloc_bufferblock()
+            bufferblock.append("foo")
+            bufferblock.append("bar")
+            with mock.patch('hashlib.md5', side_effect=AssertionError("rehashed")):
+                blockmanager.commit_bufferblock(bufferblock, True)
+            args, kwargs = mockkeep.put.call_args
+            self.assertIsInstance(args[0], memoryview)
+            self.assertEqual(b"foobar", args[0].tobytes())
+            self.assertEqual("3858f62230ac3c915f300c664312c63f", kwargs['data_hash'])
+
+    def test_bufferblock_locator_without_append(self):
+        bufferblock = arvados.arvfile._BufferBlock("bufferblock0", 3, None)
+        bufferblock.write_pointer = 3
+        self.assertEqual(bufferblock.locator(), "693e9af84d3dfcc71e640e005bdc5e2e+3")
+        bufferblock.append("foo")
+        self.assertEqual(bufferblock.locator(), "%s+6" % hashlib.md5(b"\0\0\0foo").hexdigest())
+
     def test_bufferblock_commit_pending(self):
         # Test for bug #7225
         mockkeep = mock.MagicMock()
@@ -877,6 +1095,147 @@ class BlockManagerTest(unittest.TestCase):
             self.assertEqual(bufferblock.state(), arvados.arvfile._BufferBlock.COMMITTED)
 
 
+    def test_bufferblock_commit_backpressure(self):
+        mockkeep = mock.MagicMock()
+        uploading = threading.Event()
+        mockkeep.put.side_effect = lambda *args, **kwargs: uploading.wait()
+        with arvados.arvfile._BlockManager(mockkeep, max_buffer_bytes=4) as blockmanager:
+            bufferblock1 = blockmanager.alloc_bufferblock()
+            bufferblock1.append("foo")
+            bufferblock2 = blockmanager.alloc_bufferblock()
+            bufferblock2.append("bar")
+
+            blockmanager.commit_bufferblock(bufferblock1, False)
+            committer = threading.Thread(target=blockmanager.commit_bufferblock,
+                                         args=(bufferblock2, False))
+            committer.start()
+            committer.join(0.2)
+            self.assertTrue(committer.is_alive())
+            self.assertEqual(1, mockkeep.put.call_count)
+            self.assertEqual(3, blockmanager._put_pending_bytes)
+
+            uploading.set()
+            committer.join(5)
+            self.assertFalse(committer.is_alive())
+            blockmanager._put_queue.join()
+            self.assertEqual(0, blockmanager._put_pending_bytes)
+
+    def test_bufferblock_larger_budget_fills_put_threads(self):
+        mockkeep = mock.MagicMock()
+        uploading = threading.Event()
+        mockkeep.put.side_effect = lambda *args, **kwargs: uploading.wait()
+        with arvados.arvfile._BlockManager(mockkeep, put_threads=8, max_buffer_bytes=30) as blockmanager:
+            def commit_blocks():
+                for _ in range(10):
+                    bufferblock = blockmanager.alloc_bufferblock()
+                    bufferblock.append("foo")
+                    blockmanager.commit_bufferblock(bufferblock, False)
+            committer = threading.Thread(target=commit_blocks)
+            committer.daemon = True
+            committer.start()
+            try:
+                committer.join(0.5)
+                # Every thread has a block, and 2 more are queued.
+                self.assertFalse(committer.is_alive())
+                self.assertEqual(8, mockkeep.put.call_count)
+                self.assertEqual(30, blockmanager._put_pending_bytes)
+            finally:
+                uploading.set()
+            blockmanager._put_queue.join()
+
+    def test_collection_max_buffer_bytes(self):
+        c = Collection(api_client=mock.MagicMock(), keep_client=mock.MagicMock(),
+                       replication_desired=1, max_buffer_bytes=12345)
+        self.assertEqual(12345, c._my_block_manager().max_buffer_bytes)
+
+    def test_collection_default_max_buffer_bytes(self):
+        c = Collection(api_client=mock.MagicMock(), keep_client=mock.MagicMock(),
+                       replication_desired=1)
+        self.assertEqual(arvados.arvfile._BlockManager.DEFAULT_MAX_BUFFER_BYTES,
+                         c._my_block_manager().max_buffer_bytes)
+
+    def _adaptive_blockmanager(self, **kwargs):
+        keep = mock.MagicMock()
+        keep.upload_threads_counter = arvados.keep.Counter()
+        blockmanager = arvados.arvfile._BlockManager(keep, **kwargs)
+        blockmanager._put_queue = queue.Queue()
+        blockmanager._put_queue.put("waiting block")
+        blockmanager._put_threads = [threading.current_thread(), mock.MagicMock()]
+        def start_put_thread():
+            blockmanager._put_threads.append(mock.MagicMock())
+            keep.upload_threads_counter.add(1)
+        blockmanager._start_put_thread = start_put_thread
+        keep.upload_threads_counter.add(2)
+        return blockmanager
+
+    def _upload_round(self, blockmanager, now, elapsed):
+        if not isinstance(elapsed, list):
+            elapsed = [elapsed] * blockmanager.num_put_threads
+        with mock.patch('time.time', return_value=now):
+            return [blockmanager._put_block_done(2**20, e) for e in elapsed]
+
+    def test_put_threads_adapt_to_throughput(self):
+        blockmanager = self._adaptive_blockmanager()
+        self.assertEqual([False, False], self._upload_round(blockmanager, 10, 1.0))
+        self.assertEqual(3, blockmanager.num_put_threads)
+        self.assertEqual([False]*3, self._upload_round(blockmanager, 11, 1.0))
+        self.assertEqual(4, blockmanager.num_put_threads)
+        self.assertEqual(4, blockmanager._keep.upload_threads_counter.get())
+        # Throughput dropped with the extra thread: back off.
+        self.assertEqual([False]*3 + [True], self._upload_round(blockmanager, 14, 3.0))
+        self.assertEqual(3, blockmanager.num_put_threads)
+        self.assertEqual(3, len(blockmanager._put_threads))
+        self.assertEqual(3, blockmanager._keep.upload_threads_counter.get())
+
+    def test_put_threads_limited_by_buffer(self):
+        blockmanager = self._adaptive_blockmanager(max_buffer_bytes=3 * 2**20)
+        self._upload_round(blockmanager, 10, 1.0)
+        self.assertEqual(3, blockmanager.num_put_threads)
+        # A fourth thread would have no block to send.
+        self._upload_round(blockmanager, 11, 1.0)
+        self.assertEqual(3, blockmanager.num_put_threads)
+        self._upload_round(blockmanager, 12, 1.0)
+        self.assertEqual(3, blockmanager.num_put_threads)
+        self.assertEqual(3, blockmanager._keep.upload_threads_counter.get())
+
+    def test_put_threads_back_off_on_latency(self):
+        blockmanager = self._adaptive_blockmanager()
+        self._upload_round(blockmanager, 10, 1.0)
+        self.assertEqual(3, blockmanager.num_put_threads)
+        # Same throughput, but each block takes much longer.
+        self.assertEqual([False]*2 + [True], self._upload_round(blockmanager, 11.5, [1.5, 3.0, 3.0]))
+        self.assertEqual(2, blockmanager.num_put_threads)
+
+    def test_put_threads_fixed(self):
+        blockmanager = self._adaptive_blockmanager(put_threads=2)
+        self.assertEqual([False, False], self._upload_round(blockmanager, 10, 1.0))
+        self.assertEqual([False, False], self._upload_round(blockmanager, 11, 1.0))
+        self.assertEqual(2, blockmanager.num_put_threads)
+
+    def test_block_prefetch_dedup_and_cancel(self):
+        mockkeep = mock.MagicMock()
+        mockkeep.get_from_cache.return_value = None
+        fetching = threading.Event()
+        mockkeep.get.side_effect = lambda loc: fetching.wait()
+        with arvados.arvfile._BlockManager(mockkeep) as blockmanager:
+            blockmanager.num_get_threads = 1
+            queued = [blockmanager.block_prefetch("a")]
+            # Once "a" is being downloaded, later requests aren't queued.
+            deadline = time.time() + 5
+            while "a" not in blockmanager._prefetch_inflight and time.time() < deadline:
+                time.sleep(0.01)
+            for loc in ["a", "b", "b", "c", "c", "d"]:
+                queued.append(blockmanager.block_prefetch(loc))
+            blockmanager.cancel_prefetch("b")
+            blockmanager.cancel_prefetch("c")
+            blockmanager.cancel_prefetch("c")
+            blockmanager.cancel_prefetch("d")
+            fetching.set()
+            blockmanager._prefetch_queue.put(None)
+            blockmanager._prefetch_threads[0].join()
+        self.assertEqual([True, False, True, True, True, True, True], queued)
+        self.assertEqual([mock.call("a"), mock.call("b")], mockkeep.get.call_args_list)
+
     def test_bufferblock_commit_with_error(self):
         mockkeep = mock.MagicMock()
         mockkeep.put.side_effect = arvados.errors.KeepWriteError("fail")
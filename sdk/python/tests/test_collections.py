@@ -16,6 +16,8 @@ import sys
 import tempfile
 import datetime
 import ciso8601
+import functools
+import threading
 import time
 import unittest
 
@@ -930,6 +932,91 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         with self.assertRaises(arvados.errors.ArgumentError):
             self.assertEqual(m1, CollectionReader(m1))
 
+    def test_init_manifest_segments_across_blocks(self):
+        c = Collection(". acbd18db4cc2f85cedef654fccc4a4d8+3 d41d8cd98f00b204e9800998ecf8427e+0 e2fc714c4727ee9395f324cd2e7f331f+4 1:5:f.txt 0:0:empty.txt 6:1:f.txt\n")
+        self.assertEqual([Range("acbd18db4cc2f85cedef654fccc4a4d8+3", 0, 2, 1),
+                          Range("e2fc714c4727ee9395f324cd2e7f331f+4", 2, 3, 0),
+                          Range("e2fc714c4727ee9395f324cd2e7f331f+4", 5, 1, 3)],
+                         c["f.txt"].segments())
+        self.assertEqual([], c["empty.txt"].segments())
+
+    def test_init_manifest_with_bad_segment(self):
+        # Bypass the manifest validation done by the constructor.
+        for m in [". acbd18db4cc2f85cedef654fccc4a4d8+3 0:x:f.txt\n",
+                  ". acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:\n"]:
+            with self.assertRaises(arvados.errors.SyntaxError):
+                Collection()._import_manifest(m)
+
+    def test_lazy_load(self):
+        m = (". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+             "./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n"
+             "./a/b 781e5e245d69b566979b86e28d23f2c7+10 0:5:count3.txt\n"
+             "./c\\040d 781e5e245d69b566979b86e28d23f2c7+10 0:0:.\n"
+             "./a 781e5e245d69b566979b86e28d23f2c7+10 5:5:count2.txt\n")
+        c = Collection(m, lazy=True, keep_client=mock.MagicMock(), replication_desired=1)
+        events = []
+        c.subscribe(lambda *args: events.append(args))
+        self.assertTrue(c.committed())
+        self.assertEqual(15, c.find("a/count2.txt").size())
+        a = c.find("a")
+        self.assertNotIn("_items", a.find("b").__dict__)
+        self.assertNotIn("_items", c.find("c d").__dict__)
+        self.assertEqual([], events)
+        self.assertTrue(c.committed())
+        self.assertEqual(Collection(m, keep_client=mock.MagicMock(), replication_desired=1).portable_manifest_text(),
+                         c.portable_manifest_text())
+
+        c.rename("a/b/count3.txt", "c d/count3.txt")
+        self.assertFalse(c.committed())
+        self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+                         "./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt 5:5:count2.txt\n"
+                         "./a/b d41d8cd98f00b204e9800998ecf8427e+0 0:0:\\056\n"
+                         "./c\\040d 781e5e245d69b566979b86e28d23f2c7+10 0:5:count3.txt\n",
+                         c.portable_manifest_text())
+
+    def test_lazy_load_falls_back_to_full_import(self):
+        m = (". 781e5e245d69b566979b86e28d23f2c7+10 0:10:a/count1.txt\n"
+             "./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n")
+        c = Collection(m, lazy=True)
+        self.assertIn("_items", c.find("a").__dict__)
+        self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:a/count1.txt\n"
+                         "./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n",
+                         c.manifest_text(only_committed=True))
+
+    def test_lazy_load_reports_errors_on_access(self):
+        c = Collection(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+                       "./a 781e5e245d69b566979b86e28d23f2c7+10 0:x:count2.txt\n",
+                       lazy=True)
+        self.assertEqual(10, c.find("count1.txt").size())
+        with self.assertRaises(arvados.errors.SyntaxError):
+            c.find("a/count2.txt")
+
+    def test_manifest_text_reuses_unchanged_streams(self):
+        c = Collection(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+                       "./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n"
+                       "./b 781e5e245d69b566979b86e28d23f2c7+10 0:10:count3.txt\n",
+                       keep_client=mock.MagicMock(), replication_desired=1)
+        expect = c.manifest_text(normalize=True)
+        c.portable_manifest_text()
+        with mock.patch('arvados.collection.normalize_stream',
+                        wraps=arvados.collection.normalize_stream) as ns:
+            self.assertEqual(expect, c.manifest_text(normalize=True))
+            self.assertEqual(0, ns.call_count)
+
+            c.find("a/count2.txt").truncate(5)
+            self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+                             "./a 781e5e245d69b566979b86e28d23f2c7+10 0:5:count2.txt\n"
+                             "./b 781e5e245d69b566979b86e28d23f2c7+10 0:10:count3.txt\n",
+                             c.manifest_text())
+            self.assertEqual(["./a"], [args[0][0] for args in ns.call_args_list])
+
+            c.portable_manifest_text()
+            ns.reset_mock()
+            c.rename("b/count3.txt", "b/count4.txt")
+            self.assertIn("0:10:count4.txt", c.portable_manifest_text())
+            self.assertIn("0:10:count4.txt", c.manifest_text())
+            self.assertEqual(["./b", "./b"], [args[0][0] for args in ns.call_args_list])
+
     def test_remove(self):
         c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt 0:10:count2.txt\n')
         self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt 0:10:count2.txt\n", c.portable_manifest_text())
@@ -1081,6 +1168,107 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         c1.apply(d)
         self.assertEqual(c1.portable_manifest_text(), c2.portable_manifest_text())
 
+    def test_diff_same_subcollection(self):
+        kwargs = {'keep_client': mock.MagicMock(), 'replication_desired': 1}
+        c1 = Collection(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+                        "./sub 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n"
+                        "./sub/deeper 781e5e245d69b566979b86e28d23f2c7+10 0:10:count3.txt\n",
+                        **kwargs)
+        c2 = CollectionReader(". 781e5e245d69b566979b86e28d23f2c7+10+Affffffffffffffffffffffffffffffffffffffff@ffffffff 0:10:count1.txt\n"
+                              "./sub 781e5e245d69b566979b86e28d23f2c7+10+Affffffffffffffffffffffffffffffffffffffff@ffffffff 0:10:count2.txt\n"
+                              "./sub/deeper 781e5e245d69b566979b86e28d23f2c7+10+Affffffffffffffffffffffffffffffffffffffff@ffffffff 0:10:count3.txt\n",
+                              **kwargs)
+        d = c1.diff(c2, holding_collection=Collection(**kwargs))
+        self.assertEqual(d, [('tok', './count1.txt', c1["count1.txt"], c2["count1.txt"]),
+                             ('tok', './sub', c2["sub"], c2["sub"])])
+        self.assertIs(c2["sub"], d[1][2])
+
+        c1.apply(d)
+        self.assertEqual(c2.manifest_text(normalize=True), c1.manifest_text(only_committed=True))
+
+    def test_content_digest_follows_changes(self):
+        m = ("./sub 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n"
+             "./sub/deeper 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n")
+        c1 = Collection(m, keep_client=mock.MagicMock(), replication_desired=1)
+        c2 = Collection(m.replace("+10 ", "+10+Affffffffffffffffffffffffffffffffffffffff@ffffffff "),
+                        keep_client=mock.MagicMock(), replication_desired=1)
+        self.assertEqual(c1, c2)
+        self.assertIsNotNone(c1._digest)
+        f = c1.find("sub/deeper/count2.txt")
+        f.truncate(8)
+        self.assertIsNone(c1._digest)
+        self.assertNotEqual(c1, c2)
+        f.truncate(5)
+        self.assertNotEqual(c1, c2)
+        c2.find("sub/deeper/count2.txt").truncate(5)
+        self.assertEqual(c1, c2)
+        c2.rename("sub/count1.txt", "sub/count3.txt")
+        self.assertNotEqual(c1, c2)
+
+    def test_copy_remote_blocks_without_lock(self):
+        remote_locs = ["{:032x}+3+Remote-{}@abcdef01".format(i, "a" * 40) for i in range(3)]
+        keep = mock.MagicMock()
+        keep.refresh_signatures = functools.partial(arvados.KeepClient.refresh_signatures, keep)
+        c = Collection(". {} {} 0:6:f1.txt\n"
+                       "./sub {} {} 0:6:f2.txt\n".format(remote_locs[0], remote_locs[1],
+                                                       remote_locs[1], remote_locs[2]),
+                       keep_client=keep, replication_desired=1)
+        lock_free = []
+        def try_lock():
+            if c.lock.acquire(False):
+                c.lock.release()
+                lock_free.append(True)
+            else:
+                lock_free.append(False)
+        def refresh(loc, num_retries=None):
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            return loc.replace("+Remote-" + "a" * 40, "+A" + "b" * 40)
+        keep.refresh_signature.side_effect = refresh
+        c._copy_remote_blocks()
+        self.assertEqual(sorted(remote_locs),
+                         sorted(args[0] for args, _ in keep.refresh_signature.call_args_list))
+        self.assertEqual([True] * 3, lock_free)
+        self.assertNotIn("+Remote-", c.manifest_text(only_committed=True))
+        self.assertEqual(4, c.manifest_text(only_committed=True).count("+A" + "b" * 40))
+        self.assertFalse(c.committed())
+
+    def test_copy_remote_blocks_after_manifest_text(self):
+        remote_loc = "781e5e245d69b566979b86e28d23f2c7+10+Remote-{}@abcdef01".format("a" * 40)
+        keep = mock.MagicMock()
+        keep.refresh_signatures = functools.partial(arvados.KeepClient.refresh_signatures, keep)
+        keep.refresh_signature.side_effect = lambda loc, num_retries=None: loc.replace("+Remote-" + "a" * 40, "+A" + "b" * 40)
+        api = mock.MagicMock()
+        c = Collection(". 5348b82a029fd9e971a811ce1f71360b+43 0:10:count2.txt\n"
+                       "./sub {} 0:10:count1.txt\n".format(remote_loc),
+                       api_client=api, keep_client=keep, replication_desired=1)
+        c.remove("count2.txt")
+        # Cache the stream text with the remote locator in it.
+        self.assertIn("+Remote-", c.manifest_text())
+        self.assertIsNotNone(c.find("sub")._stream_text)
+        c.save_new()
+        _, kwargs = api.collections().create.call_args
+        self.assertNotIn("+R", kwargs["body"]["manifest_text"])
+        self.assertIn("+A" + "b" * 40, kwargs["body"]["manifest_text"])
+
+    def test_update_unchanged_keeps_caches(self):
+        def manifest(sig):
+            return (". 781e5e245d69b566979b86e28d23f2c7+10+A{0}@abcdef01 0:10:count1.txt\n"
+                    "./sub 5348b82a029fd9e971a811ce1f71360b+43+A{0}@abcdef01 0:10:count2.txt\n").format(sig * 40)
+        c = Collection(manifest("a"), api_client=mock.MagicMock(), keep_client=mock.MagicMock())
+        self.assertTrue(c.committed())
+        c.manifest_text(normalize=True)
+        stream_text = c.find("sub")._stream_text
+        self.assertIsNotNone(stream_text)
+        c.update(other=CollectionReader(manifest("a")))
+        self.assertTrue(c.committed())
+        self.assertIs(stream_text, c.find("sub")._stream_text)
+        # New signatures are picked up, but the contents haven't changed.
+        c.update(other=CollectionReader(manifest("b")))
+        self.assertTrue(c.committed())
+        self.assertEqual(manifest("b"), c.manifest_text())
+
     def test_diff_mod(self):
         c1 = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n')
         c2 = Collection('. 5348b82a029fd9e971a811ce1f71360b+43 0:10:count1.txt\n')
@@ -0,0 +1,110 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+
+import hashlib
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import arvados
+import arvados.diskcache
+from . import arvados_testutil as tutil
+
+
+class DiskBlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def put(self, cache, data):
+        md5 = hashlib.md5(data).hexdigest()
+        cache.set(md5, data)
+        return md5
+
+    def test_get_after_set(self):
+        cache = arvados.diskcache.DiskBlockCache(self._dir)
+        md5 = self.put(cache, b'foo')
+        self.assertEqual(b'foo', cache.get(md5))
+        # Another cache using the same directory sees the block.
+        other = arvados.diskcache.DiskBlockCache(self._dir)
+        self.assertEqual(b'foo', other.get(md5))
+
+    def test_miss(self):
+        cache = arvados.diskcache.DiskBlockCache(self._dir)
+        self.assertIsNone(cache.get(hashlib.md5(b'foo').hexdigest()))
+
+    def test_corrupt_block_discarded(self):
+        cache = arvados.diskcache.DiskBlockCache(self._dir)
+        md5 = self.put(cache, b'foo')
+        with open(cache._filename(md5), 'wb') as f:
+            f.write(b'bar')
+        self.assertIsNone(cache.get(md5))
+        self.assertFalse(os.path.exists(cache._filename(md5)))
+
+    def test_evict_least_recently_used(self):
+        cache = arvados.diskcache.DiskBlockCache(self._dir, cache_max=7)
+        old = self.put(cache, b'aaa')
+        new = self.put(cache, b'bbb')
+        past = time.time() - 60
+        os.utime(cache._filename(new), (past, past))
+        os.utime(cache._filename(old), (past - 60, past - 60))
+        # Reading 'old' makes it the most recently used block.
+        self.assertEqual(b'aaa', cache.get(old))
+        newest = self.put(cache, b'ccc')
+        self.assertIsNone(cache.get(new))
+        self.assertEqual(b'aaa', cache.get(old))
+        self.assertEqual(b'ccc', cache.get(newest))
+
+    def test_evict_to_low_watermark(self):
+        cache = arvados.diskcache.DiskBlockCache(self._dir, cache_max=100)
+        blocks = [self.put(cache, b'%02d%s' % (i, b'x' * 8)) for i in range(10)]
+        for i, md5 in enumerate(blocks):
+            past = time.time() - 100 + i
+            os.utime(cache._filename(md5), (past, past))
+        with mock.patch.object(cache, '_cap', wraps=cache._cap) as cap_mock:
+            newest = self.put(cache, b'10' + b'x' * 8)
+            self.assertEqual(1, cap_mock.call_count)
+            # Eviction made room for more blocks without a rescan.
+            self.put(cache, b'11' + b'x' * 8)
+            self.assertEqual(1, cap_mock.call_count)
+        self.assertIsNone(cache.get(blocks[0]))
+        self.assertIsNone(cache.get(blocks[1]))
+        self.assertIsNotNone(cache.get(blocks[2]))
+        self.assertIsNotNone(cache.get(newest))
+        self.assertEqual(100, cache._cache_size)
+
+
+class KeepClientDiskCacheTest(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.data = b'xyzzy'
+        self.locator = hashlib.md5(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def keep_client(self):
+        return arvados.KeepClient(api_client=self.mock_keep_services(count=2),
+                                  disk_cache_dir=self._dir)
+
+    def test_disk_cache_shared_between_clients(self):
+        with tutil.mock_keep_responses(self.data, 200) as req_mock:
+            self.assertEqual(self.data, self.keep_client().get(self.locator))
+        self.assertEqual(1, req_mock.call_count)
+        with tutil.mock_keep_responses(self.data, 200) as req_mock:
+            self.assertEqual(self.data, self.keep_client().get(self.locator))
+        self.assertEqual(0, req_mock.call_count)
+
+    def test_head_does_not_use_disk_cache(self):
+        with tutil.mock_keep_responses(self.data, 200, 200) as req_mock:
+            self.keep_client().get(self.locator)
+            self.keep_client().head(self.locator)
+        self.assertEqual(2, req_mock.call_count)
@@ -17,6 +17,7 @@ import random
 import re
 import socket
 import sys
+import threading
 import time
 import unittest
 import urllib.parse
@@ -296,6 +297,30 @@ class KeepClientServiceTestCase(unittest.TestCase, tutil.ApiClientMock):
             self.assertEqual("HEAD", kwargs['method'])
             self.assertIn('X-Keep-Signature', kwargs['headers'])
 
+    def test_refresh_signatures(self):
+        keep_client = arvados.KeepClient(api_client=self.mock_keep_services(count=1))
+        lock = threading.Lock()
+        running = [0, 0]
+        def refresh(loc, num_retries=None):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            if loc == 'bad':
+                raise arvados.errors.KeepReadError(loc)
+            return loc + '+local'
+        remote_locs = ['remote{}'.format(i) for i in range(20)]
+        with mock.patch.object(keep_client, 'refresh_signature', side_effect=refresh):
+            self.assertEqual(
+                {loc: loc + '+local' for loc in remote_locs},
+                dict(keep_client.refresh_signatures(remote_locs, max_workers=4)))
+            self.assertLessEqual(running[1], 4)
+            self.assertGreater(running[1], 1)
+            with self.assertRaises(arvados.errors.KeepReadError):
+                list(keep_client.refresh_signatures(['remote0', 'bad']))
+
     # test_*_timeout verify that KeepClient instructs pycurl to use
     # the appropriate connection and read timeouts. They don't care
     # whether pycurl actually exhibits the expected timeout behavior
@@ -533,6 +558,223 @@ class KeepClientCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
         self.assertNotEqual(head_resp, get_resp)
 
 
+class KeepBlockCacheTestCase(unittest.TestCase):
+    def fill(self, cache, locator, data):
+        slot, first = cache.reserve_cache(locator)
+        self.assertTrue(first)
+        cache.set(slot, data)
+        return slot
+
+    def test_evict_least_recently_used(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=3)
+        self.fill(cache, 'a', b'a')
+        self.fill(cache, 'b', b'b')
+        self.fill(cache, 'c', b'c')
+        # Touch 'a' so 'b' becomes the oldest slot.
+        self.assertEqual(b'a', cache.get('a').get())
+        self.fill(cache, 'd', b'd')
+        self.assertIsNone(cache.get('b'))
+        for loc in ['a', 'c', 'd']:
+            self.assertEqual(loc.encode(), cache.get(loc).get())
+
+    def test_reserve_returns_existing_slot(self):
+        cache = arvados.keep.KeepBlockCache()
+        slot = self.fill(cache, 'a', b'foo')
+        self.assertEqual((slot, False), cache.reserve_cache('a'))
+
+    def test_pending_slots_are_not_evicted(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=2)
+        pending, _ = cache.reserve_cache('a')
+        self.fill(cache, 'b', b'bb')
+        self.fill(cache, 'c', b'cc')
+        self.assertIs(pending, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        cache.set(pending, b'aa')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(b'aa', cache.get('a').get())
+
+    def test_failed_slot_is_dropped(self):
+        cache = arvados.keep.KeepBlockCache()
+        slot, _ = cache.reserve_cache('a')
+        cache.set(slot, None)
+        self.assertIsNone(slot.get())
+        self.assertIsNone(cache.get('a'))
+        _, first = cache.reserve_cache('a')
+        self.assertTrue(first)
+
+
+class KeepResponseBufferTestCase(unittest.TestCase):
+    def check(self, size_hint, chunks):
+        buf = arvados.keep._ResponseBuffer(size_hint)
+        for chunk in chunks:
+            buf.write(chunk)
+        data = b''.join(chunks)
+        self.assertEqual(data, buf.getvalue().tobytes())
+        self.assertEqual(hashlib.md5(data).hexdigest(), buf.md5())
+        self.assertTrue(buf.getvalue().readonly)
+
+    def test_exact_size_hint(self):
+        self.check(6, [b'foo', b'bar'])
+
+    def test_short_size_hint(self):
+        self.check(2, [b'foo', b'bar'])
+
+    def test_long_size_hint(self):
+        self.check(100, [b'foo', b'bar'])
+
+    def test_no_size_hint(self):
+        self.check(None, [b'foo', b'bar'])
+
+    @mock.patch('arvados.KeepClient.KeepService._get_user_agent')
+    def test_get_view_of_received_data(self, ua_mock):
+        api_client = tutil.ApiClientMock().mock_keep_services(count=1)
+        body = b'foobar'
+        loc = tutil.str_keep_locator(body)
+        ua_mock.return_value = tutil.FakeCurl.make(code=200, body=body)
+        kc = arvados.KeepClient(api_client=api_client)
+        self.assertEqual(body, kc._get_view(loc))
+        # Once the block is cached, it is returned without a copy.
+        blob = kc._get_view(loc)
+        self.assertIsInstance(blob, memoryview)
+        self.assertEqual(body, blob)
+        md5 = hashlib.md5(body).hexdigest()
+        self.assertIsInstance(kc._get_view(loc, cache_only=True), memoryview)
+        # The public methods still return bytes.
+        self.assertIsInstance(kc.get(loc), bytes)
+        self.assertEqual(body, kc.get(loc))
+        self.assertIsInstance(kc.get_from_cache(md5), bytes)
+
+
+class KeepClientHedgedGetTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=3)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client,
+                                              hedge_delay=0.05)
+        self.data = b'xyzzy'
+        self.locator = '1271ed5ef305aadabc605b1609e24c52'
+        self.roots = self.keep_client.weighted_service_roots(
+            arvados.KeepLocator(self.locator))
+        self.cancelled = []
+
+    def fake_get(self, slow_roots):
+        def get(keep_service, locator, method="GET", timeout=None):
+            if keep_service.root in slow_roots:
+                # Wait for KeepClient to give up on this service.
+                for _ in range(500):
+                    if keep_service._cancelled:
+                        self.cancelled.append(keep_service.root)
+                        return None
+                    time.sleep(0.01)
+            return self.data
+        return get
+
+    def test_hedge_after_delay(self):
+        with mock.patch('arvados.KeepClient.KeepService.get', autospec=True,
+                        side_effect=self.fake_get(self.roots[:1])) as get_mock:
+            self.assertEqual(self.data, self.keep_client.get(self.locator))
+            for _ in range(100):
+                if self.cancelled:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(2, get_mock.call_count)
+        self.assertEqual(self.roots[:1], self.cancelled)
+        self.assertEqual(1, self.keep_client.hedged_counter.get())
+
+    def test_no_hedge_when_first_service_is_fast(self):
+        with mock.patch('arvados.KeepClient.KeepService.get', autospec=True,
+                        side_effect=self.fake_get([])) as get_mock:
+            self.assertEqual(self.data, self.keep_client.get(self.locator))
+        self.assertEqual(1, get_mock.call_count)
+        self.assertEqual(0, self.keep_client.hedged_counter.get())
+
+    def test_next_service_after_failure(self):
+        with tutil.mock_keep_responses(self.data, 500, 200) as req_mock:
+            self.assertEqual(self.data, self.keep_client.get(self.locator))
+        self.assertEqual(2, req_mock.call_count)
+
+    def test_error_when_all_services_fail(self):
+        with tutil.mock_keep_responses(self.data, 500, 500, 500):
+            with self.assertRaises(arvados.errors.KeepReadError):
+                self.keep_client.get(self.locator)
+
+    def test_error_raised_from_request_thread(self):
+        def get(keep_service, locator, method="GET", timeout=None):
+            raise ValueError("unexpected")
+        with mock.patch('arvados.KeepClient.KeepService.get', autospec=True,
+                        side_effect=get):
+            result = []
+            def fetch():
+                try:
+                    self.keep_client.get(self.locator, num_retries=0)
+                except Exception as e:
+                    result.append(e)
+            fetcher = threading.Thread(target=fetch)
+            fetcher.daemon = True
+            fetcher.start()
+            fetcher.join(5)
+        self.assertFalse(fetcher.is_alive())
+        self.assertIsInstance(result[0], ValueError)
+
+    def test_delay_uses_recent_latency(self):
+        self.keep_client.hedge_delay = 1
+        self.keep_client._get_latencies.extend([0.01] * 100)
+        self.assertEqual(0.01, self.keep_client._current_hedge_delay())
+        self.keep_client._get_latencies.extend([5] * 100)
+        self.assertEqual(1, self.keep_client._current_hedge_delay())
+
+
+class KeepClientGetManyTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.blocks = [str(i).encode() * 10 for i in range(10)]
+        self.locators = [tutil.str_keep_locator(b) for b in self.blocks]
+
+    def fake_get(self, loc_s, **kwargs):
+        return self.blocks[self.locators.index(loc_s)]
+
+    def test_blocks_in_order(self):
+        with mock.patch.object(self.keep_client, 'get',
+                               side_effect=self.fake_get) as get_mock:
+            got = list(self.keep_client.get_many(self.locators, max_workers=3))
+        self.assertEqual(self.blocks, got)
+        self.assertEqual(len(self.blocks), get_mock.call_count)
+
+    def test_outstanding_bytes_limit(self):
+        started = []
+        def get(loc_s, **kwargs):
+            started.append(loc_s)
+            return self.fake_get(loc_s)
+        with mock.patch.object(self.keep_client, 'get', side_effect=get):
+            # Each block is 10 bytes, so with a 10-byte budget
+            # only one block can be fetched ahead of the consumer.
+            blocks = self.keep_client.get_many(self.locators, max_bytes=10)
+            for i, block in enumerate(blocks):
+                self.assertEqual(self.blocks[i], block)
+                self.assertLessEqual(len(started), i + 2)
+
+    def test_error_raised_in_order(self):
+        def get(loc_s, **kwargs):
+            if loc_s == self.locators[2]:
+                raise arvados.errors.KeepReadError(loc_s)
+            return self.fake_get(loc_s)
+        with mock.patch.object(self.keep_client, 'get', side_effect=get):
+            blocks = self.keep_client.get_many(self.locators)
+            self.assertEqual(self.blocks[0], next(blocks))
+            self.assertEqual(self.blocks[1], next(blocks))
+            with self.assertRaises(arvados.errors.KeepReadError):
+                next(blocks)
+
+    def test_comma_separated_get(self):
+        # The blocks are fetched concurrently, so answer each request
+        # by locator and check they are joined in locator order.
+        data = [b'foo', b'bar', b'baz']
+        with tutil.mock_keep_blocks(*data):
+            got = self.keep_client.get(','.join(
+                tutil.str_keep_locator(d) for d in data))
+        self.assertEqual(b'foobarbaz', got)
+
+
 @tutil.skip_sleep
 class KeepXRequestIdTestCase(unittest.TestCase, tutil.ApiClientMock):
     def setUp(self):
@@ -901,6 +1143,71 @@ class KeepClientTimeout(keepstub.StubKeepServers, unittest.TestCase):
                 kc.put(self.DATA, copies=1, num_retries=0)
 
 
+class KeepClientCurlMultiTestCase(keepstub.StubKeepServers, unittest.TestCase):
+    DATA = b'x'*2**11
+
+    def keepClient(self):
+        return arvados.KeepClient(api_client=self.api_client,
+                                  curl_multi=True)
+
+    def test_put_get(self):
+        with mock.patch.object(arvados.KeepClient.KeepWriterThread,
+                               'start') as start_mock:
+            loc = self.keepClient().put(self.DATA, copies=1)
+        start_mock.assert_not_called()
+        self.assertEqual(self.DATA, self.keepClient().get(loc))
+
+    def test_concurrent_gets(self):
+        blocks = [str(i).encode() * 100 for i in range(8)]
+        kc = self.keepClient()
+        locators = [kc.put(b, copies=1) for b in blocks]
+        self.assertEqual(blocks, list(arvados.KeepClient(
+            api_client=self.api_client, curl_multi=True).get_many(locators, max_workers=8)))
+
+    def test_put_error(self):
+        self.api_client = self.mock_keep_services(
+            count=1,
+            service_host='240.0.0.0',
+        )
+        kc = arvados.KeepClient(api_client=self.api_client,
+                                curl_multi=True, timeout=(0.1, 1))
+        with self.assertRaises(arvados.errors.KeepWriteError):
+            kc.put(self.DATA, copies=1, num_retries=0)
+
+
+class CurlMultiLoopTestCase(unittest.TestCase):
+    def perform_in_thread(self, loop, url):
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+        result = []
+        def target():
+            try:
+                loop.perform(curl)
+                result.append(None)
+            except Exception as e:
+                result.append(e)
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive(), "perform() did not return")
+        return result[0]
+
+    def test_perform_local_file(self):
+        loop = arvados.keep.CurlMultiLoop()
+        self.assertIsNone(self.perform_in_thread(loop, 'file://' + __file__))
+
+    def test_unexpected_error_wakes_waiters(self):
+        loop = arvados.keep.CurlMultiLoop()
+        with mock.patch.object(loop, '_finish_transfers',
+                               side_effect=ValueError('boom')):
+            error = self.perform_in_thread(loop, 'file://' + __file__)
+        self.assertIsInstance(error, pycurl.error)
+        # The loop keeps serving new transfers afterwards.
+        self.assertIsNone(self.perform_in_thread(loop, 'file://' + __file__))
+
+
 class KeepClientGatewayTestCase(unittest.TestCase, tutil.ApiClientMock):
     def mock_disks_and_gateways(self, disks=3, gateways=1):
         self.gateways = [{
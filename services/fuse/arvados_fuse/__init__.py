@@ -53,8 +53,7 @@ from __future__ import absolute_import
 from __future__ import division
 from future.utils import viewitems
 from future.utils import native
-from future.utils import listvalues
-from future.utils import listitems
+from future.utils import itervalues
 from future import standard_library
 standard_library.install_aliases()
 from builtins import next
@@ -100,6 +99,7 @@ LLFUSE_VERSION_0 = llfuse.__version__.startswith('0')
 
 from .fusedir import Directory, CollectionDirectory, TmpCollectionDirectory, MagicDirectory, TagsDirectory, ProjectDirectory, SharedDirectory, CollectionDirectoryBase
 from .fusefile import StringFile, FuseArvadosFile
+from .writeback import WriteBack
 
 _logger = logging.getLogger('arvados.arvados_fuse')
 
@@ -121,7 +121,7 @@ class Handle(object):
     def release(self):
         self.obj.dec_use()
 
-    def flush(self):
+    def flush(self, sync=True):
         pass
 
 
@@ -129,18 +129,38 @@ class FileHandle(Handle):
     """Connects a numeric file handle to a File  object that has
     been opened by the client."""
 
-    def flush(self):
+    def flush(self, sync=True):
         if self.obj.writable():
-            return self.obj.flush()
+            return self.obj.flush(sync)
 
 
 class DirectoryHandle(Handle):
     """Connects a numeric file handle to a Directory object that has
-    been opened by the client."""
+    been opened by the client.
+
+    `entries` holds the (name, entry) pairs listed so far.  More are taken
+    from `listing` (see Directory.listing()) only when readdir() asks for an
+    offset past the end, so a large directory can be read while the rest of
+    it is still being fetched.  Entries already listed stay put for the
+    life of the handle, so readdir offsets remain valid.
+    """
 
-    def __init__(self, fh, dirobj, entries):
+    def __init__(self, fh, dirobj, entries, listing=None):
         super(DirectoryHandle, self).__init__(fh, dirobj)
         self.entries = entries
+        self.listing = listing
+
+    def entry(self, off):
+        """Return the (name, entry) pair at off, or None past the end."""
+        while off >= len(self.entries) and self.listing is not None:
+            ent = next(self.listing, None)
+            if ent is None:
+                self.listing = None
+            else:
+                self.entries.append(ent)
+        if off < len(self.entries):
+            return self.entries[off]
+        return None
 
 
 class InodeCache(object):
@@ -156,7 +176,14 @@ class InodeCache(object):
     """
 
     def __init__(self, cap, min_entries=4):
+        # Candidates for clearing, least recently used first.
         self._entries = collections.OrderedDict()
+        # Entries that cap_cache() found it couldn't clear because they are
+        # in use or referenced by the kernel.  They are kept here, out of the
+        # way of cap_cache(), until unpin(), touch() or recheck_pinned()
+        # puts them back.
+        self._pinned = {}
+        self._recheck_pinned = False
         self._by_uuid = {}
         self.cap = cap
         self._total = 0
@@ -167,22 +194,9 @@ class InodeCache(object):
 
     def _remove(self, obj, clear):
         if clear:
-            # Kernel behavior seems to be that if a file is
-            # referenced, its parents remain referenced too. This
-            # means has_ref() exits early when a collection is not
-            # candidate for eviction.
-            #
-            # By contrast, in_use() doesn't increment references on
-            # parents, so it requires a full tree walk to determine if
-            # a collection is a candidate for eviction.  This takes
-            # .07s for 240000 files, which becomes a major drag when
-            # cap_cache is being called several times a second and
-            # there are multiple non-evictable collections in the
-            # cache.
-            #
-            # So it is important for performance that we do the
-            # has_ref() check first.
-
+            # The use and reference counts are propagated up to every
+            # ancestor (see FreshBase), so these checks don't need to walk
+            # the tree below a collection or project.
             if obj.has_ref(True):
                 _logger.debug("InodeCache cannot clear inode %i, still referenced", obj.inode)
                 return
@@ -199,11 +213,14 @@ class InodeCache(object):
         # Directory.clear().  While the llfuse lock is released, it can happen
         # that a reentrant call removes this entry before this call gets to it.
         # Ensure that the entry is still valid before trying to remove it.
-        if obj.inode not in self._entries:
+        if obj.inode in self._entries:
+            del self._entries[obj.inode]
+        elif obj.inode in self._pinned:
+            del self._pinned[obj.inode]
+        else:
             return
 
         self._total -= obj.cache_size
-        del self._entries[obj.inode]
         if obj.cache_uuid:
             self._by_uuid[obj.cache_uuid].remove(obj)
             if not self._by_uuid[obj.cache_uuid]:
@@ -213,11 +230,35 @@ class InodeCache(object):
             _logger.debug("InodeCache cleared inode %i total now %i", obj.inode, self._total)
 
     def cap_cache(self):
-        if self._total > self.cap:
-            for ent in listvalues(self._entries):
-                if self._total < self.cap or len(self._entries) < self.min_entries:
-                    break
-                self._remove(ent, True)
+        if self._recheck_pinned and self._total > self.cap:
+            self._recheck_pinned = False
+            self._entries.update(self._pinned)
+            self._pinned = {}
+        while (self._total > self.cap and self._entries and
+               len(self._entries) + len(self._pinned) >= self.min_entries):
+            obj = next(iter(itervalues(self._entries)))
+            self._remove(obj, True)
+            if self._entries.get(obj.inode) is obj:
+                # Couldn't be cleared, set it aside so it isn't checked
+                # again on every call.
+                del self._entries[obj.inode]
+                self._pinned[obj.inode] = obj
+
+    def unpin(self, obj):
+        """Make obj a candidate for clearing again, if it was set aside."""
+        if self._pinned.get(obj.inode) is obj:
+            del self._pinned[obj.inode]
+            self._entries[obj.inode] = obj
+
+    def recheck_pinned(self):
+        """Make every entry that was set aside a candidate again.
+
+        For changes that don't go through unpin(), like WriteBack saving
+        a collection in the background.  This only sets a flag, so it
+        can be called without the llfuse lock.  The next cap_cache()
+        that needs to clear something puts the entries back.
+        """
+        self._recheck_pinned = True
 
     def manage(self, obj):
         if obj.persisted():
@@ -232,17 +273,18 @@ class InodeCache(object):
                         self._by_uuid[obj.cache_uuid].append(obj)
             self._total += obj.objsize()
             _logger.debug("InodeCache touched inode %i (size %i) (uuid %s) total now %i (%i entries)",
-                          obj.inode, obj.objsize(), obj.cache_uuid, self._total, len(self._entries))
+                          obj.inode, obj.objsize(), obj.cache_uuid, self._total,
+                          len(self._entries) + len(self._pinned))
             self.cap_cache()
 
     def touch(self, obj):
         if obj.persisted():
-            if obj.inode in self._entries:
+            if obj.inode in self._entries or obj.inode in self._pinned:
                 self._remove(obj, False)
             self.manage(obj)
 
     def unmanage(self, obj):
-        if obj.persisted() and obj.inode in self._entries:
+        if obj.persisted() and (obj.inode in self._entries or obj.inode in self._pinned):
             self._remove(obj, True)
 
     def find_by_uuid(self, uuid):
@@ -250,6 +292,7 @@ class InodeCache(object):
 
     def clear(self):
         self._entries.clear()
+        self._pinned.clear()
         self._by_uuid.clear()
         self._total = 0
 
@@ -257,13 +300,25 @@ class Inodes(object):
     """Manage the set of inodes.  This is the mapping from a numeric id
     to a concrete File or Directory object"""
 
-    def __init__(self, inode_cache, encoding="utf-8"):
+    def __init__(self, inode_cache, encoding="utf-8", write_back=None):
         self._entries = {}
         self._counter = itertools.count(llfuse.ROOT_INODE)
         self.inode_cache = inode_cache
         self.encoding = encoding
+        self.write_back = write_back if write_back is not None else WriteBack()
         self.deferred_invalidations = []
 
+    @property
+    def write_back(self):
+        return self._write_back
+
+    @write_back.setter
+    def write_back(self, write_back):
+        # Collections with unsaved changes can't be cleared from the
+        # inode cache, so check them again after they are saved.
+        self._write_back = write_back
+        write_back.on_save(self.inode_cache.recheck_pinned)
+
     def __getitem__(self, item):
         return self._entries[item]
 
@@ -284,6 +339,7 @@ class Inodes(object):
         self.inode_cache.touch(entry)
 
     def add_entry(self, entry):
+        entry.inodes = self
         entry.inode = next(self._counter)
         if entry.inode == llfuse.ROOT_INODE:
             entry.inc_ref()
@@ -294,6 +350,9 @@ class Inodes(object):
     def del_entry(self, entry):
         if entry.ref_count == 0:
             self.inode_cache.unmanage(entry)
+            # Anything below the entry that is still counted no longer
+            # counts against the directories above it.
+            entry.set_parent_inode(None)
             del self._entries[entry.inode]
             with llfuse.lock_released:
                 entry.finalize()
@@ -360,6 +419,13 @@ class Operations(llfuse.Operations):
     so request handlers do not run concurrently unless the lock is explicitly released
     using 'with llfuse.lock_released:'
 
+    Handlers release the lock around anything that waits on the network
+    (API server requests, Keep reads and writes, collection saves), so with
+    several llfuse worker threads (see --fuse-workers) a slow request only
+    holds up requests for the same directory, which wait on that directory's
+    update lock.  Anything read from a directory before the lock was
+    released must be checked again after it is reacquired.
+
     """
 
     fuse_time = Summary('arvmount_fuse_operations_seconds', 'Time spent during FUSE operations', labelnames=['op'])
@@ -383,14 +449,14 @@ class Operations(llfuse.Operations):
     rename_time = fuse_time.labels(op='rename')
     flush_time = fuse_time.labels(op='flush')
 
-    def __init__(self, uid, gid, api_client, encoding="utf-8", inode_cache=None, num_retries=4, enable_write=False):
+    def __init__(self, uid, gid, api_client, encoding="utf-8", inode_cache=None, num_retries=4, enable_write=False, write_back=None):
         super(Operations, self).__init__()
 
         self._api_client = api_client
 
         if not inode_cache:
             inode_cache = InodeCache(cap=256*1024*1024)
-        self.inodes = Inodes(inode_cache, encoding=encoding)
+        self.inodes = Inodes(inode_cache, encoding=encoding, write_back=write_back)
         self.uid = uid
         self.gid = gid
         self.enable_write = enable_write
@@ -452,6 +518,17 @@ class Operations(llfuse.Operations):
             self.events.close()
             self.events = None
 
+        # Save collections with deferred changes before tearing down.
+        # A save can deliver collection events, which take the llfuse
+        # lock, so don't hold it while waiting for background saves.
+        if LLFUSE_VERSION_0:
+            # llfuse < 0.42
+            self.inodes.write_back.close()
+        else:
+            # llfuse >= 0.42
+            with llfuse.lock_released:
+                self.inodes.write_back.close()
+
         # Different versions of llfuse require and forbid us to
         # acquire the lock here. See #8345#note-37, #10805#note-9.
         if LLFUSE_VERSION_0 and llfuse.lock.acquire():
@@ -578,6 +655,8 @@ class Operations(llfuse.Operations):
     def lookup(self, parent_inode, name, ctx=None):
         name = str(name, self.inodes.encoding)
         inode = None
+        entry_timeout = 0
+        negative_entry_timeout = 0
 
         if name == '.':
             inode = parent_inode
@@ -587,17 +666,28 @@ class Operations(llfuse.Operations):
                 self.inodes.touch(p)
                 if name == '..':
                     inode = p.parent_inode
-                elif isinstance(p, Directory) and name in p:
-                    inode = p[name].inode
+                elif isinstance(p, Directory):
+                    if name in p:
+                        inode = p[name].inode
+                    entry_timeout = p.entry_timeout()
+                    negative_entry_timeout = p.negative_entry_timeout()
 
         if inode != None:
             _logger.debug("arv-mount lookup: parent_inode %i name '%s' inode %i",
                       parent_inode, name, inode)
             self.inodes[inode].inc_ref()
-            return self.getattr(inode)
+            entry = self.getattr(inode)
+            entry.entry_timeout = entry_timeout
+            return entry
         else:
             _logger.debug("arv-mount lookup: parent_inode %i name '%s' not found",
                       parent_inode, name)
+            if negative_entry_timeout > 0:
+                # A zero inode tells the kernel it may cache the failed lookup.
+                entry = llfuse.EntryAttributes()
+                entry.st_ino = 0
+                entry.entry_timeout = negative_entry_timeout
+                return entry
             raise llfuse.FUSEError(errno.ENOENT)
 
     @forget_time.time()
@@ -660,7 +750,9 @@ class Operations(llfuse.Operations):
 
         self.inodes.touch(handle.obj)
 
-        r = handle.obj.readfrom(off, size, self.num_retries)
+        # Pass the handle along, so that each open handle of a file gets
+        # its own readahead.
+        r = handle.obj.readfrom(off, size, self.num_retries, reader=handle)
         if r:
             self.read_counter.add(len(r))
         return r
@@ -692,7 +784,7 @@ class Operations(llfuse.Operations):
         if fh in self._filehandles:
             _logger.debug("arv-mount release fh %i", fh)
             try:
-                self._filehandles[fh].flush()
+                self._filehandles[fh].flush(sync=False)
             except Exception:
                 raise
             finally:
@@ -724,7 +816,7 @@ class Operations(llfuse.Operations):
 
         # update atime
         self.inodes.touch(p)
-        self._filehandles[fh] = DirectoryHandle(fh, p, [('.', p), ('..', parent)] + listitems(p))
+        self._filehandles[fh] = DirectoryHandle(fh, p, [('.', p), ('..', parent)], p.listing())
         return fh
 
     @readdir_time.time()
@@ -738,10 +830,12 @@ class Operations(llfuse.Operations):
             raise llfuse.FUSEError(errno.EBADF)
 
         e = off
-        while e < len(handle.entries):
-            if handle.entries[e][1].inode in self.inodes:
-                yield (handle.entries[e][0].encode(self.inodes.encoding), self.getattr(handle.entries[e][1].inode), e+1)
+        ent = handle.entry(e)
+        while ent is not None:
+            if ent[1].inode in self.inodes:
+                yield (ent[0].encode(self.inodes.encoding), self.getattr(ent[1].inode), e+1)
             e += 1
+            ent = handle.entry(e)
 
     @statfs_time.time()
     @catch_exceptions
@@ -838,12 +932,12 @@ class Operations(llfuse.Operations):
 
     @flush_time.time()
     @catch_exceptions
-    def flush(self, fh):
+    def flush(self, fh, sync=False):
         if fh in self._filehandles:
-            self._filehandles[fh].flush()
+            self._filehandles[fh].flush(sync)
 
     def fsync(self, fh, datasync):
-        self.flush(fh)
+        self.flush(fh, sync=True)
 
     def fsyncdir(self, fh, datasync):
-        self.flush(fh)
+        self.flush(fh, sync=True)
@@ -90,11 +90,17 @@ class ArgumentParser(argparse.ArgumentParser):
 
         self.add_argument('--file-cache', type=int, help="File data cache size, in bytes (default 256MiB)", default=256*1024*1024)
         self.add_argument('--directory-cache', type=int, help="Directory data cache size, in bytes (default 128MiB)", default=128*1024*1024)
+        self.add_argument('--disk-cache-dir', type=str, metavar='PATH', help="Also cache file data in this directory, which can be shared with other processes (default no disk cache)", default=None)
+        self.add_argument('--disk-cache', type=int, help="Disk cache size, in bytes, when --disk-cache-dir is given (default 8GiB)", default=8*1024*1024*1024)
+
+        self.add_argument('--fuse-workers', type=int, metavar='N', help="Number of threads handling FUSE requests.  Requests that are waiting on the API server or Keep don't hold up the others, up to this many at a time (default chosen by llfuse)", default=None)
 
         self.add_argument('--disable-event-listening', action='store_true', help="Don't subscribe to events on the API server", dest="disable_event_listening", default=False)
 
         self.add_argument('--read-only', action='store_false', help="Mount will be read only (default)", dest="enable_write", default=False)
         self.add_argument('--read-write', action='store_true', help="Mount will be read-write", dest="enable_write", default=False)
+        self.add_argument('--write-back-delay', type=float, metavar='SECONDS', help="Save a modified collection up to this many seconds after its first unsaved change, so many file closes share one save (default 0: save whenever a file is closed). fsync() and unmount always save right away.", default=0)
+        self.add_argument('--write-back-size', type=int, help="With --write-back-delay, also save once this many bytes have been written since the last save (default 64MiB)", default=64*1024*1024)
 
         self.add_argument('--crunchstat-interval', type=float, help="Write stats to stderr every N seconds (default disabled)", default=0)
 
@@ -214,6 +220,8 @@ class Mount(object):
                 apiconfig=arvados.config.settings(),
                 keep_params={
                     'block_cache': arvados.keep.KeepBlockCache(self.args.file_cache),
+                    'disk_cache_dir': self.args.disk_cache_dir,
+                    'disk_cache_max': self.args.disk_cache,
                     'num_retries': self.args.retries,
                 })
         except KeyError as e:
@@ -229,7 +237,9 @@ class Mount(object):
             api_client=self.api,
             encoding=self.args.encoding,
             inode_cache=InodeCache(cap=self.args.directory_cache),
-            enable_write=self.args.enable_write)
+            enable_write=self.args.enable_write,
+            write_back=WriteBack(delay=self.args.write_back_delay,
+                                 max_bytes=self.args.write_back_size))
 
         if self.args.crunchstat_interval:
             statsthread = threading.Thread(
@@ -383,7 +393,7 @@ From here, the following directories are available:
 
     def _llfuse_main(self):
         try:
-            llfuse.main()
+            llfuse.main(workers=self.args.fuse_workers)
         except:
             llfuse.close(unmount=False)
             raise
@@ -53,6 +53,10 @@ class FreshBase(object):
     * Manage the kernel reference count ("inc_ref" and "dec_ref").  An object
       which is referenced by the kernel cannot have its inode entry deleted.
 
+    * Propagate changes in the use and reference counts to every ancestor
+      (found through "parent_inode" and the inode table) so that in_use()
+      and has_ref() are constant time, rather than walking the subtree.
+
     * Record cache footprint, cache priority
 
     * Record Arvados uuid at the time the object is placed in the cache
@@ -62,7 +66,8 @@ class FreshBase(object):
     """
 
     __slots__ = ("_stale", "_poll", "_last_update", "_atime", "_poll_time", "use_count",
-                 "ref_count", "dead", "cache_size", "cache_uuid", "allow_attr_cache")
+                 "ref_count", "child_use_count", "child_ref_count", "inodes",
+                 "dead", "cache_size", "cache_uuid", "allow_attr_cache")
 
     def __init__(self):
         self._stale = True
@@ -72,6 +77,12 @@ class FreshBase(object):
         self._poll_time = 60
         self.use_count = 0
         self.ref_count = 0
+        # Sums of use_count and ref_count over everything below this
+        # object.
+        self.child_use_count = 0
+        self.child_ref_count = 0
+        # The Inodes table, set when the object is added to it.
+        self.inodes = None
         self.dead = False
         self.cache_size = 0
         self.cache_uuid = None
@@ -109,20 +120,61 @@ class FreshBase(object):
         pass
 
     def in_use(self):
-        return self.use_count > 0
+        return self.use_count > 0 or self.child_use_count > 0
+
+    def _ancestors(self):
+        """Yield each directory above this object, nearest first."""
+        obj = self
+        while self.inodes is not None and obj.parent_inode in self.inodes:
+            parent = self.inodes[obj.parent_inode]
+            if parent is obj:
+                # The root is its own parent.
+                return
+            yield parent
+            obj = parent
+
+    def _count_children(self, uses, refs):
+        """Add uses and refs to the child counts of every ancestor.
+
+        When the counts go down, tell the inode cache about each object
+        that can now be cleared.
+        """
+        if self.inodes is None:
+            return
+        released = [self] if (uses < 0 or refs < 0) else []
+        for parent in self._ancestors():
+            parent.child_use_count += uses
+            parent.child_ref_count += refs
+            if released:
+                released.append(parent)
+        for obj in released:
+            if not obj.in_use() and not obj.has_ref(True):
+                self.inodes.inode_cache.unpin(obj)
+
+    def set_parent_inode(self, parent_inode):
+        """Move this object, and the counts for its subtree, to a new parent."""
+        uses = self.use_count + self.child_use_count
+        refs = self.ref_count + self.child_ref_count
+        self._count_children(-uses, -refs)
+        self.parent_inode = parent_inode
+        self._count_children(uses, refs)
 
     def inc_use(self):
         self.use_count += 1
+        self._count_children(1, 0)
 
     def dec_use(self):
         self.use_count -= 1
+        self._count_children(-1, 0)
 
     def inc_ref(self):
         self.ref_count += 1
+        self._count_children(0, 1)
         return self.ref_count
 
     def dec_ref(self, n):
         self.ref_count -= n
+        self._count_children(0, -n)
         return self.ref_count
 
     def has_ref(self, only_children):
@@ -132,6 +184,8 @@ class FreshBase(object):
         If only_children is True, ignore refcount of self and only consider
         children.
         """
+        if self.child_ref_count > 0:
+            return True
         if only_children:
             return False
         else:
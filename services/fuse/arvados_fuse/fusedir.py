@@ -5,12 +5,12 @@
 from __future__ import absolute_import
 from __future__ import division
 from future.utils import viewitems
-from future.utils import itervalues
 from builtins import dict
 import apiclient
 import arvados
 import errno
 import functools
+import itertools
 import llfuse
 import logging
 import re
@@ -127,6 +127,15 @@ class Directory(FreshBase):
     def items(self):
         return list(self._entries.items())
 
+    def listing(self):
+        """Return an iterator of (name, entry) pairs for readdir().
+
+        Operations.opendir() takes pairs from it only as the kernel reads
+        further into the directory.  By default it's a snapshot of the
+        current contents.
+        """
+        return iter(self.items())
+
     @use_counter
     @check_update
     def __contains__(self, k):
@@ -193,28 +202,13 @@ class Directory(FreshBase):
 
         self.fresh()
 
-    def in_use(self):
-        if super(Directory, self).in_use():
-            return True
-        for v in itervalues(self._entries):
-            if v.in_use():
-                return True
-        return False
-
-    def has_ref(self, only_children):
-        if super(Directory, self).has_ref(only_children):
-            return True
-        for v in itervalues(self._entries):
-            if v.has_ref(False):
-                return True
-        return False
-
     def clear(self):
         """Delete all entries"""
         oldentries = self._entries
         self._entries = {}
         for n in oldentries:
             oldentries[n].clear()
+            self.inodes.invalidate_entry(self, n)
             self.inodes.del_entry(oldentries[n])
         self.invalidate()
 
@@ -234,10 +228,22 @@ class Directory(FreshBase):
     def mtime(self):
         return self._mtime
 
+    def entry_timeout(self):
+        """Return how long the kernel may cache name lookups in this directory.
+
+        Subclasses that call Inodes.invalidate_entry() whenever an entry is
+        removed or replaced can return more than zero.
+        """
+        return 0
+
+    def negative_entry_timeout(self):
+        """Return how long the kernel may cache failed lookups in this directory."""
+        return 0
+
     def writable(self):
         return False
 
-    def flush(self):
+    def flush(self, sync=True):
         pass
 
     def want_event_subscribe(self):
@@ -274,6 +280,10 @@ class CollectionDirectoryBase(Directory):
 
     """
 
+    # Contents of a collection read by portable data hash never change, so
+    # the kernel can cache lookups in it (including failed ones) this long.
+    IMMUTABLE_ENTRY_TIMEOUT = 24*60*60
+
     def __init__(self, parent_inode, inodes, apiconfig, collection):
         super(CollectionDirectoryBase, self).__init__(parent_inode, inodes, apiconfig)
         self.apiconfig = apiconfig
@@ -287,12 +297,13 @@ class CollectionDirectoryBase(Directory):
             if item.fuse_entry.inode is None:
                 raise Exception("Reparented entry must still have valid inode")
             item.fuse_entry.dead = False
+            item.fuse_entry.set_parent_inode(self.inode)
             self._entries[name] = item.fuse_entry
         elif isinstance(item, arvados.collection.RichCollectionBase):
             self._entries[name] = self.inodes.add_entry(CollectionDirectoryBase(self.inode, self.inodes, self.apiconfig, item))
             self._entries[name].populate(mtime)
         else:
-            self._entries[name] = self.inodes.add_entry(FuseArvadosFile(self.inode, item, mtime))
+            self._entries[name] = self.inodes.add_entry(FuseArvadosFile(self.inode, item, mtime, self.inodes.write_back))
         item.fuse_entry = self._entries[name]
 
     def on_event(self, event, collection, name, item):
@@ -322,10 +333,27 @@ class CollectionDirectoryBase(Directory):
     def writable(self):
         return self.collection.writable()
 
+    def immutable(self):
+        return self.collection is not None and not self.collection.writable()
+
+    def entry_timeout(self):
+        if self.immutable():
+            return self.IMMUTABLE_ENTRY_TIMEOUT
+        # on_event() invalidates entries that are removed from the collection.
+        return self.time_to_next_poll()
+
+    def negative_entry_timeout(self):
+        if self.immutable():
+            return self.IMMUTABLE_ENTRY_TIMEOUT
+        return 0
+
     @use_counter
-    def flush(self):
+    def flush(self, sync=True):
         with llfuse.lock_released:
-            self.collection.root_collection().save()
+            if sync:
+                self.inodes.write_back.save(self.collection.root_collection())
+            else:
+                self.inodes.write_back.changed(self.collection.root_collection())
 
     @use_counter
     @check_update
@@ -344,14 +372,14 @@ class CollectionDirectoryBase(Directory):
     def unlink(self, name):
         with llfuse.lock_released:
             self.collection.remove(name)
-        self.flush()
+        self.flush(sync=False)
 
     @use_counter
     @check_update
     def rmdir(self, name):
         with llfuse.lock_released:
             self.collection.remove(name)
-        self.flush()
+        self.flush(sync=False)
 
     @use_counter
     @check_update
@@ -374,8 +402,8 @@ class CollectionDirectoryBase(Directory):
 
         with llfuse.lock_released:
             self.collection.rename(name_old, name_new, source_collection=src.collection, overwrite=True)
-        self.flush()
-        src.flush()
+        self.flush(sync=False)
+        src.flush(sync=False)
 
     def clear(self):
         super(CollectionDirectoryBase, self).clear()
@@ -530,6 +558,16 @@ class CollectionDirectory(CollectionDirectoryBase):
             return super(CollectionDirectory, self).__contains__(k)
 
     def invalidate(self):
+        if self.inode is not None:
+            # Have the kernel look up names again, so they get checked
+            # against the updated collection.
+            if self.parent_inode == self.inode or self.parent_inode not in self.inodes:
+                for name in self._entries:
+                    self.inodes.invalidate_entry(self, name)
+                if self.collection_record_file is not None:
+                    self.inodes.invalidate_entry(self, '.arvados#collection')
+            else:
+                self.kernel_invalidate()
         self.collection_record = None
         self.collection_record_file = None
         super(CollectionDirectory, self).invalidate()
@@ -543,10 +581,17 @@ class CollectionDirectory(CollectionDirectoryBase):
         # footprint directly would be more accurate, but also more complicated.
         return self._manifest_size * 128
 
+    def in_use(self):
+        # Keep a collection with unsaved changes from being cleared
+        # out of the inode cache.
+        if self.collection is not None and self.inodes.write_back.pending(self.collection):
+            return True
+        return super(CollectionDirectory, self).in_use()
+
     def finalize(self):
         if self.collection is not None:
             if self.writable():
-                self.collection.save()
+                self.inodes.write_back.save(self.collection)
             self.collection.stop_threads()
 
     def clear(self):
@@ -682,10 +727,14 @@ and the directory will appear if it exists.
             e = None
 
             if group_uuid_pattern.match(k):
-                project = self.api.groups().list(
-                    filters=[['group_class', 'in', ['project','filter']], ["uuid", "=", k]]).execute(num_retries=self.num_retries)
+                with llfuse.lock_released:
+                    project = self.api.groups().list(
+                        filters=[['group_class', 'in', ['project','filter']], ["uuid", "=", k]]).execute(num_retries=self.num_retries)
                 if project[u'items_available'] == 0:
                     return False
+                if k in self._entries:
+                    # Another request added it while the lock was released.
+                    return True
                 e = self.inodes.add_entry(ProjectDirectory(
                     self.inode, self.inodes, self.api, self.num_retries, project[u'items'][0]))
             else:
@@ -810,6 +859,10 @@ class TagDirectory(Directory):
 class ProjectDirectory(Directory):
     """A special directory that contains the contents of a project."""
 
+    # Number of project contents fetched at a time while readdir() streams
+    # a listing.
+    STREAM_PAGE_SIZE = 1000
+
     def __init__(self, parent_inode, inodes, api, num_retries, project_object,
                  poll=True, poll_time=3):
         super(ProjectDirectory, self).__init__(parent_inode, inodes, api.config)
@@ -838,17 +891,71 @@ class ProjectDirectory(Directory):
             else:
                 return None
         elif uuid_pattern.match(i['uuid']):
-            return ObjectFile(self.parent_inode, i)
+            return ObjectFile(self.inode, i)
         else:
             return None
 
     def uuid(self):
         return self.project_uuid
 
+    def entry_timeout(self):
+        # merge() and child_event() invalidate entries that are removed.
+        return self.time_to_next_poll()
+
     def items(self):
         self._full_listing = True
         return super(ProjectDirectory, self).items()
 
+    def listing(self):
+        if not self.stale():
+            # Not items(), which would make later updates fetch the whole
+            # project.
+            return iter(list(self._entries.items()))
+        return self._stream_contents()
+
+    def _stream_contents(self):
+        """Yield (name, entry) pairs as pages of the project arrive.
+
+        Entries are created as they are listed, so readdir() doesn't have to
+        wait for the whole project.  Once the listing is complete, entries
+        that weren't in it are removed, the same as merge() would.
+        """
+        last_update = self._last_update
+        seen = set()
+        contents = self._contents()
+        while True:
+            with llfuse.lock_released:
+                page = list(itertools.islice(contents, self.STREAM_PAGE_SIZE))
+            if not page:
+                break
+            for i in page:
+                name = self.sanitize_filename(self.namefn(i))
+                if not name or name in seen:
+                    continue
+                ent = self._entries.get(name)
+                if ent is None or not self.samefn(ent, i):
+                    new = self.createDirectory(i)
+                    if new is None:
+                        continue
+                    if ent is not None:
+                        self.inodes.invalidate_entry(self, name)
+                        self.inodes.del_entry(ent)
+                    _logger.debug("Adding entry '%s' to inode %i", name, self.inode)
+                    ent = self._entries[name] = self.inodes.add_entry(new)
+                seen.add(name)
+                yield (name, ent)
+
+        if self._last_update != last_update:
+            # update() refreshed the directory while this was listing, and
+            # its result is at least as recent.
+            return
+        for name in [n for n in self._entries if n not in seen]:
+            _logger.debug("Forgetting about entry '%s' on inode %i", name, self.inode)
+            ent = self._entries.pop(name)
+            self.inodes.invalidate_entry(self, name)
+            self.inodes.del_entry(ent)
+        self.fresh()
+
     def namefn(self, i):
         if 'name' in i:
             if i['name'] is None or len(i['name']) == 0:
@@ -866,6 +973,32 @@ class ProjectDirectory(Directory):
             return None
 
 
+    def samefn(self, a, i):
+        if isinstance(a, CollectionDirectory) or isinstance(a, ProjectDirectory):
+            return a.uuid() == i['uuid']
+        elif isinstance(a, ObjectFile):
+            return a.uuid() == i['uuid'] and not a.stale()
+        return False
+
+    def _contents(self):
+        """Iterate over the project's subprojects and collections.
+
+        Pages are fetched from the API server as the iterator is consumed.
+        """
+        # do this in 2 steps until #17424 is fixed
+        return itertools.chain(
+            arvados.util.keyset_list_all(self.api.groups().contents,
+                                         order_key="uuid",
+                                         num_retries=self.num_retries,
+                                         uuid=self.project_uuid,
+                                         filters=[["uuid", "is_a", "arvados#group"],
+                                                  ["groups.group_class", "in", ["project","filter"]]]),
+            arvados.util.keyset_list_all(self.api.groups().contents,
+                                         order_key="uuid",
+                                         num_retries=self.num_retries,
+                                         uuid=self.project_uuid,
+                                         filters=[["uuid", "is_a", "arvados#collection"]]))
+
     @use_counter
     def update(self):
         if self.project_object_file == None:
@@ -875,13 +1008,6 @@ class ProjectDirectory(Directory):
         if not self._full_listing:
             return True
 
-        def samefn(a, i):
-            if isinstance(a, CollectionDirectory) or isinstance(a, ProjectDirectory):
-                return a.uuid() == i['uuid']
-            elif isinstance(a, ObjectFile):
-                return a.uuid() == i['uuid'] and not a.stale()
-            return False
-
         try:
             with llfuse.lock_released:
                 self._updating_lock.acquire()
@@ -894,24 +1020,13 @@ class ProjectDirectory(Directory):
                 elif user_uuid_pattern.match(self.project_uuid):
                     self.project_object = self.api.users().get(
                         uuid=self.project_uuid).execute(num_retries=self.num_retries)
-                # do this in 2 steps until #17424 is fixed
-                contents = list(arvados.util.keyset_list_all(self.api.groups().contents,
-                                                        order_key="uuid",
-                                                        num_retries=self.num_retries,
-                                                        uuid=self.project_uuid,
-                                                        filters=[["uuid", "is_a", "arvados#group"],
-                                                                 ["groups.group_class", "in", ["project","filter"]]]))
-                contents.extend(arvados.util.keyset_list_all(self.api.groups().contents,
-                                                             order_key="uuid",
-                                                             num_retries=self.num_retries,
-                                                             uuid=self.project_uuid,
-                                                             filters=[["uuid", "is_a", "arvados#collection"]]))
+                contents = list(self._contents())
 
             # end with llfuse.lock_released, re-acquire lock
 
             self.merge(contents,
                        self.namefn,
-                       samefn,
+                       self.samefn,
                        self.createDirectory)
             return True
         finally:
@@ -951,6 +1066,9 @@ class ProjectDirectory(Directory):
             name = self.sanitize_filename(self.namefn(contents[0]))
             if name != k:
                 raise KeyError(k)
+            if name in self._entries:
+                # Another request added it while the lock was released.
+                return self._entries[name]
             return self._add_entry(contents[0], name)
 
         # Didn't find item
@@ -1021,14 +1139,22 @@ class ProjectDirectory(Directory):
             # writing) so don't support that.
             raise llfuse.FUSEError(errno.EPERM)
 
-        self.api.collections().update(uuid=ent.uuid(),
-                                      body={"owner_uuid": self.uuid(),
-                                            "name": name_new}).execute(num_retries=self.num_retries)
+        with llfuse.lock_released:
+            self.api.collections().update(uuid=ent.uuid(),
+                                          body={"owner_uuid": self.uuid(),
+                                                "name": name_new}).execute(num_retries=self.num_retries)
 
         # Acually move the entry from source directory to this directory.
-        del src._entries[name_old]
-        self._entries[name_new] = ent
-        self.inodes.invalidate_entry(src, name_old)
+        if src._entries.get(name_old) is ent:
+            del src._entries[name_old]
+            ent.set_parent_inode(self.inode)
+            self._entries[name_new] = ent
+            self.inodes.invalidate_entry(src, name_old)
+        else:
+            # The source directory was refreshed while the lock was
+            # released, and has already dropped the entry.  Pick up the
+            # new name on our next update.
+            self.invalidate()
 
     @use_counter
     def child_event(self, ev):
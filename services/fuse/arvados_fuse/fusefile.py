@@ -28,7 +28,7 @@ class File(FreshBase):
     def size(self):
         return 0
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, reader=None):
         return ''
 
     def writeto(self, off, size, num_retries=0):
@@ -43,28 +43,31 @@ class File(FreshBase):
     def writable(self):
         return False
 
-    def flush(self):
+    def flush(self, sync=True):
         pass
 
 
 class FuseArvadosFile(File):
     """Wraps a ArvadosFile."""
 
-    __slots__ = ('arvfile',)
+    __slots__ = ('arvfile', 'write_back', '_unsaved_bytes')
 
-    def __init__(self, parent_inode, arvfile, _mtime):
+    def __init__(self, parent_inode, arvfile, _mtime, write_back=None):
         super(FuseArvadosFile, self).__init__(parent_inode, _mtime)
         self.arvfile = arvfile
+        self.write_back = write_back
+        self._unsaved_bytes = 0
 
     def size(self):
         with llfuse.lock_released:
             return self.arvfile.size()
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, reader=None):
         with llfuse.lock_released:
-            return self.arvfile.readfrom(off, size, num_retries, exact=True)
+            return self.arvfile.readfrom(off, size, num_retries, exact=True, reader=reader)
 
     def writeto(self, off, buf, num_retries=0):
+        self._unsaved_bytes += len(buf)
         with llfuse.lock_released:
             return self.arvfile.writeto(off, buf, num_retries)
 
@@ -74,10 +77,22 @@ class FuseArvadosFile(File):
     def writable(self):
         return self.arvfile.writable()
 
-    def flush(self):
+    def flush(self, sync=True):
+        """Save the collection this file belongs to.
+
+        If sync is False and write-back is enabled, the save may be
+        deferred and shared with other changes to the collection.
+        """
+        nbytes, self._unsaved_bytes = self._unsaved_bytes, 0
         with llfuse.lock_released:
             if self.writable():
-                self.arvfile.parent.root_collection().save()
+                collection = self.arvfile.parent.root_collection()
+                if self.write_back is None:
+                    collection.save()
+                elif sync:
+                    self.write_back.save(collection)
+                else:
+                    self.write_back.changed(collection, nbytes)
 
 
 class StringFile(File):
@@ -89,7 +104,7 @@ class StringFile(File):
     def size(self):
         return len(self.contents)
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, reader=None):
         return bytes(self.contents[off:(off+size)], encoding='utf-8')
 
 
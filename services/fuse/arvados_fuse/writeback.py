@@ -0,0 +1,119 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: AGPL-3.0
+
+from __future__ import absolute_import
+from builtins import object
+import logging
+import threading
+import time
+
+_logger = logging.getLogger('arvados.arvados_fuse')
+
+class WriteBack(object):
+    """Coalesces saves of writable collections.
+
+    Saving a collection commits its buffer blocks, merges remote changes
+    and sends the whole manifest to the API server, so saving it every
+    time a file is closed gets slower as the collection grows.
+
+    With a `delay` greater than zero, `changed()` only marks a collection
+    dirty, and a background thread saves it once `delay` seconds have
+    passed since its first unsaved change, or sooner when more than
+    `max_bytes` have been written to it since the last save.  `save()`
+    saves a collection right away, for fsync() and unmount.
+
+    With the default `delay` of zero, every change is saved right away.
+
+    """
+
+    def __init__(self, delay=0, max_bytes=64*1024*1024):
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # Collections define __eq__ to compare contents, so this is keyed
+        # by id(): {id(collection): [save deadline, bytes written since
+        # last save, collection]}
+        self._pending = {}
+        self._thread = None
+        self._closed = False
+        self._on_save = []
+
+    def changed(self, collection, nbytes=0):
+        """Note that `collection` was modified and should be saved."""
+        with self._lock:
+            if self.delay > 0 and not self._closed:
+                if id(collection) not in self._pending:
+                    self._pending[id(collection)] = [time.time() + self.delay, 0, collection]
+                ent = self._pending[id(collection)]
+                ent[1] += nbytes
+                if ent[1] >= self.max_bytes:
+                    ent[0] = 0
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._wake.notify()
+                return
+        collection.save()
+
+    def on_save(self, callback):
+        """Call `callback()` after the background thread saves collections.
+
+        The callback runs on the background thread, without the llfuse
+        lock.
+        """
+        with self._lock:
+            self._on_save.append(callback)
+
+    def pending(self, collection):
+        """Return True if `collection` has changes waiting to be saved."""
+        with self._lock:
+            return id(collection) in self._pending
+
+    def save(self, collection):
+        """Save `collection` now, along with any changes waiting."""
+        with self._lock:
+            self._pending.pop(id(collection), None)
+        collection.save()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.time()
+                    due = [ent[2] for ent in self._pending.values() if ent[0] <= now]
+                    if due:
+                        break
+                    if self._pending:
+                        self._wake.wait(min(ent[0] for ent in self._pending.values()) - now)
+                    else:
+                        self._wake.wait()
+                for collection in due:
+                    del self._pending[id(collection)]
+            for collection in due:
+                try:
+                    collection.save()
+                except Exception:
+                    _logger.exception("Error saving collection, will retry in %s seconds", self.delay)
+                    self.changed(collection)
+            for callback in self._on_save:
+                callback()
+
+    def close(self):
+        """Stop the background thread and save everything still pending."""
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+            pending = [ent[2] for ent in self._pending.values()]
+            self._pending.clear()
+        if self._thread is not None:
+            self._thread.join()
+        for collection in pending:
+            try:
+                collection.save()
+            except Exception:
+                _logger.exception("Error saving collection")
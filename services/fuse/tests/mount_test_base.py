@@ -25,6 +25,9 @@ logger = logging.getLogger('arvados.arv-mount')
 from .integration_test import workerPool
 
 class MountTestBase(unittest.TestCase):
+    # Passed to llfuse.main(), None for llfuse's default.
+    fuse_workers = None
+
     def setUp(self, api=None, local_store=True):
         # The underlying C implementation of open() makes a fstat() syscall
         # with the GIL still held.  When the GETATTR message comes back to
@@ -50,7 +53,7 @@ class MountTestBase(unittest.TestCase):
     # to use a Mount instead of copying its code.
     def _llfuse_main(self):
         try:
-            llfuse.main()
+            llfuse.main(workers=self.fuse_workers)
         except:
             llfuse.close(unmount=False)
             raise
@@ -0,0 +1,68 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: AGPL-3.0
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+import arvados_fuse as fuse
+import llfuse
+import os
+import threading
+import time
+import unittest
+from .. import run_test_server
+from ..mount_test_base import MountTestBase
+from ..slow_test import slow_test
+
+from .performance_profiler import profiled
+
+def fuse_statAndListCollectionsConcurrently(mounttmp, nthreads):
+    class Test(unittest.TestCase):
+        def runTest(self):
+            self.statAndListCollectionsConcurrently()
+
+        @profiled
+        def statAndListCollectionsConcurrently(self):
+            names = [n for n in llfuse.listdir(mounttmp) if n.startswith('Collection_')]
+            self.assertEqual(200, len(names))
+            errors = []
+
+            def worker(n):
+                try:
+                    # The first listing of each collection fetches it from
+                    # the API server.
+                    for name in names[n::nthreads]:
+                        os.stat(os.path.join(mounttmp, name))
+                        self.assertIn('baz', llfuse.listdir(os.path.join(mounttmp, name)))
+                        os.stat(os.path.join(mounttmp, name, 'baz'))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(nthreads)]
+            t0 = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            secs = time.time() - t0
+            self.assertEqual([], errors)
+            print("{} client threads: {} collections listed in {:.2f}s ({:.0f} ops/s)".format(
+                nthreads, len(names), secs, 3 * len(names) / secs))
+
+    Test().runTest()
+
+class ConcurrentMetadataOperations(MountTestBase):
+    CLIENT_THREADS = 16
+
+    @slow_test
+    def test_concurrentMetadataOperations(self):
+        self.make_mount(fuse.ProjectDirectory,
+                        project_object=run_test_server.fixture('groups')['project_with_201_collections'])
+        self.pool.apply(fuse_statAndListCollectionsConcurrently,
+                        (self.mounttmp, self.CLIENT_THREADS))
+
+class ConcurrentMetadataOperationsOneWorker(ConcurrentMetadataOperations):
+    # For comparison: every request is handled in turn.
+    fuse_workers = 1
@@ -0,0 +1,66 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: AGPL-3.0
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from builtins import range
+import arvados
+import arvados_fuse as fuse
+import os
+import time
+import unittest
+from ..mount_test_base import MountTestBase
+from ..slow_test import slow_test
+
+from .performance_profiler import profiled
+
+def fuse_openAndCloseFilesAcrossCollections(mounttmp, pdhs, held, rounds):
+    class Test(unittest.TestCase):
+        def runTest(self):
+            self.openAndCloseFilesAcrossCollections()
+
+        @profiled
+        def openAndCloseFilesAcrossCollections(self):
+            # Keep files open in the first few collections, so the inode
+            # cache has entries that it can't clear.
+            holding = [open(os.path.join(mounttmp, pdh, 'file.txt')) for pdh in pdhs[:held]]
+            try:
+                t0 = time.time()
+                for _ in range(rounds):
+                    for i in range(held, len(pdhs)):
+                        with open(os.path.join(mounttmp, pdhs[i], 'file.txt')) as f:
+                            self.assertEqual('{:08}'.format(i), f.read())
+                secs = time.time() - t0
+            finally:
+                for f in holding:
+                    f.close()
+            print("Opened and closed {} files across {} collections in {:.2f}s ({:.0f} opens/s)".format(
+                rounds * (len(pdhs) - held), len(pdhs), secs, rounds * (len(pdhs) - held) / secs))
+
+    Test().runTest()
+
+class OpenAndCloseFilesAcrossManyCollections(MountTestBase):
+    COLLECTIONS = 1000
+    HELD = 100
+    ROUNDS = 3
+
+    def setUp(self):
+        super(OpenAndCloseFilesAcrossManyCollections, self).setUp()
+        self.pdhs = []
+        for i in range(self.COLLECTIONS):
+            c = arvados.collection.Collection(api_client=self.api)
+            with c.open('file.txt', 'w') as f:
+                f.write('{:08}'.format(i))
+            c.save_new()
+            self.pdhs.append(c.portable_data_hash())
+
+    @slow_test
+    def test_openAndCloseFilesAcrossManyCollections(self):
+        self.make_mount(fuse.MagicDirectory)
+        # Small enough that only a fraction of the collections fit, so
+        # nearly every open makes the inode cache clear something.
+        self.operations.inodes.inode_cache.cap = 1024*1024
+        self.pool.apply(fuse_openAndCloseFilesAcrossCollections,
+                        (self.mounttmp, self.pdhs, self.HELD, self.ROUNDS))
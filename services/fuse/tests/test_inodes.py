@@ -4,6 +4,7 @@
 
 import arvados_fuse
 import mock
+import time
 import unittest
 import llfuse
 import logging
@@ -150,3 +151,127 @@ class InodeTests(unittest.TestCase):
         self.assertEqual(0, cache.total())
         cache.touch(ent3)
         self.assertEqual(600, cache.total())
+
+    def test_pinned_set_aside(self):
+        cache = arvados_fuse.InodeCache(1000, 1)
+        inodes = arvados_fuse.Inodes(cache)
+
+        ent1 = mock.MagicMock()
+        ent1.in_use.return_value = True
+        ent1.has_ref.return_value = False
+        ent1.persisted.return_value = True
+        ent1.objsize.return_value = 600
+        inodes.add_entry(ent1)
+
+        ent2 = mock.MagicMock()
+        ent2.in_use.return_value = False
+        ent2.has_ref.return_value = False
+        ent2.persisted.return_value = True
+        ent2.objsize.return_value = 600
+        inodes.add_entry(ent2)
+
+        # ent1 couldn't be cleared, so ent2 was
+        self.assertFalse(ent1.clear.called)
+        self.assertTrue(ent2.clear.called)
+        self.assertEqual(600, cache.total())
+        self.assertIn(ent1.inode, cache._pinned)
+
+        # ent1 isn't looked at again until it is unpinned
+        ent1.in_use.reset_mock()
+        cache.cap = 500
+        cache.cap_cache()
+        self.assertFalse(ent1.in_use.called)
+        self.assertFalse(ent1.clear.called)
+
+        ent1.in_use.return_value = False
+        cache.unpin(ent1)
+        cache.cap_cache()
+        self.assertTrue(ent1.clear.called)
+        self.assertEqual(0, cache.total())
+
+    def test_pinned_rechecked_after_write_back(self):
+        cache = arvados_fuse.InodeCache(1000, 1)
+        wb = arvados_fuse.WriteBack(delay=0.1)
+        inodes = arvados_fuse.Inodes(cache, write_back=wb)
+        coll = mock.MagicMock()
+        wb.changed(coll)
+
+        ent1 = mock.MagicMock()
+        ent1.in_use.side_effect = lambda: wb.pending(coll)
+        ent1.has_ref.return_value = False
+        ent1.persisted.return_value = True
+        ent1.objsize.return_value = 600
+        inodes.add_entry(ent1)
+
+        ent2 = mock.MagicMock()
+        ent2.in_use.return_value = True
+        ent2.has_ref.return_value = False
+        ent2.persisted.return_value = True
+        ent2.objsize.return_value = 600
+        inodes.add_entry(ent2)
+
+        # ent1 has unsaved changes, so it was set aside
+        self.assertIn(ent1.inode, cache._pinned)
+        self.assertIn(ent2.inode, cache._pinned)
+
+        # Once the background save is done, the next cap_cache() clears it
+        deadline = time.time() + 5
+        while wb.pending(coll) and time.time() < deadline:
+            time.sleep(0.01)
+        wb.close()
+        cache.cap_cache()
+        self.assertTrue(ent1.clear.called)
+        self.assertFalse(ent2.clear.called)
+        self.assertEqual(600, cache.total())
+
+    def test_counts_propagate(self):
+        cache = arvados_fuse.InodeCache(1000, 1)
+        inodes = arvados_fuse.Inodes(cache)
+        apiconfig = mock.MagicMock()
+
+        class PersistedDirectory(arvados_fuse.Directory):
+            def persisted(self):
+                return True
+            def objsize(self):
+                return 600
+
+        root = inodes.add_entry(arvados_fuse.Directory(llfuse.ROOT_INODE, inodes, apiconfig))
+        coll = inodes.add_entry(PersistedDirectory(root.inode, inodes, apiconfig))
+        subdir = inodes.add_entry(arvados_fuse.Directory(coll.inode, inodes, apiconfig))
+        f = inodes.add_entry(arvados_fuse.StringFile(subdir.inode, "data", 0))
+        coll._entries["subdir"] = subdir
+        subdir._entries["file"] = f
+
+        f.inc_use()
+        self.assertTrue(subdir.in_use())
+        self.assertTrue(coll.in_use())
+        self.assertTrue(root.in_use())
+
+        # coll can't be cleared while the file is in use
+        other = inodes.add_entry(PersistedDirectory(root.inode, inodes, apiconfig))
+        self.assertIn(coll.inode, cache._pinned)
+        self.assertIn("subdir", coll._entries)
+
+        # Once it isn't, coll goes back to being a candidate
+        f.dec_use()
+        self.assertFalse(coll.in_use())
+        self.assertNotIn(coll.inode, cache._pinned)
+        self.assertIn(coll.inode, cache._entries)
+
+        f.inc_ref()
+        self.assertTrue(coll.has_ref(True))
+        self.assertTrue(f.has_ref(False))
+        self.assertFalse(f.has_ref(True))
+        f.dec_ref(1)
+        self.assertFalse(coll.has_ref(True))
+        self.assertFalse(root.has_ref(True))
+
+        # Moving an entry moves its counts
+        f.inc_use()
+        f.set_parent_inode(other.inode)
+        self.assertFalse(coll.in_use())
+        self.assertTrue(other.in_use())
+        self.assertTrue(root.in_use())
+        f.dec_use()
+        self.assertFalse(other.in_use())
+        self.assertFalse(root.in_use())
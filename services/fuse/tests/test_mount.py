@@ -123,6 +123,40 @@ class FuseMountTest(MountTestBase):
                 self.assertEqual(v, f.read().decode())
 
 
+class FuseEntryTimeoutTest(FuseMountTest):
+    def runTest(self):
+        self.make_mount(fuse.CollectionDirectory, collection_record=self.testcollection)
+
+        with llfuse.lock:
+            # Entries of a collection mounted by PDH never change, so the
+            # kernel can cache lookups, including failed ones, for a long time.
+            dir1 = self.operations.lookup(llfuse.ROOT_INODE, b'dir1')
+            self.assertGreater(dir1.entry_timeout, 3600)
+            thing3 = self.operations.lookup(dir1.st_ino, b'thing3.txt')
+            self.assertGreater(thing3.entry_timeout, 3600)
+            missing = self.operations.lookup(dir1.st_ino, b'missing.txt')
+            self.assertEqual(0, missing.st_ino)
+            self.assertGreater(missing.entry_timeout, 3600)
+
+
+class FuseWritableEntryTimeoutTest(MountTestBase):
+    def runTest(self):
+        collection = arvados.collection.Collection(api_client=self.api)
+        with collection.open("file1.txt", "w") as f:
+            f.write("Hello world!")
+        collection.save_new()
+
+        m = self.make_mount(fuse.CollectionDirectory)
+        with llfuse.lock:
+            m.new_collection(collection.api_response(), collection)
+            entry = self.operations.lookup(llfuse.ROOT_INODE, b'file1.txt')
+            self.assertGreater(entry.entry_timeout, 0)
+            # Files can be added to a writable collection at any time, so
+            # failed lookups aren't cached.
+            with self.assertRaises(llfuse.FUSEError):
+                self.operations.lookup(llfuse.ROOT_INODE, b'missing.txt')
+
+
 class FuseMagicTest(MountTestBase):
     def setUp(self, api=None):
         super(FuseMagicTest, self).setUp(api=api)
@@ -523,6 +557,60 @@ class FuseUpdateFileTest(MountTestBase):
             r'\. daaef200ebb921e011e3ae922dd3266b\+11\+A\S+ 86fb269d190d2c85f6e0468ceca42a20\+12\+A\S+ 0:11:file1\.txt 22:1:file1\.txt$')
 
 
+def fuseWriteBackTestHelperWriteFiles(mounttmp):
+    class Test(unittest.TestCase):
+        def runTest(self):
+            for i in range(3):
+                with open(os.path.join(mounttmp, "file%d.txt" % i), "w") as f:
+                    f.write("Hello world!")
+    Test().runTest()
+
+def fuseWriteBackTestHelperFsync(mounttmp):
+    class Test(unittest.TestCase):
+        def runTest(self):
+            fd = os.open(os.path.join(mounttmp, "file0.txt"), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+    Test().runTest()
+
+class FuseWriteBackTest(MountTestBase):
+    def setUp(self):
+        super(FuseWriteBackTest, self).setUp()
+        self.collection = arvados.collection.Collection(api_client=self.api)
+        self.collection.save_new()
+
+    def make_write_back_mount(self, delay):
+        m = self.make_mount(fuse.CollectionDirectory)
+        self.operations.inodes.write_back = fuse.WriteBack(delay=delay)
+        with llfuse.lock:
+            m.new_collection(self.collection.api_response(), self.collection)
+        self.assertTrue(m.writable())
+
+    def saved_manifest(self):
+        return self.api.collections().get(
+            uuid=self.collection.manifest_locator()).execute()["manifest_text"]
+
+    def test_fsync_saves(self):
+        self.make_write_back_mount(delay=3600)
+        self.pool.apply(fuseWriteBackTestHelperWriteFiles, (self.mounttmp,))
+        # Closing the files didn't save the collection...
+        self.assertEqual("", self.saved_manifest())
+        # ...but fsync does.
+        self.pool.apply(fuseWriteBackTestHelperFsync, (self.mounttmp,))
+        assertRegex(self, self.saved_manifest(),
+            r'\. 86fb269d190d2c85f6e0468ceca42a20\+12\+A\S+ 0:12:file0\.txt 0:12:file1\.txt 0:12:file2\.txt$')
+
+    def test_delayed_save(self):
+        self.make_write_back_mount(delay=1)
+        with mock.patch.object(self.collection, 'save', wraps=self.collection.save) as save:
+            self.pool.apply(fuseWriteBackTestHelperWriteFiles, (self.mounttmp,))
+            for attempt in AssertWithTimeout(10):
+                attempt(assertRegex, self, self.saved_manifest(),
+                        r'0:12:file0\.txt 0:12:file1\.txt 0:12:file2\.txt$')
+            # All three closes shared one save.
+            self.assertEqual(1, save.call_count)
+
+
 def fuseMkdirTestHelper(mounttmp):
     class Test(unittest.TestCase):
         def runTest(self):
@@ -1067,6 +1155,51 @@ class FuseProjectMvTest(MountTestBase):
         self.pool.apply(fuseProjectMvTestHelper1, (self.mounttmp,))
 
 
+class FuseProjectStreamingListTest(MountTestBase):
+    def runTest(self):
+        # Small pages, so one readdir() takes several of them.
+        with mock.patch.object(fuse.ProjectDirectory, 'STREAM_PAGE_SIZE', 7):
+            root = self.make_mount(fuse.ProjectDirectory,
+                                   project_object=run_test_server.fixture('groups')['project_with_201_collections'])
+
+            d1 = llfuse.listdir(self.mounttmp)
+            self.assertEqual(201, len(d1))
+            self.assertIn('Collection_1', d1)
+            self.assertEqual(len(d1), len(set(d1)))
+
+            # Fresh now, so listing again doesn't go back to the API server.
+            self.assertFalse(root.stale())
+            self.assertEqual(sorted(d1), sorted(llfuse.listdir(self.mounttmp)))
+
+
+class FuseProjectStreamingListRemoveTest(MountTestBase):
+    def runTest(self):
+        aproject = self.api.groups().create(body={
+            "name": "aproject",
+            "group_class": "project"
+        }).execute()
+        c1 = self.api.collections().create(body={
+            "name": "c1",
+            "owner_uuid": aproject["uuid"]
+        }).execute()
+        self.api.collections().create(body={
+            "name": "c2",
+            "owner_uuid": aproject["uuid"]
+        }).execute()
+
+        root = self.make_mount(fuse.ProjectDirectory, project_object=aproject)
+        self.assertEqual(["c1", "c2"], sorted(llfuse.listdir(self.mounttmp)))
+
+        self.api.collections().delete(uuid=c1["uuid"]).execute()
+        with llfuse.lock:
+            root.invalidate()
+
+        # Entries missing from a complete listing are removed.
+        self.assertEqual(["c2"], sorted(llfuse.listdir(self.mounttmp)))
+        with llfuse.lock:
+            self.assertNotIn("c1", root._entries)
+
+
 def fuseFsyncTestHelper(mounttmp, k):
     class Test(unittest.TestCase):
         def runTest(self):
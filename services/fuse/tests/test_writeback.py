@@ -0,0 +1,89 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: AGPL-3.0
+
+import arvados_fuse
+import mock
+import time
+import unittest
+
+class WriteBackTests(unittest.TestCase):
+    def test_save_immediately_by_default(self):
+        wb = arvados_fuse.WriteBack()
+        coll = mock.MagicMock()
+        wb.changed(coll)
+        self.assertEqual(1, coll.save.call_count)
+        self.assertFalse(wb.pending(coll))
+
+    def test_changes_share_one_save(self):
+        wb = arvados_fuse.WriteBack(delay=0.2)
+        coll = mock.MagicMock()
+        for _ in range(10):
+            wb.changed(coll)
+        self.assertTrue(wb.pending(coll))
+        self.assertEqual(0, coll.save.call_count)
+        time.sleep(0.5)
+        self.assertFalse(wb.pending(coll))
+        self.assertEqual(1, coll.save.call_count)
+        wb.close()
+
+    def test_size_threshold(self):
+        wb = arvados_fuse.WriteBack(delay=3600, max_bytes=1000)
+        coll = mock.MagicMock()
+        wb.changed(coll, 600)
+        self.assertTrue(wb.pending(coll))
+        wb.changed(coll, 600)
+        deadline = time.time() + 5
+        while wb.pending(coll) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(wb.pending(coll))
+        wb.close()
+        self.assertEqual(1, coll.save.call_count)
+
+    def test_save_now(self):
+        wb = arvados_fuse.WriteBack(delay=3600)
+        coll = mock.MagicMock()
+        wb.changed(coll)
+        wb.save(coll)
+        self.assertFalse(wb.pending(coll))
+        self.assertEqual(1, coll.save.call_count)
+        wb.close()
+        self.assertEqual(1, coll.save.call_count)
+
+    def test_close_saves_pending(self):
+        wb = arvados_fuse.WriteBack(delay=3600)
+        coll1 = mock.MagicMock()
+        coll2 = mock.MagicMock()
+        wb.changed(coll1)
+        wb.changed(coll2)
+        wb.close()
+        self.assertEqual(1, coll1.save.call_count)
+        self.assertEqual(1, coll2.save.call_count)
+        # Changes after close are saved right away.
+        wb.changed(coll1)
+        self.assertEqual(2, coll1.save.call_count)
+
+    def test_failed_save_retried(self):
+        wb = arvados_fuse.WriteBack(delay=0.1)
+        coll = mock.MagicMock()
+        coll.save.side_effect = [Exception('API fail'), None]
+        wb.changed(coll)
+        deadline = time.time() + 5
+        while coll.save.call_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, coll.save.call_count)
+        self.assertFalse(wb.pending(coll))
+        wb.close()
+
+    def test_on_save_called_after_background_save(self):
+        wb = arvados_fuse.WriteBack(delay=0.1)
+        coll = mock.MagicMock()
+        saved = mock.MagicMock()
+        wb.on_save(saved)
+        wb.changed(coll)
+        deadline = time.time() + 5
+        while not saved.called and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, coll.save.call_count)
+        self.assertEqual(1, saved.call_count)
+        wb.close()